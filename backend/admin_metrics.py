@@ -0,0 +1,576 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, select
+from .database import AsyncSessionLocal
+from .models import AdminStats, Conversation, Message, User
+from .ws_manager import REDIS_URL
+
+# How often the current figures are stored as an AdminStats snapshot
+ADMIN_STATS_SNAPSHOT_SECONDS = float(os.getenv("ADMIN_STATS_SNAPSHOT_SECONDS", "300"))
+# "0" keeps this worker from writing snapshots at all
+ADMIN_STATS_SNAPSHOTS = os.getenv("ADMIN_STATS_SNAPSHOTS", "1") != "0"
+
+# Rolling window of the "24h" figures and the width of its buckets
+WINDOW_SECONDS = 24 * 60 * 60
+BUCKET_SECONDS = 60
+
+
+def _epoch(at: datetime | None) -> float:
+    """Seconds since the epoch of a naive UTC datetime (now if None)."""
+    if at is None:
+        return time.time()
+    return at.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _minute(column, dialect: str):
+    """SQL expression of the minute ``column`` falls in, for grouping by it."""
+    if dialect == "sqlite":
+        return func.strftime("%Y-%m-%d %H:%M:00", column)
+    if dialect == "postgresql":
+        return func.date_trunc("minute", column)
+    return column
+
+
+def _as_datetime(value) -> datetime:
+    """A datetime from a result column (SQLite returns aggregates as text)."""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+class RollingCounter:
+    """Events of the last ``window`` seconds, counted per ``bucket`` seconds.
+
+    Holds at most ``window / bucket`` counts and their running sum, so
+    adding an event and reading the total don't depend on how many events
+    there were.
+    """
+
+    def __init__(self, window: float = WINDOW_SECONDS, bucket: float = BUCKET_SECONDS):
+        self.bucket = bucket
+        self.size = int(window // bucket)
+        self._counts = {}  # bucket number -> events
+        self._order = []  # bucket numbers, ascending
+        self._total = 0
+        self._current = None  # bucket number of the last expiry check
+
+    def bucket_number(self, at: float) -> int:
+        return int(at // self.bucket)
+
+    def oldest(self) -> int:
+        """Number of the oldest bucket still in the window; drops older ones."""
+        current = self.bucket_number(time.time())
+        if current != self._current:
+            self._current = current
+            expired = bisect_left(self._order, current - self.size + 1)
+            for number in self._order[:expired]:
+                self._total -= self._counts.pop(number)
+            del self._order[:expired]
+        return self._current - self.size + 1
+
+    def add_to(self, number: int, count: int = 1) -> None:
+        if number < self.oldest():
+            return
+        if number in self._counts:
+            self._counts[number] += count
+        else:
+            insort(self._order, number)
+            self._counts[number] = count
+        self._total += count
+
+    def add(self, count: int = 1, at: float | None = None) -> None:
+        self.add_to(self.bucket_number(time.time() if at is None else at), count)
+
+    def total(self) -> int:
+        self.oldest()
+        return self._total
+
+    def merge(self, other: "RollingCounter") -> None:
+        for number, count in other._counts.items():
+            self.add_to(number, count)
+
+
+class RollingDistinct:
+    """Distinct ids seen in the last ``window`` seconds, e.g. active users.
+
+    Each id is counted once, in the bucket of its latest event; memory grows
+    with the number of ids seen in the window (see ``prune``).
+    """
+
+    def __init__(self, window: float = WINDOW_SECONDS, bucket: float = BUCKET_SECONDS):
+        self._latest = {}  # id -> bucket number of its latest event
+        self._counter = RollingCounter(window, bucket)
+
+    def add(self, key, at: float | None = None) -> None:
+        self._add_to(key, self._counter.bucket_number(time.time() if at is None else at))
+
+    def _add_to(self, key, number: int) -> None:
+        previous = self._latest.get(key)
+        if previous is not None and previous >= number:
+            return
+        self._latest[key] = number
+        if previous is not None and previous >= self._counter.oldest():
+            self._counter.add_to(previous, -1)
+        self._counter.add_to(number, 1)
+
+    def total(self) -> int:
+        return self._counter.total()
+
+    def merge(self, other: "RollingDistinct") -> None:
+        for key, number in other._latest.items():
+            self._add_to(key, number)
+
+    def prune(self) -> None:
+        """Forgets the ids whose latest event has left the window."""
+        oldest = self._counter.oldest()
+        self._latest = {key: n for key, n in self._latest.items() if n >= oldest}
+
+    def __len__(self) -> int:
+        return len(self._latest)
+
+
+class AdminMetrics:
+    """Running totals and rolling 24h figures behind the admin dashboard.
+
+    Signups, new conversations and stored messages are reported here as they
+    happen, so reading the dashboard figures costs the same however large
+    the tables grow. Totals and the last 24 hours are loaded from the
+    database once, in the background after start (writes counted meanwhile
+    are added to them). Every ``interval`` seconds, and on stop, the figures
+    are stored as an ``AdminStats`` snapshot for the history chart.
+
+    Counts cover the writes of this process; with several workers, use
+    ``SharedAdminMetrics``. So that the history is one series rather than
+    several interleaved ones, only one worker writes snapshots: with
+    ``redis``, the holder of a lease that it renews on every snapshot and
+    that expires after three missed ones; without it, every worker that has
+    ``snapshots`` enabled.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        interval: float = ADMIN_STATS_SNAPSHOT_SECONDS,
+        window: float = WINDOW_SECONDS,
+        bucket: float = BUCKET_SECONDS,
+        snapshots: bool = ADMIN_STATS_SNAPSHOTS,
+        redis=None,
+        lease_key: str = "talkflow:admin_stats:writer",
+    ):
+        self.session_factory = session_factory
+        self.snapshots_enabled = snapshots
+        self.redis = redis
+        self.lease_key = lease_key
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_writer = False
+        self.interval = interval
+        self.window = window
+        self.bucket = bucket
+        self.total_users = 0
+        self.total_conversations = 0
+        self.total_messages = 0
+        self.new_users = RollingCounter(window, bucket)
+        self.new_messages = RollingCounter(window, bucket)
+        self.active_users = RollingDistinct(window, bucket)
+        self.loaded_at = None
+        self.load_seconds = None
+        self.snapshots = 0
+        self._task = None
+        # Sync routes (signup, new conversations) report from FastAPI's
+        # threadpool while the event loop reports messages and reads
+        self._lock = threading.Lock()
+
+    def user_created(self, created_at: datetime | None = None) -> None:
+        with self._lock:
+            self.total_users += 1
+            self.new_users.add(at=_epoch(created_at))
+
+    def conversation_created(self) -> None:
+        with self._lock:
+            self.total_conversations += 1
+
+    def messages_stored(self, rows) -> None:
+        """Counts committed message ``rows`` (dicts with sender and timestamp)."""
+        with self._lock:
+            for row in rows:
+                at = _epoch(row["timestamp"])
+                self.new_messages.add(at=at)
+                self.active_users.add(row["sender_id"], at)
+            self.total_messages += len(rows)
+
+    async def current(self) -> dict:
+        """The dashboard figures, with the fields of ``AdminStats``."""
+        with self._lock:
+            return {
+                "total_users": self.total_users,
+                "total_conversations": self.total_conversations,
+                "total_messages": self.total_messages,
+                "active_users_24h": self.active_users.total(),
+                "new_users_24h": self.new_users.total(),
+                "new_messages_24h": self.new_messages.total(),
+                "stats_date": datetime.utcnow(),
+            }
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        if self.loaded_at is not None and await self.hold_lease():
+            await self.write_snapshot()
+        if self.is_writer and self.redis is not None:
+            # Hand over to another worker without waiting for the lease to expire
+            if _decode(await self.redis.get(self.lease_key)) == self.worker_id:
+                await self.redis.delete(self.lease_key)
+            self.is_writer = False
+
+    async def hold_lease(self) -> bool:
+        """Whether this worker is the one to write snapshots (renewing its lease)."""
+        if not self.snapshots_enabled:
+            self.is_writer = False
+        elif self.redis is None:
+            self.is_writer = True
+        else:
+            ttl = max(int(self.interval * 3), 1)
+            acquired = await self.redis.set(
+                self.lease_key, self.worker_id, nx=True, ex=ttl
+            )
+            if not acquired and (
+                _decode(await self.redis.get(self.lease_key)) == self.worker_id
+            ):
+                acquired = await self.redis.expire(self.lease_key, ttl)
+            self.is_writer = bool(acquired)
+        return self.is_writer
+
+    async def load(self) -> None:
+        """Reads the totals and the window's events from the database.
+
+        Counts recorded before it finishes are added to what it reads, so it
+        is meant to run once, on an aggregator that started counting empty.
+        """
+        started = time.perf_counter()
+        (
+            (total_users, total_conversations, total_messages),
+            new_users,
+            new_messages,
+            active_users,
+        ) = await self.read_database()
+        with self._lock:
+            new_users.merge(self.new_users)
+            new_messages.merge(self.new_messages)
+            active_users.merge(self.active_users)
+            self.total_users += total_users
+            self.total_conversations += total_conversations
+            self.total_messages += total_messages
+            self.new_users = new_users
+            self.new_messages = new_messages
+            self.active_users = active_users
+        self.loaded_at = datetime.utcnow()
+        self.load_seconds = time.perf_counter() - started
+
+    async def read_database(self) -> tuple:
+        """``(totals, new_users, new_messages, active_users)`` counted from the
+        tables: the user, conversation and message counts, and rolling
+        figures of the window."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.window)
+        new_users = RollingCounter(self.window, self.bucket)
+        new_messages = RollingCounter(self.window, self.bucket)
+        active_users = RollingDistinct(self.window, self.bucket)
+        async with self.session_factory() as db:
+            total_users = await db.scalar(select(func.count(User.id)))
+            total_conversations = await db.scalar(select(func.count(Conversation.id)))
+            total_messages = await db.scalar(select(func.count(Message.id)))
+            created = await db.execute(
+                select(User.created_at).where(User.created_at >= cutoff)
+            )
+            for (created_at,) in created:
+                new_users.add(at=_epoch(created_at))
+            minute = _minute(Message.timestamp, db.get_bind().dialect.name)
+            per_minute = await db.execute(
+                select(minute, func.count(Message.id))
+                .where(Message.timestamp >= cutoff)
+                .group_by(minute)
+            )
+            for started_at, count in per_minute:
+                new_messages.add(count, at=_epoch(_as_datetime(started_at)))
+            latest = await db.execute(
+                select(Message.sender_id, func.max(Message.timestamp))
+                .where(Message.timestamp >= cutoff)
+                .group_by(Message.sender_id)
+            )
+            for sender_id, timestamp in latest:
+                active_users.add(sender_id, _epoch(_as_datetime(timestamp)))
+        totals = (total_users, total_conversations, total_messages)
+        return totals, new_users, new_messages, active_users
+
+    async def flush(self) -> None:
+        """Hands counts over to shared storage (nothing to do here)."""
+
+    async def write_snapshot(self) -> None:
+        figures = await self.current()
+        async with self.session_factory() as db:
+            db.add(AdminStats(**figures))
+            await db.commit()
+        self.snapshots += 1
+
+    def stats(self) -> dict:
+        return {
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "load_seconds": self.load_seconds,
+            "snapshots": self.snapshots,
+            "snapshot_writer": self.is_writer,
+            "tracked_active_users": len(self.active_users),
+        }
+
+    async def _run(self) -> None:
+        try:
+            await self.load()
+        except Exception as e:
+            print(f"Error loading admin stats: {e}")
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._tick()
+            except Exception as e:
+                print(f"Error writing admin stats snapshot: {e}")
+
+    async def _tick(self) -> None:
+        """Runs every ``interval``: drops expired ids, writes a snapshot."""
+        if self.loaded_at is None:
+            return  # partial figures; the load failed
+        with self._lock:
+            self.active_users.prune()
+        if await self.hold_lease():
+            await self.write_snapshot()
+
+
+class SharedAdminMetrics(AdminMetrics):
+    """``AdminMetrics`` kept in Redis, so every worker reports the same figures.
+
+    Each worker buffers the writes it reports and adds them to Redis every
+    ``flush_interval`` seconds; the figures are read back from Redis:
+
+    - ``<prefix>:totals`` hash of users, conversations and messages
+    - ``<prefix>:new_users:<n>`` / ``<prefix>:new_messages:<n>`` counts of
+      bucket ``n``, each expiring when it leaves the window
+    - ``<prefix>:active`` sorted set of user id -> start of the bucket of
+      their latest message, trimmed to the window
+    - ``<prefix>:loaded`` set by the worker that counted the tables
+
+    The tables are counted by the first worker to start (and again if Redis
+    lost the figures), not by every one.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        redis,
+        prefix: str = "talkflow:admin_stats",
+        flush_interval: float = 1.0,
+        **kwargs,
+    ):
+        super().__init__(session_factory, redis=redis, **kwargs)
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self._pending_totals = {"users": 0, "conversations": 0, "messages": 0}
+        self._pending_buckets = {"new_users": {}, "new_messages": {}}
+        self._pending_active = {}  # user id -> bucket number of latest message
+        self.flushes = 0
+
+    def _key(self, *parts) -> str:
+        return ":".join((self.prefix, *map(str, parts)))
+
+    def _count(self, series: str, at: float, count: int = 1) -> None:
+        buckets = self._pending_buckets[series]
+        number = int(at // self.bucket)
+        buckets[number] = buckets.get(number, 0) + count
+
+    def user_created(self, created_at: datetime | None = None) -> None:
+        with self._lock:
+            self._pending_totals["users"] += 1
+            self._count("new_users", _epoch(created_at))
+
+    def conversation_created(self) -> None:
+        with self._lock:
+            self._pending_totals["conversations"] += 1
+
+    def messages_stored(self, rows) -> None:
+        with self._lock:
+            for row in rows:
+                at = _epoch(row["timestamp"])
+                self._count("new_messages", at)
+                number = int(at // self.bucket)
+                if self._pending_active.get(row["sender_id"], number - 1) < number:
+                    self._pending_active[row["sender_id"]] = number
+            self._pending_totals["messages"] += len(rows)
+
+    def _window_numbers(self) -> range:
+        newest = int(time.time() // self.bucket)
+        return range(newest - int(self.window // self.bucket) + 1, newest + 1)
+
+    async def current(self) -> dict:
+        numbers = self._window_numbers()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(self._key("totals"), "users", "conversations", "messages")
+            for series in ("new_users", "new_messages"):
+                pipe.mget([self._key(series, n) for n in numbers])
+            pipe.zcount(self._key("active"), numbers[0] * self.bucket, "+inf")
+            totals, new_users, new_messages, active = await pipe.execute()
+        users, conversations, messages = (int(value or 0) for value in totals)
+        return {
+            "total_users": users,
+            "total_conversations": conversations,
+            "total_messages": messages,
+            "active_users_24h": active,
+            "new_users_24h": sum(int(value or 0) for value in new_users),
+            "new_messages_24h": sum(int(value or 0) for value in new_messages),
+            "stats_date": datetime.utcnow(),
+        }
+
+    async def flush(self) -> None:
+        with self._lock:
+            totals, self._pending_totals = self._pending_totals, {
+                "users": 0,
+                "conversations": 0,
+                "messages": 0,
+            }
+            buckets, self._pending_buckets = self._pending_buckets, {
+                "new_users": {},
+                "new_messages": {},
+            }
+            active, self._pending_active = self._pending_active, {}
+        if not any(totals.values()) and not any(buckets.values()) and not active:
+            return
+        try:
+            await self._write(totals, buckets, active, absolute=False)
+        except Exception:
+            # Keep the counts for the next flush
+            with self._lock:
+                for name, count in totals.items():
+                    self._pending_totals[name] += count
+                for series, counts in buckets.items():
+                    for number, count in counts.items():
+                        self._count(series, number * self.bucket, count)
+                for user_id, number in active.items():
+                    if self._pending_active.get(user_id, number - 1) < number:
+                        self._pending_active[user_id] = number
+            raise
+        self.flushes += 1
+
+    async def _write(self, totals: dict, buckets: dict, active: dict, absolute: bool):
+        """Adds counts to Redis, or with ``absolute`` replaces them."""
+        oldest = self._window_numbers()[0]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for name, count in totals.items():
+                if absolute:
+                    pipe.hset(self._key("totals"), name, count)
+                elif count:
+                    pipe.hincrby(self._key("totals"), name, count)
+            for series, counts in buckets.items():
+                for number, count in counts.items():
+                    if number < oldest:
+                        continue
+                    key = self._key(series, number)
+                    if absolute:
+                        pipe.set(key, count)
+                    else:
+                        pipe.incrby(key, count)
+                    pipe.expireat(key, int((number + 1) * self.bucket + self.window))
+            if active:
+                pipe.zadd(
+                    self._key("active"),
+                    {user_id: number * self.bucket for user_id, number in active.items()},
+                    gt=True,
+                )
+            await pipe.execute()
+
+    async def load(self) -> None:
+        """Counts the tables into Redis, unless another worker already did."""
+        started = time.perf_counter()
+        if await self.redis.set(self._key("loaded"), self.worker_id, nx=True):
+            try:
+                totals, new_users, new_messages, active_users = (
+                    await self.read_database()
+                )
+                # The tables hold every committed write up to now, including
+                # ones other workers have already added
+                await self._write(
+                    dict(zip(("users", "conversations", "messages"), totals)),
+                    {
+                        "new_users": dict(new_users._counts),
+                        "new_messages": dict(new_messages._counts),
+                    },
+                    dict(active_users._latest),
+                    absolute=True,
+                )
+            except BaseException:
+                await self.redis.delete(self._key("loaded"))
+                raise
+        self.loaded_at = datetime.utcnow()
+        self.load_seconds = time.perf_counter() - started
+
+    async def _run(self) -> None:
+        flusher = asyncio.create_task(self._flush_regularly())
+        try:
+            await super()._run()
+        finally:
+            flusher.cancel()
+
+    async def _flush_regularly(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error adding admin stats to Redis: {e}")
+
+    async def _tick(self) -> None:
+        if not await self.redis.exists(self._key("loaded")):
+            await self.load()  # Redis lost the figures (e.g. restarted)
+        if self.loaded_at is None:
+            return
+        await self.redis.zremrangebyscore(
+            self._key("active"), "-inf", f"({self._window_numbers()[0] * self.bucket}"
+        )
+        if await self.hold_lease():
+            await self.write_snapshot()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        del stats["tracked_active_users"]
+        return {**stats, "store": "redis", "flushes": self.flushes}
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def create_admin_metrics(redis_url: str | None) -> AdminMetrics:
+    """Counters for this worker, or shared through Redis if configured."""
+    if not redis_url:
+        return AdminMetrics(AsyncSessionLocal)
+    try:
+        import redis.asyncio as redis_asyncio
+    except ImportError as e:
+        raise RuntimeError(
+            "REDIS_URL is set but the 'redis' package is not installed"
+        ) from e
+    return SharedAdminMetrics(AsyncSessionLocal, redis_asyncio.from_url(redis_url))
+
+
+# Shared aggregator fed by the signup, conversation and message write paths
+admin_metrics = create_admin_metrics(REDIS_URL)
@@ -1,10 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from sqlalchemy import func, and_, distinct
 from datetime import datetime, timedelta
 from .database import get_db
-from .models import User, Conversation, Message, AdminStats, ConversationParticipant
-from .auth import get_current_user, get_password_hash
+from .models import User, Message, AdminStats, ConversationParticipant
+from .auth import (
+    get_current_user_flags,
+    password_hasher,
+    user_cache,
+    user_cache_invalidator,
+)
+from .admin_metrics import admin_metrics
+from .ws_manager import presence, connect_limiter
+from .message_pipeline import message_pipeline
+from .chat_list_notifier import chat_list_notifier
+from .membership_cache import membership_cache
+from .presence_broadcaster import presence_broadcaster
+from .last_seen_writer import last_seen_writer
+from .ai_cache import ai_cache
+from .ai_limiter import ai_limiter
+from .ai_routes import ai_client
 from typing import List, Optional
 from pydantic import BaseModel
 
@@ -32,55 +47,17 @@ class UserStats(BaseModel):
     is_super_admin: bool
 
 # Helper function to check if user is admin
-async def get_admin_user(current_user: User = Depends(get_current_user)):
+async def get_admin_user(current_user: User = Depends(get_current_user_flags)):
     if not current_user.is_admin and not current_user.is_super_admin:
         raise HTTPException(status_code=403, detail="Not authorized. Admin access required.")
     return current_user
 
 # Helper function to check if user is super admin
-async def get_super_admin_user(current_user: User = Depends(get_current_user)):
+async def get_super_admin_user(current_user: User = Depends(get_current_user_flags)):
     if not current_user.is_super_admin:
         raise HTTPException(status_code=403, detail="Not authorized. Super admin access required.")
     return current_user
 
-async def update_admin_stats(db: Session):
-    """Background task to update admin stats"""
-    try:
-        # Get total counts
-        total_users = db.query(func.count(User.id)).scalar()
-        total_conversations = db.query(func.count(Conversation.id)).scalar()
-        total_messages = db.query(func.count(Message.id)).scalar()
-        
-        # Get 24h stats
-        day_ago = datetime.utcnow() - timedelta(days=1)
-        
-        # Count distinct users who sent messages in the last 24 hours
-        active_users = db.query(func.count(distinct(Message.sender_id))).\
-            filter(Message.timestamp >= day_ago).scalar() or 0
-        
-        new_users = db.query(func.count(User.id)).\
-            filter(User.created_at >= day_ago).scalar() or 0
-        
-        new_messages = db.query(func.count(Message.id)).\
-            filter(Message.timestamp >= day_ago).scalar() or 0
-        
-        # Create new stats entry
-        stats = AdminStats(
-            total_users=total_users,
-            total_conversations=total_conversations,
-            total_messages=total_messages,
-            active_users_24h=active_users,
-            new_users_24h=new_users,
-            new_messages_24h=new_messages,
-            stats_date=datetime.utcnow()
-        )
-        
-        db.add(stats)
-        db.commit()
-    except Exception as e:
-        print(f"Error updating admin stats: {e}")
-        db.rollback()
-
 @router.post("/create-super-admin")
 async def create_super_admin(
     username: str,
@@ -93,7 +70,7 @@ async def create_super_admin(
         raise HTTPException(status_code=400, detail="Super admin already exists")
     
     # Create new super admin
-    hashed_password = get_password_hash(password)
+    hashed_password = await password_hasher.hash(password)
     
     super_admin = User(
         username=username,
@@ -104,55 +81,42 @@ async def create_super_admin(
     
     db.add(super_admin)
     db.commit()
+    admin_metrics.user_created(super_admin.created_at)
     
     return {"message": "Super admin created successfully"}
 
 @router.get("/stats", response_model=AdminStatsResponse)
-async def get_admin_stats(
-    background_tasks: BackgroundTasks,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
+async def get_admin_stats(current_user: User = Depends(get_current_user_flags)):
     if not current_user.is_admin and not current_user.is_super_admin:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    # Get total counts
-    total_users = db.query(func.count(User.id)).scalar()
-    total_conversations = db.query(func.count(Conversation.id)).scalar()
-    total_messages = db.query(func.count(Message.id)).scalar()
-    
-    # Get 24h stats
-    day_ago = datetime.utcnow() - timedelta(days=1)
-    
-    # Count distinct users who sent messages in the last 24 hours
-    active_users = db.query(func.count(distinct(Message.sender_id))).\
-        filter(Message.timestamp >= day_ago).scalar() or 0
-    
-    new_users = db.query(func.count(User.id)).\
-        filter(User.created_at >= day_ago).scalar() or 0
-    
-    new_messages = db.query(func.count(Message.id)).\
-        filter(Message.timestamp >= day_ago).scalar() or 0
-    
-    # Create stats response
-    stats = AdminStatsResponse(
-        total_users=total_users,
-        total_conversations=total_conversations,
-        total_messages=total_messages,
-        active_users_24h=active_users,
-        new_users_24h=new_users,
-        new_messages_24h=new_messages,
-        stats_date=datetime.utcnow()
+    # Counted as writes happen (see admin_metrics.py), so no table is scanned;
+    # the snapshots in /stats/history are written by the same aggregator
+    return AdminStatsResponse(
+        **(await admin_metrics.current()),
+        additional_metrics={
+            "online_users": await presence.user_count(),
+            "connected_sockets": await presence.socket_count(),
+            "admin_metrics": admin_metrics.stats(),
+            "auth_cache": user_cache.stats(),
+            "auth_cache_invalidator": user_cache_invalidator.stats(),
+            "password_hasher": password_hasher.stats(),
+            "message_pipeline": message_pipeline.stats(),
+            "chat_list_notifier": chat_list_notifier.stats(),
+            "connect_limiter": connect_limiter.stats(),
+            "membership_cache": membership_cache.stats(),
+            "presence_store": presence.stats(),
+            "presence_broadcaster": presence_broadcaster.stats(),
+            "last_seen_writer": last_seen_writer.stats(),
+            "ai_cache": ai_cache.stats(),
+            "ai_limiter": ai_limiter.stats(),
+            "ai_client": ai_client.stats(),
+        }
     )
-    
-    # Update stats in background
-    background_tasks.add_task(update_admin_stats, db)
-    
-    return stats
 
 @router.get("/users", response_model=List[UserStats])
 async def get_user_stats(
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_user_flags),
     db: Session = Depends(get_db),
     skip: int = 0,
     limit: int = 10
@@ -190,7 +154,7 @@ async def get_user_stats(
 @router.post("/users/{user_id}/toggle-admin")
 async def toggle_admin_status(
     user_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_user_flags),
     db: Session = Depends(get_db)
 ):
     if not current_user.is_super_admin:
@@ -205,6 +169,9 @@ async def toggle_admin_status(
     
     user.is_admin = not user.is_admin
     db.commit()
+    # Cached sessions of this user must see the new flags immediately, on
+    # every worker
+    await user_cache_invalidator.invalidate_user(user.id)
     
     return {"message": f"Admin status {'granted' if user.is_admin else 'revoked'} for user {user.username}"}
 
@@ -0,0 +1,64 @@
+import json
+import os
+import re
+from .ai_prompts import prompts
+
+# Bounds of one batched prompt: characters of message text and messages
+AI_BATCH_MAX_CHARS = int(os.getenv("AI_BATCH_MAX_CHARS", "6000"))
+AI_BATCH_MAX_ITEMS = int(os.getenv("AI_BATCH_MAX_ITEMS", "50"))
+
+
+def pack_batches(
+    items: list[tuple[int, str]],
+    max_chars: int = AI_BATCH_MAX_CHARS,
+    max_items: int = AI_BATCH_MAX_ITEMS,
+) -> list[list[tuple[int, str]]]:
+    """Splits ``(id, text)`` pairs into batches of bounded size, in order.
+
+    A text longer than ``max_chars`` gets a batch of its own.
+    """
+    batches = []
+    batch, size = [], 0
+    for item_id, text in items:
+        if batch and (size + len(text) > max_chars or len(batch) >= max_items):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append((item_id, text))
+        size += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def batch_translation_prompt(
+    batch: list[tuple[int, str]], target_language: str
+) -> str:
+    """One prompt translating every text of ``batch``, keyed by id."""
+    payload = json.dumps(
+        {str(item_id): text for item_id, text in batch}, ensure_ascii=False
+    )
+    return prompts.render("translate-batch", payload, target_language)
+
+
+def parse_batch_response(response: str, ids) -> dict:
+    """The ``{id: text}`` results found in a response to a batched prompt.
+
+    Tolerates a Markdown code fence or text around the JSON object; ids
+    that are missing or not strings are left out, for the caller to retry
+    on their own.
+    """
+    match = re.search(r"\{.*\}", response, re.DOTALL)
+    if not match:
+        return {}
+    try:
+        parsed = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    results = {}
+    for item_id in ids:
+        value = parsed.get(str(item_id))
+        if isinstance(value, str) and value.strip():
+            results[item_id] = value.strip()
+    return results
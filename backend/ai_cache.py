@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "5000"))
+AI_CACHE_TTL_SECONDS = int(os.getenv("AI_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# SQLite file for a cache that survives restarts and is shared by workers;
+# unset keeps the cache in memory only
+AI_CACHE_DB_PATH = os.getenv("AI_CACHE_DB_PATH")
+
+
+def normalize_text(text: str) -> str:
+    """Unicode-normalized text with insignificant whitespace removed."""
+    text = unicodedata.normalize("NFC", text)
+    lines = (re.sub(r"[ \t]+", " ", line).strip() for line in text.splitlines())
+    return "\n".join(lines).strip()
+
+
+def cache_key(kind: str, text: str, target_language: str | None = None) -> str:
+    """Content address of an AI request: prompt kind, language and text."""
+    material = "\0".join(
+        (kind, (target_language or "").strip().lower(), normalize_text(text))
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class SQLiteResponseStore:
+    """Persistent tier of the AI response cache (blocking; use from a thread)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ai_responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "expires_at REAL NOT NULL)"
+            )
+        self.purge_expired()
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections aren't thread-safe
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        """Returns ``(response, expires_at)`` or None if missing/expired."""
+        row = (
+            self._connect()
+            .execute(
+                "SELECT response, expires_at FROM ai_responses "
+                "WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+        return tuple(row) if row else None
+
+    def put(self, key: str, response: str, expires_at: float) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO ai_responses (key, response, expires_at) "
+                "VALUES (?, ?, ?)",
+                (key, response, expires_at),
+            )
+
+    def purge_expired(self) -> int:
+        with self._connect() as conn:
+            return conn.execute(
+                "DELETE FROM ai_responses WHERE expires_at <= ?", (time.time(),)
+            ).rowcount
+
+
+class AIResponseCache:
+    """Content-addressed cache of AI responses.
+
+    A bounded in-memory LRU in front of an optional SQLite tier. Entries
+    expire after ``ttl_seconds``; only successful responses are stored, so
+    errors are always retried upstream.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = AI_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = AI_CACHE_TTL_SECONDS,
+        store: SQLiteResponseStore | None = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.store = store
+        self._entries = OrderedDict()  # key -> (expires_at, response)
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.store_errors = 0
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            del self._entries[key]
+
+        if self.store is not None:
+            try:
+                row = await asyncio.to_thread(self.store.get, key)
+            except sqlite3.Error as e:
+                print(f"Error reading the AI response cache: {e}")
+                self.store_errors += 1
+                row = None
+            if row is not None:
+                response, expires_at = row
+                self._remember(key, response, expires_at)
+                self.persistent_hits += 1
+                return response
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, response: str) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, response, expires_at)
+        if self.store is not None:
+            try:
+                await asyncio.to_thread(self.store.put, key, response, expires_at)
+            except sqlite3.Error as e:
+                print(f"Error writing the AI response cache: {e}")
+                self.store_errors += 1
+
+    def _remember(self, key: str, response: str, expires_at: float) -> None:
+        self._entries[key] = (expires_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.persistent_hits
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "persistent": self.store is not None,
+            "memory_hits": self.memory_hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "store_errors": self.store_errors,
+        }
+
+
+def create_ai_cache(db_path: str | None = AI_CACHE_DB_PATH) -> AIResponseCache:
+    store = SQLiteResponseStore(db_path) if db_path else None
+    return AIResponseCache(store=store)
+
+
+# Shared cache used by the AI routes
+ai_cache = create_ai_cache()
@@ -0,0 +1,149 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+
+# Upstream AI calls allowed at once, in total and per user
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+AI_MAX_CONCURRENCY_PER_USER = int(os.getenv("AI_MAX_CONCURRENCY_PER_USER", "2"))
+
+# Calls allowed to wait for a slot; beyond that requests get a 429
+AI_MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", "64"))
+AI_QUEUE_TIMEOUT_SECONDS = float(os.getenv("AI_QUEUE_TIMEOUT_SECONDS", "15"))
+
+
+class AICallLimiter:
+    """Single-flight deduplication and concurrency limits for AI calls.
+
+    Requests with the same key (same prompt kind, language and text) while
+    a call for it is in flight share that call's result instead of making
+    their own. New calls take a per-user and a global slot; while slots are
+    taken they wait in a bounded queue (429 with Retry-After once it is
+    full, 503 if no slot frees up within ``queue_timeout``).
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = AI_MAX_CONCURRENCY,
+        max_concurrency_per_user: int = AI_MAX_CONCURRENCY_PER_USER,
+        max_queue: int = AI_MAX_QUEUE,
+        queue_timeout: float = AI_QUEUE_TIMEOUT_SECONDS,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_concurrency_per_user = max_concurrency_per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._slots = None  # created lazily, inside the running event loop
+        self._user_slots = {}  # user id -> (semaphore, calls using it)
+        self._inflight = {}  # key -> task of the call
+        self._queued = 0
+        self._running = 0
+        self.calls = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    async def run(self, key: str, user_id, call):
+        """Returns ``await call()``, or the result of an identical call in flight."""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        self._enqueue()
+        # A task of its own, so the call survives the first caller going away
+        # while others still wait for it
+        task = asyncio.ensure_future(self._call(user_id, call))
+        self._inflight[key] = task
+        task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        """Holds a per-user and a global slot, without single-flight.
+
+        For calls whose result can't be shared, e.g. a response streamed to
+        one client.
+        """
+        self._enqueue()
+        async with self._slot(user_id):
+            yield
+
+    def _enqueue(self) -> None:
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Too many AI requests, please retry shortly.",
+                headers={"Retry-After": "2"},
+            )
+        self.calls += 1
+        self._queued += 1  # until the call gets its slots
+
+    def _forget(self, key, task) -> None:
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every caller went away
+
+    async def _call(self, user_id, call):
+        async with self._slot(user_id):
+            return await call()
+
+    @asynccontextmanager
+    async def _slot(self, user_id):
+        """Waits for the slots of an enqueued call and holds them."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        user_slot, users = self._user_slots.get(user_id, (None, 0))
+        if user_slot is None:
+            user_slot = asyncio.Semaphore(self.max_concurrency_per_user)
+        self._user_slots[user_id] = (user_slot, users + 1)
+
+        acquired = []
+
+        async def acquire_slots():
+            for slot in (user_slot, self._slots):
+                await slot.acquire()
+                acquired.append(slot)
+
+        try:
+            try:
+                await asyncio.wait_for(acquire_slots(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="AI service is busy, please retry shortly.",
+                    headers={"Retry-After": "5"},
+                )
+            finally:
+                self._queued -= 1
+
+            self._running += 1
+            try:
+                yield
+            finally:
+                self._running -= 1
+        finally:
+            for slot in acquired:
+                slot.release()
+            user_slot, users = self._user_slots[user_id]
+            if users > 1:
+                self._user_slots[user_id] = (user_slot, users - 1)
+            else:
+                del self._user_slots[user_id]
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self._running,
+            "queued": self._queued,
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+
+# Shared limiter used by the AI routes
+ai_limiter = AICallLimiter()
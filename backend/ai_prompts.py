@@ -0,0 +1,78 @@
+import os
+from fastapi import HTTPException
+
+# Target languages of translations besides the built-in ones, e.g. "French,Spanish"
+AI_EXTRA_TRANSLATION_LANGUAGES = os.getenv("AI_EXTRA_TRANSLATION_LANGUAGES", "")
+
+
+class PromptRegistry:
+    """Prompt templates per AI task, optionally specialized per language.
+
+    Templates are ``str.format`` strings over ``text`` and ``language``. A
+    task's template for a language is used when registered, otherwise its
+    language-independent one; translations are limited to the registered
+    languages.
+    """
+
+    def __init__(self):
+        self._templates = {}  # (task, language or None) -> template
+        self.languages = {}  # lower-case name -> display name
+
+    def register(self, task: str, template: str, language: str | None = None) -> None:
+        key = (task, language.lower() if language else None)
+        self._templates[key] = template
+
+    def register_language(self, name: str) -> None:
+        self.languages[name.strip().lower()] = name.strip()
+
+    def language(self, target_language: str | None) -> str:
+        """Display name of a supported translation language (400 otherwise)."""
+        language = self.languages.get((target_language or "").strip().lower())
+        if language is None:
+            supported = ", ".join(self.languages.values())
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported target language. Supported languages: {supported}",
+            )
+        return language
+
+    def render(self, task: str, text: str, target_language: str | None = None) -> str:
+        language = self.language(target_language) if target_language else None
+        template = self._templates.get((task, language and language.lower()))
+        if template is None:
+            template = self._templates.get((task, None))
+        if template is None:
+            raise HTTPException(status_code=400, detail=f"Unknown AI task: {task}")
+        return template.format(text=text, language=language)
+
+
+def create_prompt_registry() -> PromptRegistry:
+    registry = PromptRegistry()
+    registry.register(
+        "fix-grammar",
+        'Correct the grammar and spelling of the following text, only return the corrected text:\n\n"{text}"',
+    )
+    # Simple prompt, might need refinement for better results
+    registry.register(
+        "complete-sentence",
+        'Complete the following text naturally, returning the full completed text:\n\n"{text}"',
+    )
+    registry.register(
+        "translate",
+        'Translate the following text to {language} and only return the translated text:\n\n"{text}"',
+    )
+    # ``text`` is a JSON object of the messages, keyed by id (see ai_batch.py)
+    registry.register(
+        "translate-batch",
+        "Translate the values of the following JSON object to {language}. "
+        "Return only a JSON object with the same keys and the translated "
+        "values:\n\n{text}",
+    )
+    for name in ["Russian", "German", *AI_EXTRA_TRANSLATION_LANGUAGES.split(",")]:
+        if name.strip():
+            registry.register_language(name)
+    return registry
+
+
+# Shared registry used by the AI routes
+prompts = create_prompt_registry()
@@ -0,0 +1,338 @@
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from dataclasses import dataclass
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+# Load environment variables (specifically GEMINI_API_KEY)
+load_dotenv()
+
+# Gemini model name, or "stub" for the offline stand-in (see ai_stub.py)
+AI_MODEL = os.getenv("AI_MODEL", "gemini-1.5-flash")
+
+# Providers tried in order, e.g. "gemini,stub" or "gemini:gemini-1.5-pro,gemini";
+# defaults to the one AI_MODEL selects
+AI_PROVIDERS = os.getenv("AI_PROVIDERS")
+
+# Per-provider deadline of a call, and when a slow call gets a second attempt
+# running alongside it (0 disables hedging; a failed call is still retried once)
+AI_TIMEOUT_SECONDS = float(os.getenv("AI_TIMEOUT_SECONDS", "30"))
+AI_HEDGE_AFTER_MS = int(os.getenv("AI_HEDGE_AFTER_MS", "4000"))
+
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+@dataclass(frozen=True)
+class AIResponse:
+    """Text of a provider's answer and the tokens it reports (0 if unknown)."""
+
+    text: str
+    prompt_tokens: int = 0
+    response_tokens: int = 0
+
+
+class Histogram:
+    """Observation counts per bucket (inclusive upper bounds, plus overflow)."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float):
+        """Upper bound of the bucket holding the ``q`` quantile (None if empty/overflow)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def stats(self) -> dict:
+        buckets = {f"le_{bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets["overflow"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class ProviderMetrics:
+    def __init__(self):
+        self.latency_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.first_chunk_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.prompt_tokens = Histogram(TOKEN_BUCKETS)
+        self.response_tokens = Histogram(TOKEN_BUCKETS)
+        self.errors = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    def observe(self, seconds: float, response: AIResponse | None = None) -> None:
+        self.latency_ms.observe(seconds * 1000)
+        if response is not None and response.prompt_tokens:
+            self.prompt_tokens.observe(response.prompt_tokens)
+        if response is not None and response.response_tokens:
+            self.response_tokens.observe(response.response_tokens)
+
+    def stats(self) -> dict:
+        return {
+            "latency_ms": self.latency_ms.stats(),
+            "first_chunk_ms": self.first_chunk_ms.stats(),
+            "prompt_tokens": self.prompt_tokens.stats(),
+            "response_tokens": self.response_tokens.stats(),
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+        }
+
+
+class GeminiProvider:
+    """Google Gemini; the client is only imported and configured on first use."""
+
+    def __init__(self, model_name: str = AI_MODEL, api_key: str | None = None):
+        self.name = f"gemini:{model_name}"
+        self.model_name = model_name
+        self.api_key = api_key
+        self._model = None
+
+    def _client(self):
+        if self._model is None:
+            api_key = self.api_key or os.getenv("GEMINI_API_KEY")
+            if not api_key:
+                raise HTTPException(
+                    status_code=503,
+                    detail="AI service is not configured (missing API key).",
+                )
+            try:
+                import google.generativeai as genai
+
+                genai.configure(api_key=api_key)
+                self._model = genai.GenerativeModel(self.model_name)
+                print(f"Gemini AI model {self.model_name} initialized successfully.")
+            except Exception as e:
+                print(f"Error configuring Gemini AI: {e}")
+                raise HTTPException(status_code=503, detail="AI service is unavailable.")
+        return self._model
+
+    async def generate(self, prompt: str) -> AIResponse:
+        response = await self._client().generate_content_async(prompt)
+        if not response.parts:
+            # Blocked or empty; response.prompt_feedback has the safety ratings
+            print(
+                f"Gemini response was empty or blocked. Feedback: {response.prompt_feedback}"
+            )
+            raise HTTPException(
+                status_code=500, detail="AI failed to generate a response."
+            )
+        usage = getattr(response, "usage_metadata", None)
+        return AIResponse(
+            response.text,
+            getattr(usage, "prompt_token_count", 0) or 0,
+            getattr(usage, "candidates_token_count", 0) or 0,
+        )
+
+    async def stream(self, prompt: str):
+        response = await self._client().generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            if chunk.parts:
+                yield chunk.text
+
+
+class AIClient:
+    """Calls AI providers with timeouts, hedged retries and a fallback chain.
+
+    Each provider gets ``timeout`` seconds. A call still unanswered after
+    ``hedge_after`` seconds gets a second attempt alongside it, and the
+    first answer wins; a call that fails early is retried once instead.
+    When a provider fails or times out the next one in ``providers`` is
+    tried. Errors a retry can't fix (4xx) are raised right away. Latency
+    and token counts are recorded per provider.
+    """
+
+    def __init__(
+        self,
+        providers: list,
+        timeout: float = AI_TIMEOUT_SECONDS,
+        hedge_after: float = AI_HEDGE_AFTER_MS / 1000,
+    ):
+        self.providers = providers
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.metrics = {provider.name: ProviderMetrics() for provider in providers}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.retries = 0
+        self.fallbacks = 0
+
+    async def generate(self, prompt: str) -> str:
+        error = None
+        for n, provider in enumerate(self.providers):
+            if n:
+                self.fallbacks += 1
+            try:
+                return await self._hedged(provider, prompt)
+            except HTTPException as e:
+                if e.status_code < 500:
+                    raise
+                error = e
+        raise error
+
+    async def stream(self, prompt: str):
+        """Yields the answer in chunks from the first provider that starts one.
+
+        Falls back to the next provider only until the first chunk arrives
+        (within ``timeout``); streams are not hedged.
+        """
+        error = None
+        for n, provider in enumerate(self.providers):
+            if n:
+                self.fallbacks += 1
+            metrics = self.metrics[provider.name]
+            chunks = provider.stream(prompt)
+            started = time.perf_counter()
+            try:
+                try:
+                    first = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    metrics.errors += 1
+                    error = HTTPException(
+                        status_code=500, detail="AI failed to generate a response."
+                    )
+                    continue
+                except asyncio.TimeoutError:
+                    metrics.timeouts += 1
+                    error = HTTPException(status_code=504, detail="AI service timed out.")
+                    continue
+                except Exception as e:
+                    error = self._failed(provider, e)
+                    if error.status_code < 500:
+                        raise error
+                    continue
+
+                metrics.first_chunk_ms.observe((time.perf_counter() - started) * 1000)
+                yield first
+                try:
+                    async for delta in chunks:
+                        yield delta
+                except Exception as e:
+                    raise self._failed(provider, e)
+                metrics.observe(time.perf_counter() - started)
+                return
+            finally:
+                await chunks.aclose()
+        raise error
+
+    def _failed(self, provider, error: Exception) -> HTTPException:
+        """Counts a provider error and returns it as an HTTPException."""
+        self.metrics[provider.name].errors += 1
+        if isinstance(error, HTTPException):
+            return error
+        print(f"Error calling AI provider {provider.name}: {error}")
+        return HTTPException(status_code=500, detail=f"AI processing error: {str(error)}")
+
+    async def _attempt(self, provider, prompt: str) -> str:
+        started = time.perf_counter()
+        try:
+            response = await provider.generate(prompt)
+        except asyncio.CancelledError:
+            self.metrics[provider.name].cancelled += 1  # lost a hedge race
+            raise
+        except Exception as e:
+            raise self._failed(provider, e)
+        self.metrics[provider.name].observe(time.perf_counter() - started, response)
+        return response.text
+
+    async def _hedged(self, provider, prompt: str) -> str:
+        """One provider's answer, from the first of up to two attempts."""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        attempts = [asyncio.ensure_future(self._attempt(provider, prompt))]
+        second = None
+        hedged = False
+        error = None
+        try:
+            while attempts:
+                now = time.monotonic()
+                wait = deadline - now
+                if second is None and self.hedge_after > 0:
+                    wait = min(wait, started + self.hedge_after - now)
+                done, _ = await asyncio.wait(
+                    attempts, timeout=max(wait, 0), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    attempts.remove(task)
+                    if task.exception() is None:
+                        if hedged and task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+                    if error.status_code < 500:
+                        raise error
+
+                now = time.monotonic()
+                if now >= deadline:
+                    self.metrics[provider.name].timeouts += 1
+                    raise HTTPException(status_code=504, detail="AI service timed out.")
+                if second is not None:
+                    continue
+                if not attempts:
+                    self.retries += 1
+                elif self.hedge_after > 0 and now >= started + self.hedge_after:
+                    self.hedges += 1
+                    hedged = True
+                else:
+                    continue
+                second = asyncio.ensure_future(self._attempt(provider, prompt))
+                attempts.append(second)
+            raise error
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "providers": [provider.name for provider in self.providers],
+            "timeout_seconds": self.timeout,
+            "hedge_after_ms": self.hedge_after * 1000,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "retries": self.retries,
+            "fallbacks": self.fallbacks,
+            "by_provider": {
+                name: metrics.stats() for name, metrics in self.metrics.items()
+            },
+        }
+
+
+def create_provider(spec: str):
+    """A provider from ``name[:model]``: ``gemini[:model]`` or ``stub``."""
+    name, _, model_name = spec.strip().partition(":")
+    if name == "gemini":
+        return GeminiProvider(model_name or AI_MODEL)
+    if name == "stub":
+        from .ai_stub import StubProvider
+
+        return StubProvider()
+    raise RuntimeError(f"Unknown AI provider in AI_PROVIDERS: {spec!r}")
+
+
+def create_ai_client(providers: str | None = AI_PROVIDERS) -> AIClient:
+    if not providers:
+        providers = "stub" if AI_MODEL == "stub" else f"gemini:{AI_MODEL}"
+    return AIClient([create_provider(spec) for spec in providers.split(",") if spec.strip()])
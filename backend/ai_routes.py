@@ -1,14 +1,20 @@
-import os
-import google.generativeai as genai
-from fastapi import APIRouter, Depends, HTTPException, Body
-from pydantic import BaseModel
-from dotenv import load_dotenv
+import asyncio
+import json
+from contextlib import aclosing
+from fastapi import APIRouter, Depends, HTTPException, Body, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from sqlalchemy.orm import Session
 from .auth import (
     get_current_user,
 )  # Assuming you have a way to get the authenticated user
-
-# Load environment variables (specifically GEMINI_API_KEY)
-load_dotenv()
+from .ai_batch import batch_translation_prompt, pack_batches, parse_batch_response
+from .ai_cache import ai_cache, cache_key
+from .ai_limiter import ai_limiter
+from .ai_prompts import prompts
+from .ai_providers import create_ai_client
+from .chat import MESSAGE_PAGE_DEFAULT, MESSAGE_PAGE_MAX, get_messages
+from .database import get_db
 
 router = APIRouter(
     prefix="/ai",
@@ -16,26 +22,8 @@ router = APIRouter(
     dependencies=[Depends(get_current_user)],  # Protect AI endpoints
 )
 
-# Configure the Gemini client
-try:
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        print("Warning: GEMINI_API_KEY not found in environment variables.")
-        # Optionally raise an exception or handle appropriately
-        # raise ValueError("GEMINI_API_KEY not set")
-        genai.configure(
-            api_key="DUMMY_KEY_FOR_NOW"
-        )  # Avoid crashing if key missing during dev
-    else:
-        genai.configure(api_key=api_key)
-    # Initialize the model (consider making this configurable or choosing based on task)
-    # Using gemini-1.5-flash as a generally capable and fast model
-    model = genai.GenerativeModel("gemini-1.5-flash")
-    print("Gemini AI Model initialized successfully.")
-except Exception as e:
-    print(f"Error configuring Gemini AI: {e}")
-    # Handle initialization failure - maybe disable AI features?
-    model = None  # Set model to None if initialization fails
+# Shared client used by the AI routes; providers are set up on first use
+ai_client = create_ai_client()
 
 
 # --- Request Models ---
@@ -48,69 +36,341 @@ class TranslateInput(BaseModel):
     target_language: str = "English"  # Default target language
 
 
-# --- Helper for API Call ---
-async def generate_ai_response(prompt: str):
-    if not model:
-        raise HTTPException(status_code=503, detail="AI service is unavailable.")
-    if not os.getenv("GEMINI_API_KEY"):
-        raise HTTPException(
-            status_code=503, detail="AI service is not configured (missing API key)."
+class BatchTranslateMessage(BaseModel):
+    id: int
+    text: str
+
+
+class BatchTranslateInput(BaseModel):
+    """Either ``messages`` or a page of a conversation (as in ``/chat/messages``)."""
+
+    target_language: str  # Required: there is no supported default
+    messages: list[BatchTranslateMessage] | None = Field(
+        None, max_length=MESSAGE_PAGE_MAX
+    )
+    conversation_id: int | None = None
+    before_id: int | None = None
+    after_id: int | None = None
+    limit: int = Field(MESSAGE_PAGE_DEFAULT, ge=1, le=MESSAGE_PAGE_MAX)
+
+
+# --- Helpers for API Calls ---
+def build_prompt(kind: str, text: str, target_language: str | None = None) -> str:
+    """The prompt for an AI task, from the template registry (see ai_prompts.py)."""
+    return prompts.render(kind, text, target_language)
+
+
+async def generate_ai_response(prompt: str) -> str:
+    return await ai_client.generate(prompt)
+
+
+async def cached_ai_response(
+    kind: str,
+    text: str,
+    prompt: str,
+    target_language: str | None = None,
+    user_id: int | None = None,
+) -> str:
+    """``generate_ai_response`` behind the response cache and call limiter.
+
+    Keyed by prompt kind, target language and normalized text, so asking
+    again for the same text costs no upstream call, and identical requests
+    arriving while one is in flight share its call.
+    """
+    key = cache_key(kind, text, target_language)
+    cached = await ai_cache.get(key)
+    if cached is not None:
+        return cached
+
+    async def fetch():
+        result = (await generate_ai_response(prompt)).strip()
+        await ai_cache.put(key, result)
+        return result
+
+    return await ai_limiter.run(key, user_id, fetch)
+
+
+async def translate_messages(
+    messages: list[tuple[int, str]],
+    target_language: str,
+    user_id: int | None = None,
+) -> dict:
+    """Translates ``(id, text)`` pairs; returns ``{id: translation}``.
+
+    Cached translations are reused and identical texts translated once. The
+    rest is packed into size-bounded prompts that each translate many
+    messages and run concurrently (within the call limits). Messages missing
+    from a batched response are translated on their own.
+
+    Only translations of a single text are cached (shared with
+    ``/ai/translate``): in a multi-message prompt one message's text can
+    steer the translations of the others, which must not reach other users.
+    """
+    prompts.language(target_language)  # 400 if unsupported, before any work
+    target_lang = target_language.lower()
+
+    results = {}
+    pending = {}  # cache key -> (text, ids sharing it)
+    for message_id, text in messages:
+        if not text or not text.strip():
+            continue
+        key = cache_key("translate", text, target_lang)
+        if key in pending:
+            pending[key][1].append(message_id)
+            continue
+        cached = await ai_cache.get(key)
+        if cached is not None:
+            results[message_id] = cached
+        else:
+            pending[key] = (text, [message_id])
+
+    keys = list(pending)
+    items = [(n, pending[key][0]) for n, key in enumerate(keys)]
+
+    async def translate_batch(batch):
+        prompt = batch_translation_prompt(batch, target_lang)
+        batch_key = cache_key("translate-batch", prompt, target_lang)
+        response = await ai_limiter.run(
+            batch_key, user_id, lambda: generate_ai_response(prompt)
         )
+        translated = parse_batch_response(response, [n for n, _ in batch])
+        for n, text in batch:
+            if n in translated:
+                if len(batch) == 1:
+                    await ai_cache.put(keys[n], translated[n])
+            else:
+                translated[n] = await cached_ai_response(
+                    "translate",
+                    text,
+                    build_prompt("translate", text, target_lang),
+                    target_lang,
+                    user_id=user_id,
+                )
+        return translated
+
+    batch_results = await asyncio.gather(
+        *(translate_batch(batch) for batch in pack_batches(items))
+    )
+    for translated in batch_results:
+        for n, translation in translated.items():
+            for message_id in pending[keys[n]][1]:
+                results[message_id] = translation
+    return results
+
+
+async def translate_conversation(
+    db: Session,
+    conversation_id: int,
+    user,
+    target_language: str,
+    before_id: int | None = None,
+    after_id: int | None = None,
+    limit: int = MESSAGE_PAGE_DEFAULT,
+) -> list[dict]:
+    """A page of ``chat.get_messages`` with each message's ``translation``.
 
+    Deleted messages are not translated (their ``translation`` is None).
+    """
+    page = await asyncio.to_thread(
+        get_messages, conversation_id, before_id, after_id, limit, user, db
+    )
+    translations = await translate_messages(
+        [(m["id"], m["content"]) for m in page if not m["is_deleted"]],
+        target_language,
+        user_id=user.id,
+    )
+    for message in page:
+        message["translation"] = translations.get(message["id"])
+    return page
+
+
+async def stream_cached_ai_response(
+    kind: str,
+    text: str,
+    target_language: str | None = None,
+    user_id: int | None = None,
+):
+    """Streaming ``cached_ai_response``: yields the response in chunks.
+
+    A cached response arrives as a single chunk; a streamed one holds an AI
+    call slot (not shared with identical requests) and is cached once
+    complete. Closing the generator, e.g. when the client goes away, stops
+    the upstream stream and frees the slot.
+    """
+    prompt = build_prompt(kind, text, target_language)
+    key = cache_key(kind, text, target_language)
+    cached = await ai_cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    parts = []
+    async with ai_limiter.slot(user_id), aclosing(ai_client.stream(prompt)) as chunks:
+        async for delta in chunks:
+            parts.append(delta)
+            yield delta
+    await ai_cache.put(key, "".join(parts).strip())
+
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def streaming_ai_response(request: Request, chunks) -> StreamingResponse:
+    """Server-sent events for ``chunks``: ``delta`` events, then ``done``.
+
+    The first chunk is awaited before responding, so errors up to then
+    (busy, bad request) still get their HTTP status; later ones are sent as
+    an ``error`` event.
+    """
     try:
-        # Use generate_content for potentially simpler API usage
-        response = await model.generate_content_async(prompt)
-        # Accessing the text part safely
-        if response.parts:
-            return response.text
-        else:
-            # Handle cases where the response might be blocked or empty
-            # Check response.prompt_feedback for safety ratings if needed
-            print(
-                f"Gemini response was empty or blocked. Feedback: {response.prompt_feedback}"
-            )
-            raise HTTPException(
-                status_code=500, detail="AI failed to generate a response."
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def events():
+        parts = []
+        try:
+            if first is not None:
+                parts.append(first)
+                yield _sse_event("delta", {"delta": first})
+                async for delta in chunks:
+                    if await request.is_disconnected():
+                        return
+                    parts.append(delta)
+                    yield _sse_event("delta", {"delta": delta})
+            yield _sse_event("done", {"result": "".join(parts).strip()})
+        except HTTPException as e:
+            yield _sse_event("error", {"status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            # The 200 is already sent; end the stream with an error event
+            print(f"Error streaming AI response: {e}")
+            yield _sse_event(
+                "error", {"status": 500, "detail": "AI failed to generate a response."}
             )
+        finally:
+            await chunks.aclose()
 
-    except Exception as e:
-        print(f"Error calling Gemini API: {e}")
-        # More specific error handling could be added here based on google.api_core.exceptions
-        raise HTTPException(status_code=500, detail=f"AI processing error: {str(e)}")
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # --- API Endpoints ---
 
 
 @router.post("/fix-grammar")
-async def fix_grammar(input_data: TextInput = Body(...)):
+async def fix_grammar(
+    input_data: TextInput = Body(...), user=Depends(get_current_user)
+):
     """Fixes grammar mistakes in the provided text."""
-    prompt = f'Correct the grammar and spelling of the following text, only return the corrected text:\n\n"{input_data.text}"'
-    corrected_text = await generate_ai_response(prompt)
-    return {"result": corrected_text.strip()}
+    prompt = build_prompt("fix-grammar", input_data.text)
+    corrected_text = await cached_ai_response(
+        "fix-grammar", input_data.text, prompt, user_id=user.id
+    )
+    return {"result": corrected_text}
 
 
 @router.post("/complete-sentence")
-async def complete_sentence(input_data: TextInput = Body(...)):
+async def complete_sentence(
+    input_data: TextInput = Body(...), user=Depends(get_current_user)
+):
     """Completes the sentence or phrase provided."""
-    # Simple prompt, might need refinement for better results
-    prompt_v2 = f'Complete the following text naturally, returning the full completed text:\n\n"{input_data.text}"'
-    full_completed_text = await generate_ai_response(prompt_v2)
-    return {"result": full_completed_text.strip()}
+    prompt_v2 = build_prompt("complete-sentence", input_data.text)
+    full_completed_text = await cached_ai_response(
+        "complete-sentence", input_data.text, prompt_v2, user_id=user.id
+    )
+    return {"result": full_completed_text}
 
 
 @router.post("/translate")
-async def translate_text(input_data: TranslateInput = Body(...)):
+async def translate_text(
+    input_data: TranslateInput = Body(...), user=Depends(get_current_user)
+):
     """Translates the provided text to the target language."""
     target_lang = input_data.target_language.lower()
-    
-    # Create appropriate prompt based on target language
-    if target_lang == "russian":
-        prompt = f'Translate the following text to Russian and only return the translated text:\n\n"{input_data.text}"'
-    elif target_lang == "german":
-        prompt = f'Translate the following text to German and only return the translated text:\n\n"{input_data.text}"'
+    prompt = build_prompt("translate", input_data.text, target_lang)
+    translated_text = await cached_ai_response(
+        "translate", input_data.text, prompt, target_lang, user_id=user.id
+    )
+    return {"result": translated_text}
+
+
+@router.post("/translate/batch")
+async def translate_batch(
+    input_data: BatchTranslateInput = Body(...),
+    user=Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Translates many messages, or a page of a conversation, at once."""
+    if (input_data.messages is None) == (input_data.conversation_id is None):
+        raise HTTPException(
+            status_code=400, detail="Provide either messages or conversation_id"
+        )
+
+    if input_data.conversation_id is not None:
+        page = await translate_conversation(
+            db,
+            input_data.conversation_id,
+            user,
+            input_data.target_language,
+            before_id=input_data.before_id,
+            after_id=input_data.after_id,
+            limit=input_data.limit,
+        )
+        translations = [
+            {"id": message["id"], "result": message["translation"]}
+            for message in page
+        ]
     else:
-        raise HTTPException(status_code=400, detail="Unsupported target language. Supported languages: Russian, German")
-    
-    translated_text = await generate_ai_response(prompt)
-    return {"result": translated_text.strip()}
+        results = await translate_messages(
+            [(message.id, message.text) for message in input_data.messages],
+            input_data.target_language,
+            user_id=user.id,
+        )
+        translations = [
+            {"id": message.id, "result": results.get(message.id)}
+            for message in input_data.messages
+        ]
+    return {"translations": translations}
+
+
+# --- Streaming variants (server-sent events) ---
+
+
+@router.post("/fix-grammar/stream")
+async def fix_grammar_stream(
+    request: Request, input_data: TextInput = Body(...), user=Depends(get_current_user)
+):
+    """Streams the grammar-corrected text as server-sent events."""
+    chunks = stream_cached_ai_response("fix-grammar", input_data.text, user_id=user.id)
+    return await streaming_ai_response(request, chunks)
+
+
+@router.post("/complete-sentence/stream")
+async def complete_sentence_stream(
+    request: Request, input_data: TextInput = Body(...), user=Depends(get_current_user)
+):
+    """Streams the completed text as server-sent events."""
+    chunks = stream_cached_ai_response(
+        "complete-sentence", input_data.text, user_id=user.id
+    )
+    return await streaming_ai_response(request, chunks)
+
+
+@router.post("/translate/stream")
+async def translate_text_stream(
+    request: Request,
+    input_data: TranslateInput = Body(...),
+    user=Depends(get_current_user),
+):
+    """Streams the translation as server-sent events."""
+    chunks = stream_cached_ai_response(
+        "translate",
+        input_data.text,
+        input_data.target_language.lower(),
+        user_id=user.id,
+    )
+    return await streaming_ai_response(request, chunks)
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import random
+from fastapi import HTTPException
+from .ai_providers import AIResponse
+
+# Simulated upstream latency of the stub provider: a fixed part plus a random
+# extra averaging AI_STUB_JITTER_MS (exponential: a long tail, like real
+# upstream latency), and the share of calls that fail
+AI_STUB_LATENCY_MS = int(os.getenv("AI_STUB_LATENCY_MS", "200"))
+AI_STUB_JITTER_MS = int(os.getenv("AI_STUB_JITTER_MS", "0"))
+AI_STUB_FAILURE_RATE = float(os.getenv("AI_STUB_FAILURE_RATE", "0"))
+AI_STUB_SEED = int(os.getenv("AI_STUB_SEED", "0"))
+
+
+class StubProvider:
+    """Offline stand-in for the Gemini provider (``AI_PROVIDERS=stub``).
+
+    Answers every prompt by echoing the quoted text it ends with, so load
+    tests and local development never hit the network. Latency jitter and
+    failures are drawn from a seeded generator: the same sequence of calls
+    always behaves the same way.
+    """
+
+    name = "stub"
+
+    def __init__(
+        self,
+        latency: float = AI_STUB_LATENCY_MS / 1000,
+        jitter: float = AI_STUB_JITTER_MS / 1000,
+        failure_rate: float = AI_STUB_FAILURE_RATE,
+        seed: int = AI_STUB_SEED,
+        name: str | None = None,
+    ):
+        if name:
+            self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.active = 0
+        self.peak = 0
+
+    def answer(self, prompt: str) -> str:
+        text = prompt.rsplit("\n\n", 1)[-1].strip().strip('"')
+        return f"[stub] {text}"
+
+    def _next_call(self):
+        """Delay and outcome of the next call."""
+        self.calls += 1
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.expovariate(1 / self.jitter)
+        return delay, self._random.random() < self.failure_rate
+
+    async def generate(self, prompt: str) -> AIResponse:
+        delay, fails = self._next_call()
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.active -= 1
+        if fails:
+            raise HTTPException(status_code=500, detail="AI processing error: stub failure")
+        text = self.answer(prompt)
+        return AIResponse(text, len(prompt.split()), len(text.split()))
+
+    async def stream(self, prompt: str):
+        """Yields the answer one word at a time, spread over the call's delay."""
+        delay, fails = self._next_call()
+        if fails:
+            await asyncio.sleep(delay)
+            raise HTTPException(status_code=500, detail="AI processing error: stub failure")
+        words = self.answer(prompt).split(" ")
+        for n, word in enumerate(words):
+            await asyncio.sleep(delay / len(words))
+            yield word if n == 0 else " " + word
@@ -1,12 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from .database import get_db
 from .models import User, ConversationParticipant, Message
 from .schemas import UserCreate, UserLogin, Token
+from .admin_metrics import admin_metrics
+from .user_search import USER_SEARCH_DEFAULT, USER_SEARCH_MAX, find_users
+from .ws_manager import REDIS_URL
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import anyio
+import asyncio
+import os
+import threading
+import time
 
 router = APIRouter(prefix="/auth")
 
@@ -14,7 +25,27 @@ SECRET_KEY = "your_secret_key"  # Replace with a secure key
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Validated tokens are remembered this long before the user row is re-read
+AUTH_CACHE_TTL_SECONDS = 60
+AUTH_CACHE_MAX_ENTRIES = 10_000
+
+# bcrypt cost factor; hashes with any other cost are upgraded on next sign-in
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Dedicated hashing threads and how many hash jobs may wait before we shed load
+PASSWORD_HASH_WORKERS = int(
+    os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1))
+)
+PASSWORD_HASH_MAX_PENDING = int(
+    os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 16))
+)
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
 
 
 def verify_password(plain_password, hashed_password):
@@ -25,6 +56,76 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+class PasswordHasher:
+    """Runs bcrypt on a dedicated, size-limited thread pool.
+
+    bcrypt releases the GIL, so the pool uses every core without blocking the
+    event loop, and its size rather than FastAPI's threadpool bounds how many
+    hashes run at once. Sync routes call it with ``anyio.from_thread.run``.
+    Once ``max_pending`` jobs are queued or running, new ones are rejected
+    with a 503 and a Retry-After hint instead of piling up behind a login
+    storm.
+    """
+
+    def __init__(self, context: CryptContext, max_workers: int, max_pending: int):
+        self.context = context
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = 0  # only touched from the event loop thread
+        self.rejected = 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="bcrypt"
+            )
+        return self._executor
+
+    async def _run(self, fn, *args):
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Authentication service is busy, please retry shortly.",
+                headers={"Retry-After": "1"},
+            )
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str):
+        """Returns ``(is_valid, new_hash)``; ``new_hash`` is set when the stored
+        hash uses an outdated cost factor and should be replaced."""
+        return await self._run(
+            self.context.verify_and_update, password, hashed_password
+        )
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(
+    pwd_context, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING
+)
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
@@ -33,10 +134,204 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
+@dataclass(frozen=True)
+class CachedUser:
+    """The fields of User that authenticated routes read, detached from any session."""
+
+    id: int
+    username: str
+    is_admin: bool
+    is_super_admin: bool
+
+    @classmethod
+    def from_user(cls, user: User) -> "CachedUser":
+        return cls(
+            id=user.id,
+            username=user.username,
+            is_admin=bool(user.is_admin),
+            is_super_admin=bool(user.is_super_admin),
+        )
+
+
+class TokenUserCache:
+    """Bounded LRU of validated token -> CachedUser with a per-entry TTL.
+
+    An entry never outlives its token's ``exp`` claim. Entries are indexed by
+    user id so changes to a user (e.g. admin flags) can drop every cached
+    token of that user at once.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # token -> (expires_at, CachedUser)
+        self._tokens_by_user = {}  # user id -> set of tokens
+        # get_current_user is sync, so FastAPI calls it from its threadpool
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, token: str):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, user = entry
+            if expires_at <= time.monotonic():
+                self._discard(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return user
+
+    def put(self, token: str, user: CachedUser, token_exp=None) -> None:
+        now = time.monotonic()
+        expires_at = now + self.ttl_seconds
+        if token_exp is not None:
+            expires_at = min(expires_at, now + (token_exp - time.time()))
+        with self._lock:
+            self._discard(token)
+            self._entries[token] = (expires_at, user)
+            self._tokens_by_user.setdefault(user.id, set()).add(token)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._discard(token)
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def _discard(self, token: str) -> None:
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        tokens = self._tokens_by_user.get(entry[1].id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[entry[1].id]
+
+
+user_cache = TokenUserCache(AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL_SECONDS)
+
+
+class UserCacheInvalidator:
+    """Drops a user's cached tokens on every worker, not just this one.
+
+    With ``REDIS_URL`` set, invalidations are published on a Redis channel
+    every worker listens to (``shared`` is True). Without it they only reach
+    this process: other workers, if any, may serve the old flags for up to
+    ``AUTH_CACHE_TTL_SECONDS``, so the admin routes re-read them from the
+    database instead (see ``get_current_user_flags``).
+    """
+
+    def __init__(
+        self,
+        cache: TokenUserCache,
+        redis_url: str | None,
+        channel: str = "talkflow:auth:invalidate",
+    ):
+        self.cache = cache
+        self.redis_url = redis_url
+        self.channel = channel
+        self.redis = None
+        self._task = None
+        self.published = 0
+        self.received = 0
+
+    @property
+    def shared(self) -> bool:
+        return self.redis_url is not None
+
+    async def start(self) -> None:
+        if not self.shared or self._task is not None:
+            return
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError(
+                "REDIS_URL is set but the 'redis' package is not installed"
+            ) from e
+        self.redis = redis_asyncio.from_url(self.redis_url)
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
+
+    async def invalidate_user(self, user_id: int) -> None:
+        self.cache.invalidate_user(user_id)
+        if self.redis is not None:
+            await self.redis.publish(self.channel, user_id)
+            self.published += 1
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    # Invalidations sent while we weren't subscribed are lost
+                    self.cache.clear()
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.received += 1
+                            self.cache.invalidate_user(int(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error receiving auth cache invalidations: {e}")
+                await asyncio.sleep(1)
+
+    def stats(self) -> dict:
+        return {
+            "shared": self.shared,
+            "published": self.published,
+            "received": self.received,
+        }
+
+
+# Shared invalidator used when a user's flags change
+user_cache_invalidator = UserCacheInvalidator(user_cache, REDIS_URL)
+
+
 def get_current_user(
     token: str = Depends(OAuth2PasswordBearer(tokenUrl="/auth/signin")),
     db: Session = Depends(get_db),
 ):
+    cached = user_cache.get(token)
+    if cached is not None:
+        return cached
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -47,19 +342,42 @@ def get_current_user(
     user = db.query(User).filter(User.username == username).first()
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
-    return user
 
+    cached = CachedUser.from_user(user)
+    user_cache.put(token, cached, payload.get("exp"))
+    return cached
 
+
+def get_current_user_flags(
+    current_user: CachedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """``get_current_user`` with admin flags that can be trusted on any worker.
+
+    Without a shared invalidation channel the cached flags may be up to
+    ``AUTH_CACHE_TTL_SECONDS`` old on other workers, so they are re-read.
+    """
+    if user_cache_invalidator.shared:
+        return current_user
+    user = db.get(User, current_user.id)
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return CachedUser.from_user(user)
+
+
+# signup and signin are sync so their Session work runs in FastAPI's
+# threadpool; bcrypt is handed to the hashing pool on the event loop
 @router.post("/signup", response_model=Token)
 def signup(user: UserCreate, db: Session = Depends(get_db)):
     db_user = db.query(User).filter(User.username == user.username).first()
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    hashed_password = get_password_hash(user.password)
+    hashed_password = anyio.from_thread.run(password_hasher.hash, user.password)
     new_user = User(username=user.username, hashed_password=hashed_password)
     db.add(new_user)
     db.commit()
     db.refresh(new_user)
+    admin_metrics.user_created(new_user.created_at)
     access_token = create_access_token(data={"sub": new_user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -67,8 +385,17 @@ def signup(user: UserCreate, db: Session = Depends(get_db)):
 @router.post("/signin", response_model=Token)
 def signin(user: UserLogin, db: Session = Depends(get_db)):
     db_user = db.query(User).filter(User.username == user.username).first()
-    if not db_user or not verify_password(user.password, db_user.hashed_password):
+    if not db_user:
+        raise HTTPException(status_code=400, detail="Incorrect username or password")
+    is_valid, new_hash = anyio.from_thread.run(
+        password_hasher.verify_and_update, user.password, db_user.hashed_password
+    )
+    if not is_valid:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
+    if new_hash:
+        # Stored hash used an outdated cost factor, upgrade it transparently
+        db_user.hashed_password = new_hash
+        db.commit()
     access_token = create_access_token(data={"sub": db_user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -110,16 +437,20 @@ def get_user_by_id(
 
 @router.get("/users/search")
 def search_users(
-    query: str,
+    query: str = Query(..., max_length=100),
+    limit: int = Query(USER_SEARCH_DEFAULT, ge=1, le=USER_SEARCH_MAX),
+    cursor: str | None = Query(None, description="next_cursor of the previous page"),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
+    """Users whose username starts with ``query`` (any case), best matches first.
+
+    Exact matches come first, then people the caller chats with (most recent
+    first), then everyone else alphabetically; see user_search.py.
+    """
     if not query:
         raise HTTPException(status_code=400, detail="Query parameter is required")
-    users = db.query(User).filter(User.username.ilike(f"{query}%")).all()
-    if not users:
-        return []  # Return empty list instead of raising an error
-    return [{"id": user.id, "username": user.username} for user in users]
+    return find_users(db, current_user.id, query, limit, cursor)
 
 
 @router.get("/profile/{user_id}")
@@ -0,0 +1,1744 @@
+"""Micro-benchmarks for TalkFlow hot paths.
+
+Each benchmark seeds a throwaway SQLite database, so it never touches
+talkflowchat.db. Run from the repository root, e.g.:
+
+    python -m backend.benchmark conversations
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, text
+from sqlalchemy.orm import sessionmaker
+
+from .conversation_summaries import rebuild_summaries
+from .database import Base, create_async_db_engine, create_db_engine
+from .models import Conversation, ConversationParticipant, Message, User
+
+
+# --- Helpers ---
+def make_session_factory(path: str, profile: str | None = None):
+    """Creates a fresh schema in ``path`` and returns a bound sessionmaker."""
+    if profile is None:
+        engine = create_db_engine(f"sqlite:///{path}")
+    else:
+        engine = create_db_engine(f"sqlite:///{path}", profile)
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def time_call(fn, repeat: int) -> list[float]:
+    """Runs ``fn`` ``repeat`` times and returns the latencies in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(label: str, samples: list[float]) -> None:
+    ordered = sorted(samples)
+    print(
+        f"{label:<40} median {statistics.median(ordered):8.2f} ms"
+        f"   p95 {percentile(ordered, 0.95):8.2f} ms"
+        f"   p99 {percentile(ordered, 0.99):8.2f} ms   n={len(ordered)}"
+    )
+
+
+def seed_conversations(
+    db, conversation_count: int, messages_per_conversation: int
+) -> int:
+    """Seeds one user with ``conversation_count`` 1-on-1 chats; returns its id."""
+    db.execute(
+        insert(User),
+        [
+            {"id": i, "username": f"user{i}", "hashed_password": "x"}
+            for i in range(1, conversation_count + 2)
+        ],
+    )
+    db.execute(
+        insert(Conversation),
+        [{"id": i} for i in range(1, conversation_count + 1)],
+    )
+    participants = []
+    for conversation_id in range(1, conversation_count + 1):
+        participants.append({"conversation_id": conversation_id, "user_id": 1})
+        participants.append(
+            {"conversation_id": conversation_id, "user_id": conversation_id + 1}
+        )
+    db.execute(insert(ConversationParticipant), participants)
+
+    start = datetime.utcnow() - timedelta(days=30)
+    messages = []
+    for conversation_id in range(1, conversation_count + 1):
+        for n in range(messages_per_conversation):
+            messages.append(
+                {
+                    "conversation_id": conversation_id,
+                    "sender_id": 1 if n % 2 else conversation_id + 1,
+                    "content": f"message {n} in {conversation_id}",
+                    "timestamp": start + timedelta(minutes=conversation_id * 7 + n),
+                    "is_deleted": False,
+                }
+            )
+    db.execute(insert(Message), messages)
+    db.commit()
+    rebuild_summaries(db)
+    return 1
+
+
+# --- Benchmarks ---
+def bench_ai_cache(args) -> None:
+    """AI response cache: lookup cost per tier and upstream calls saved.
+
+    The Gemini call is replaced by a stub that sleeps ``--ai-latency`` ms.
+    ``--requests`` translate requests are spread over 50 distinct texts
+    (with stray whitespace, as users send them) and run through the route
+    helper with and without the cache.
+    """
+    import asyncio
+    from . import ai_routes
+    from .ai_cache import AIResponseCache, SQLiteResponseStore, cache_key
+
+    texts = [f"Message number {n} in the group chat" for n in range(50)]
+    upstream_calls = 0
+
+    async def stub_generate(prompt):
+        nonlocal upstream_calls
+        upstream_calls += 1
+        await asyncio.sleep(args.ai_latency / 1000)
+        return f"translated: {prompt}\n"
+
+    async def lookups(cache, keys):
+        started = time.perf_counter()
+        for key in keys:
+            assert await cache.get(key) is not None
+        return (time.perf_counter() - started) / len(keys) * 1e6
+
+    async def run(db_path):
+        nonlocal upstream_calls
+        store = SQLiteResponseStore(db_path)
+        cache = AIResponseCache(store=store)
+        keys = [cache_key("translate", text, "german") for text in texts]
+        for key, text in zip(keys, texts):
+            await cache.put(key, text)
+        print(f"{'memory hit':<40} {await lookups(cache, keys * 20):8.1f} us/lookup")
+        cold = AIResponseCache(store=store)
+        print(f"{'SQLite tier hit':<40} {await lookups(cold, keys):8.1f} us/lookup")
+
+        requests = [
+            ("  " * (n % 3)) + texts[n % len(texts)] + (" " * (n % 2))
+            for n in range(args.requests)
+        ]
+        original = ai_routes.generate_ai_response, ai_routes.ai_cache
+        ai_routes.generate_ai_response = stub_generate
+        try:
+            for label, use_cache in (("no cache", False), ("cache", True)):
+                ai_routes.ai_cache = AIResponseCache()
+                upstream_calls = 0
+                started = time.perf_counter()
+                for text in requests:
+                    if use_cache:
+                        await ai_routes.cached_ai_response(
+                            "translate", text, f"Translate: {text}", "german"
+                        )
+                    else:
+                        await stub_generate(f"Translate: {text}")
+                elapsed = time.perf_counter() - started
+                print(
+                    f"{label:<40} {upstream_calls:5d} upstream calls for "
+                    f"{len(requests)} requests in {elapsed:.2f}s"
+                )
+        finally:
+            ai_routes.generate_ai_response, ai_routes.ai_cache = original
+
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(os.path.join(tmp, "ai_cache.db")))
+
+
+def bench_ai_limits(args) -> None:
+    """Single-flight and concurrency limits under a burst of AI requests.
+
+    ``--requests`` translate requests from ``--readers`` users over 20
+    distinct texts arrive at once (a popular group message everyone
+    translates), against the stub model (``--ai-latency`` ms). Compares
+    calling the model directly with the route helper (cache + limiter):
+    upstream calls, peak upstream concurrency and 429 rejections.
+    """
+    import asyncio
+    from fastapi import HTTPException
+    from . import ai_routes
+    from .ai_cache import AIResponseCache
+    from .ai_limiter import AICallLimiter
+    from .ai_providers import AIClient
+    from .ai_stub import StubProvider
+
+    texts = [f"Popular message {n}" for n in range(20)]
+    requests = [
+        (n % args.readers, texts[n % len(texts)]) for n in range(args.requests)
+    ]
+
+    async def direct(user_id, text):
+        response = await provider.generate(f"Translate\n\n{text}")
+        return response.text
+
+    async def limited(user_id, text):
+        return await ai_routes.cached_ai_response(
+            "translate", text, f"Translate\n\n{text}", "german", user_id=user_id
+        )
+
+    async def run(label, handler):
+        nonlocal provider
+        provider = StubProvider(args.ai_latency / 1000)
+        ai_routes.ai_client = AIClient([provider], hedge_after=0)
+        ai_routes.ai_cache = AIResponseCache()
+        ai_routes.ai_limiter = AICallLimiter()
+        rejected = 0
+
+        async def one(user_id, text):
+            nonlocal rejected
+            try:
+                await handler(user_id, text)
+            except HTTPException as e:
+                if e.status_code != 429:
+                    raise
+                rejected += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(user_id, text) for user_id, text in requests))
+        elapsed = time.perf_counter() - started
+        print(
+            f"{label:<22} {provider.calls:5d} upstream calls, "
+            f"peak concurrency {provider.peak:3d}, {rejected} rejected, "
+            f"{elapsed:.2f}s"
+        )
+
+    provider = None
+    original = ai_routes.ai_client, ai_routes.ai_cache, ai_routes.ai_limiter
+    try:
+        asyncio.run(run("direct model calls", direct))
+        asyncio.run(run("cache + limiter", limited))
+    finally:
+        ai_routes.ai_client, ai_routes.ai_cache, ai_routes.ai_limiter = original
+
+
+def bench_ai_batch(args) -> None:
+    """Translating a page of 200 messages, one call per message vs batched.
+
+    The messages (a fifth of them repeated, like "ok" or "thanks") are
+    translated through ``/ai/translate``'s helper one by one, then with
+    ``translate_messages``, against the stub model (``--ai-latency`` ms);
+    the batched run is repeated with the cache the one-by-one run filled
+    (batched translations aren't cached). The one-by-one run gets a queue
+    long enough for all of them, instead of mostly 429s and 503s.
+    """
+    import asyncio
+    from . import ai_routes
+    from .ai_cache import AIResponseCache
+    from .ai_limiter import AICallLimiter
+    from .ai_providers import AIClient
+    from .ai_stub import StubProvider
+
+    messages = [
+        (n, f"Message number {n} of the conversation" if n % 5 else "ok thanks")
+        for n in range(200)
+    ]
+
+    async def one_by_one():
+        await asyncio.gather(
+            *(
+                ai_routes.cached_ai_response(
+                    "translate",
+                    text,
+                    ai_routes.build_prompt("translate", text, "german"),
+                    "german",
+                    user_id=1,
+                )
+                for _, text in messages
+            )
+        )
+
+    async def batched():
+        translations = await ai_routes.translate_messages(messages, "german", user_id=1)
+        assert len(translations) == len(messages)
+
+    async def run(label, handler, fresh=True):
+        if fresh:
+            ai_routes.ai_cache = AIResponseCache()
+        provider = StubProvider(args.ai_latency / 1000)
+        ai_routes.ai_client = AIClient([provider], hedge_after=0)
+        ai_routes.ai_limiter = AICallLimiter(max_queue=len(messages), queue_timeout=600)
+        started = time.perf_counter()
+        await handler()
+        elapsed = time.perf_counter() - started
+        print(
+            f"{label:<22} {provider.calls:4d} upstream calls, "
+            f"{elapsed * 1000:8.1f} ms"
+        )
+
+    original = ai_routes.ai_client, ai_routes.ai_cache, ai_routes.ai_limiter
+    try:
+        asyncio.run(run("batched", batched))
+        asyncio.run(run("one call per message", one_by_one))
+        asyncio.run(run("batched, cached", batched, fresh=False))
+    finally:
+        ai_routes.ai_client, ai_routes.ai_cache, ai_routes.ai_limiter = original
+
+
+def bench_ai_providers(args) -> None:
+    """Hedged retries and provider fallback against a long-tailed, flaky stub.
+
+    ``--requests`` calls go to stub providers answering in ``--ai-latency``
+    ms plus an exponential extra of 4x that on average, some failing.
+    Client-side latency percentiles, errors and upstream calls are compared
+    without hedging, with hedging at about the stub's p90 (10x the base
+    latency), and with a second provider to fall back to.
+    """
+    import asyncio
+    from fastapi import HTTPException
+    from .ai_providers import AIClient
+    from .ai_stub import StubProvider
+
+    latency = args.ai_latency / 1000
+
+    def stub(name, failure_rate, seed):
+        return StubProvider(
+            latency, 4 * latency, failure_rate=failure_rate, seed=seed, name=name
+        )
+
+    async def run(label, client):
+        latencies = []
+        errors = 0
+
+        async def one(n):
+            nonlocal errors
+            started = time.perf_counter()
+            try:
+                await client.generate(f"Translate\n\nmessage {n}")
+            except HTTPException:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+        await asyncio.gather(*(one(n) for n in range(args.requests)))
+        latencies.sort()
+        p = lambda q: latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+        calls = sum(provider.calls for provider in client.providers)
+        print(
+            f"{label:<34} p50 {p(0.5):6.0f} ms  p95 {p(0.95):6.0f} ms  "
+            f"p99 {p(0.99):6.0f} ms  {errors:3d} errors  {calls:4d} upstream calls"
+        )
+
+    for failure_rate in (0.0, 0.1):
+        print(f"--- {failure_rate:.0%} of calls fail")
+        asyncio.run(
+            run("no hedging", AIClient([stub("stub", failure_rate, 1)], hedge_after=0))
+        )
+        asyncio.run(
+            run(
+                "hedged at p90",
+                AIClient([stub("stub", failure_rate, 1)], hedge_after=10 * latency),
+            )
+        )
+        asyncio.run(
+            run(
+                "hedged, falling back to a 2nd stub",
+                AIClient(
+                    [stub("stub", failure_rate, 1), stub("fallback", failure_rate, 2)],
+                    hedge_after=10 * latency,
+                ),
+            )
+        )
+
+
+def bench_conversations(args) -> None:
+    """Latency of the chat list for users with 10, 100 and 1,000 conversations."""
+    from .chat import build_conversation_list
+
+    for conversation_count in (10, 100, 1000):
+        with tempfile.TemporaryDirectory() as tmp:
+            Session = make_session_factory(os.path.join(tmp, "bench.db"))
+            db = Session()
+            try:
+                user_id = seed_conversations(
+                    db, conversation_count, args.messages_per_conversation
+                )
+                samples = time_call(
+                    lambda: build_conversation_list(db, user_id), args.repeat
+                )
+                report(f"conversation list ({conversation_count} convs)", samples)
+            finally:
+                db.close()
+
+
+def bench_history(args) -> None:
+    """Latency of opening a conversation with 50 vs 100,000 messages."""
+    from .chat import fetch_message_page
+
+    for message_count in (50, 100_000):
+        with tempfile.TemporaryDirectory() as tmp:
+            Session = make_session_factory(os.path.join(tmp, "bench.db"))
+            db = Session()
+            try:
+                seed_conversations(db, 1, message_count)
+                newest = time_call(lambda: fetch_message_page(db, 1), args.repeat)
+                report(f"newest page ({message_count} msgs)", newest)
+
+                oldest_id = fetch_message_page(db, 1)[0]["id"]
+                older = time_call(
+                    lambda: fetch_message_page(db, 1, before_id=oldest_id),
+                    args.repeat,
+                )
+                report(f"older page ({message_count} msgs)", older)
+            finally:
+                db.close()
+
+
+def bench_mark_read(args) -> None:
+    """Marking a group with 10,000 unread messages as read.
+
+    Compares the endpoint with both set-based strategies of
+    chat.mark_messages_read and with loading/mutating every Message object.
+    """
+    import asyncio
+    from types import SimpleNamespace
+    from .chat import mark_conversation_as_read, mark_messages_read
+
+    def orm_loop(db, reader_id):
+        now = datetime.utcnow()
+        for message in db.query(Message).filter(
+            Message.conversation_id == 1,
+            Message.sender_id != reader_id,
+            Message.read_at == None,
+        ):
+            message.read_at = now
+        db.commit()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Session = make_session_factory(os.path.join(tmp, "bench.db"))
+        db = Session()
+        try:
+            db.execute(
+                insert(User),
+                [
+                    {"id": i, "username": f"user{i}", "hashed_password": "x"}
+                    for i in (1, 2, 3)
+                ],
+            )
+            db.execute(insert(Conversation), [{"id": 1}])
+            db.execute(
+                insert(ConversationParticipant),
+                [{"conversation_id": 1, "user_id": i} for i in (1, 2, 3)],
+            )
+            start = datetime.utcnow() - timedelta(days=1)
+            db.execute(
+                insert(Message),
+                [
+                    {
+                        "conversation_id": 1,
+                        "sender_id": 2 + n % 2,
+                        "content": f"message {n}",
+                        "timestamp": start + timedelta(seconds=n),
+                        "is_deleted": False,
+                    }
+                    for n in range(args.unread)
+                ],
+            )
+            db.commit()
+            user = SimpleNamespace(id=1)
+
+            def run(label, fn):
+                samples = []
+                for _ in range(args.repeat):
+                    db.execute(text("UPDATE messages SET read_at = NULL"))
+                    db.commit()
+                    db.expire_all()
+                    started = time.perf_counter()
+                    fn()
+                    samples.append((time.perf_counter() - started) * 1000)
+                report(f"{label} ({args.unread} unread)", samples)
+
+            def set_based(returning):
+                mark_messages_read(db, 1, 1, datetime.utcnow(), returning=returning)
+                db.commit()
+
+            run(
+                "mark_read endpoint",
+                lambda: asyncio.run(mark_conversation_as_read(1, user=user, db=db)),
+            )
+            if db.get_bind().dialect.update_returning:
+                run("UPDATE ... RETURNING", lambda: set_based(True))
+            run("grouped + bounded UPDATE", lambda: set_based(False))
+            run("per-object ORM loop", lambda: orm_loop(db, 1))
+        finally:
+            db.close()
+
+
+def bench_search(args) -> None:
+    """Message search over ``--search-messages`` messages (default 1M).
+
+    Messages are 4-15 words drawn from a Zipf-distributed vocabulary of
+    20,000 words, spread Zipf-like over 2,000 conversations of 5 of 1,000
+    users. Reports the index build time and size, then search latency by
+    term frequency for a member of the busiest conversation, through the
+    FTS5 index and through the (unranked) ``LIKE`` scan of the user's
+    conversations it replaces, and the write cost of indexing.
+    """
+    import random
+    import sqlite3
+    from .message_search import index_messages, search_messages
+    from .migrate_db import SEARCH_REBUILD_STATEMENTS
+
+    rng = random.Random(42)
+    syllables = ["ka", "lo", "mi", "ne", "su", "ta", "ri", "po", "ve", "da", "zu", "gi"]
+    vocabulary = []
+    seen = set()
+    while len(vocabulary) < 20_000:
+        word = "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            vocabulary.append(word)
+
+    def zipf_weights(count):
+        cumulative = []
+        total = 0.0
+        for rank in range(1, count + 1):
+            total += 1 / rank
+            cumulative.append(total)
+        return cumulative
+
+    cumulative = zipf_weights(len(vocabulary))
+
+    def sentence():
+        return " ".join(rng.choices(vocabulary, cum_weights=cumulative, k=rng.randint(4, 15)))
+
+    user_count, conversation_count = 1000, 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "search.db")
+        Session = make_session_factory(path)
+        conn = sqlite3.connect(path)
+        conn.executemany(
+            "INSERT INTO users (id, username, hashed_password) VALUES (?, ?, 'x')",
+            [(n, f"user{n}") for n in range(1, user_count + 1)],
+        )
+        conn.executemany(
+            "INSERT INTO conversations (id, name) VALUES (?, ?)",
+            [(n, f"group {n}") for n in range(1, conversation_count + 1)],
+        )
+        members = {
+            n: rng.sample(range(1, user_count + 1), 5)
+            for n in range(1, conversation_count + 1)
+        }
+        conn.executemany(
+            "INSERT INTO conversation_participants (conversation_id, user_id) VALUES (?, ?)",
+            [(cid, uid) for cid, uids in members.items() for uid in uids],
+        )
+
+        started = time.perf_counter()
+        base = datetime(2024, 1, 1)
+        conversation_ids = list(range(1, conversation_count + 1))
+        conversation_weights = zipf_weights(conversation_count)
+        batch = []
+        for n in range(1, args.search_messages + 1):
+            (cid,) = rng.choices(conversation_ids, cum_weights=conversation_weights)
+            batch.append(
+                (
+                    n,
+                    cid,
+                    rng.choice(members[cid]),
+                    sentence(),
+                    (base + timedelta(seconds=n)).isoformat(" "),
+                )
+            )
+            if len(batch) == 50_000:
+                conn.executemany(
+                    "INSERT INTO messages (id, conversation_id, sender_id, content, "
+                    "timestamp, is_deleted) VALUES (?, ?, ?, ?, ?, 0)",
+                    batch,
+                )
+                batch = []
+        if batch:
+            conn.executemany(
+                "INSERT INTO messages (id, conversation_id, sender_id, content, "
+                "timestamp, is_deleted) VALUES (?, ?, ?, ?, ?, 0)",
+                batch,
+            )
+        conn.commit()
+        print(f"seeded {args.search_messages:,} messages in {time.perf_counter() - started:.1f}s")
+
+        size_before = os.path.getsize(path)
+        started = time.perf_counter()
+        for statement in SEARCH_REBUILD_STATEMENTS:
+            conn.execute(statement)
+        conn.commit()
+        conn.execute("VACUUM")
+        print(
+            f"built the index in {time.perf_counter() - started:.1f}s, "
+            f"database {size_before / 2**20:.0f} MB -> {os.path.getsize(path) / 2**20:.0f} MB"
+        )
+
+        user_id = members[1][0]
+        own = [cid for cid, uids in members.items() if user_id in uids]
+        visible = conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE conversation_id IN (%s)"
+            % ",".join(map(str, own))
+        ).fetchone()[0]
+        like_scan = text(
+            "SELECT id FROM messages WHERE conversation_id IN "
+            "(SELECT conversation_id FROM conversation_participants WHERE user_id = :uid) "
+            "AND NOT is_deleted AND content LIKE :pattern "
+            "ORDER BY timestamp DESC LIMIT 20"
+        )
+        queries = [
+            ("common word", vocabulary[4]),
+            ("medium word", vocabulary[300]),
+            ("rare word", vocabulary[15_000]),
+            ("two words", f"{vocabulary[20]} {vocabulary[60]}"),
+            ("prefix", vocabulary[300][:3]),
+        ]
+        db = Session()
+        try:
+            print(
+                f"user {user_id} is in {len(own)} conversations "
+                f"with {visible:,} messages"
+            )
+            for label, query in queries:
+                hits = len(search_messages(db, user_id, query, limit=20)["results"])
+                report(
+                    f"fts {label} ({hits} hits)",
+                    time_call(lambda: search_messages(db, user_id, query, limit=20), args.repeat),
+                )
+                report(
+                    f"fts {label}, one conversation",
+                    time_call(
+                        lambda: search_messages(db, user_id, query, conversation_id=own[-1]),
+                        args.repeat,
+                    ),
+                )
+                pattern = f"%{query.split()[0]}%"
+                report(
+                    f"LIKE scan {label}",
+                    time_call(
+                        lambda: db.execute(like_scan, {"uid": user_id, "pattern": pattern}).all(),
+                        max(args.repeat // 4, 1),
+                    ),
+                )
+            report(
+                "fts page 5 of a common word",
+                time_call(
+                    lambda: search_messages(db, user_id, vocabulary[4], limit=20, offset=80),
+                    args.repeat,
+                ),
+            )
+        finally:
+            db.close()
+
+        # Write cost: single-message transactions with and without indexing
+        async_engine = create_async_db_engine(f"sqlite+aiosqlite:///{path}")
+
+        async def write(indexed):
+            from sqlalchemy.ext.asyncio import async_sessionmaker
+
+            AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+            started = time.perf_counter()
+            for _ in range(500):
+                row = {
+                    "conversation_id": own[0],
+                    "sender_id": user_id,
+                    "content": sentence(),
+                    "timestamp": datetime.utcnow(),
+                    "is_deleted": False,
+                }
+                async with AsyncSession() as session:
+                    result = await session.execute(insert(Message).values(**row))
+                    row["id"] = result.inserted_primary_key[0]
+                    if indexed:
+                        await index_messages(session, [row])
+                    await session.commit()
+            return (time.perf_counter() - started) * 1000 / 500
+
+        import asyncio
+
+        plain = asyncio.run(write(False))
+        indexed = asyncio.run(write(True))
+        asyncio.run(async_engine.dispose())
+        print(f"message insert {plain:.3f} ms, with index update {indexed:.3f} ms")
+        conn.close()
+
+
+def bench_user_search(args) -> None:
+    """User type-ahead over ``--search-users`` users (default 1M).
+
+    Compares the former unbounded ``ILIKE 'prefix%'`` query with the ranked,
+    indexed prefix search (user_search.py) for prefixes of 1-4 characters
+    and an exact name, for a caller with 200 contacts in 40 conversations.
+    """
+    import random
+    import sqlite3
+    from .models import username_search_key
+    from .user_search import find_users
+
+    rng = random.Random(7)
+    syllables = ["ka", "lo", "mi", "ne", "su", "ta", "ri", "po", "ve", "da", "zu", "gi"]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "users.db")
+        Session = make_session_factory(path)
+        conn = sqlite3.connect(path)
+        started = time.perf_counter()
+        seen = set()
+        rows = []
+        for n in range(1, args.search_users + 1):
+            name = "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+            if rng.random() < 0.3:
+                name = name.capitalize()
+            if name.casefold() in seen:
+                name += str(n)
+            seen.add(name.casefold())
+            rows.append((n, name, username_search_key(name)))
+        conn.executemany(
+            "INSERT INTO users (id, username, username_key, hashed_password) "
+            "VALUES (?, ?, ?, 'x')",
+            rows,
+        )
+        user_id = 1
+        contacts = rng.sample(range(2, args.search_users + 1), 200)
+        conn.executemany(
+            "INSERT INTO conversations (id, name) VALUES (?, ?)",
+            [(n, f"group {n}") for n in range(1, 41)],
+        )
+        conn.executemany(
+            "INSERT INTO conversation_participants (conversation_id, user_id) VALUES (?, ?)",
+            [(n, user_id) for n in range(1, 41)]
+            + [(n % 40 + 1, uid) for n, uid in enumerate(contacts)],
+        )
+        conn.executemany(
+            "INSERT INTO conversation_summaries (conversation_id, last_message_at) "
+            "VALUES (?, ?)",
+            [
+                (n, (datetime(2024, 1, 1) + timedelta(hours=n)).isoformat(" "))
+                for n in range(1, 41)
+            ],
+        )
+        conn.execute("ANALYZE")
+        conn.commit()
+        conn.close()
+        print(f"seeded {args.search_users:,} users in {time.perf_counter() - started:.1f}s")
+
+        contact_name = rows[contacts[0] - 1][1]
+        queries = [
+            ("1 character", syllables[0][0]),
+            ("2 characters", syllables[1]),
+            ("3 characters", syllables[2] + syllables[3][0]),
+            ("4 characters, a contact's", contact_name[:4]),
+            ("exact name", rows[len(rows) // 2][1].upper()),
+        ]
+        db = Session()
+        try:
+            for label, query in queries:
+                matches = db.query(User).filter(User.username.ilike(f"{query}%")).count()
+                report(
+                    f"ILIKE {label} ({matches:,} rows)",
+                    time_call(
+                        lambda: db.query(User).filter(User.username.ilike(f"{query}%")).all(),
+                        max(args.repeat // 4, 1),
+                    ),
+                )
+                first = find_users(db, user_id, query, limit=10)
+                report(
+                    f"indexed {label}",
+                    time_call(lambda: find_users(db, user_id, query, limit=10), args.repeat),
+                )
+                if first["next_cursor"]:
+                    report(
+                        f"indexed {label}, page 2",
+                        time_call(
+                            lambda: find_users(
+                                db, user_id, query, limit=10, cursor=first["next_cursor"]
+                            ),
+                            args.repeat,
+                        ),
+                    )
+        finally:
+            db.close()
+
+
+def bench_admin_stats(args) -> None:
+    """Admin dashboard figures with ``--stats-messages`` messages (default 1M).
+
+    Messages are spread over the last 48 hours among 100,000 users. Compares
+    the six COUNT queries the dashboard used to run per page load with
+    reading the incremental counters (admin_metrics.py), and reports the
+    counters' one-off load after startup and their cost per stored message.
+    """
+    import asyncio
+    import sqlite3
+    from sqlalchemy import distinct, func
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    from .admin_metrics import AdminMetrics, SharedAdminMetrics
+
+    user_count = 100_000
+    now = datetime.utcnow()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stats.db")
+        Session = make_session_factory(path)
+        conn = sqlite3.connect(path)
+        started = time.perf_counter()
+        conn.executemany(
+            "INSERT INTO users (id, username, username_key, hashed_password, created_at) "
+            "VALUES (?, ?, ?, 'x', ?)",
+            [
+                (n, f"user{n}", f"user{n}", (now - timedelta(minutes=n)).isoformat(" "))
+                for n in range(1, user_count + 1)
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO conversations (id, name) VALUES (?, ?)",
+            [(n, f"group {n}") for n in range(1, 10_001)],
+        )
+        span = 48 * 60 * 60
+        for first in range(0, args.stats_messages, 50_000):
+            conn.executemany(
+                "INSERT INTO messages (conversation_id, sender_id, content, timestamp, "
+                "is_deleted) VALUES (?, ?, 'hello', ?, 0)",
+                [
+                    (
+                        n % 10_000 + 1,
+                        n * 7919 % user_count + 1,
+                        (now - timedelta(seconds=span * n / args.stats_messages)).isoformat(" "),
+                    )
+                    for n in range(first, min(first + 50_000, args.stats_messages))
+                ],
+            )
+        conn.commit()
+        conn.close()
+        print(f"seeded {args.stats_messages:,} messages in {time.perf_counter() - started:.1f}s")
+
+        db = Session()
+
+        def count_queries():
+            day_ago = datetime.utcnow() - timedelta(days=1)
+            return (
+                db.query(func.count(User.id)).scalar(),
+                db.query(func.count(Conversation.id)).scalar(),
+                db.query(func.count(Message.id)).scalar(),
+                db.query(func.count(distinct(Message.sender_id)))
+                .filter(Message.timestamp >= day_ago)
+                .scalar(),
+                db.query(func.count(User.id)).filter(User.created_at >= day_ago).scalar(),
+                db.query(func.count(Message.id)).filter(Message.timestamp >= day_ago).scalar(),
+            )
+
+        try:
+            expected = count_queries()
+            report("COUNT queries per page load", time_call(count_queries, max(args.repeat // 4, 1)))
+        finally:
+            db.close()
+
+        async_engine = create_async_db_engine(f"sqlite+aiosqlite:///{path}")
+        session_factory = async_sessionmaker(async_engine, expire_on_commit=False)
+        loop = asyncio.new_event_loop()
+        variants = [("counters", AdminMetrics(session_factory))]
+        try:
+            import fakeredis
+        except ImportError:
+            print("(skipping the Redis counters: pip install fakeredis)")
+        else:
+            redis = fakeredis.aioredis.FakeRedis()
+            # In-process fakeredis, so this is slower than a Redis server would be
+            variants.append(("redis counters", SharedAdminMetrics(session_factory, redis)))
+        for label, metrics in variants:
+            loop.run_until_complete(metrics.load())
+            print(
+                f"{label} loaded (in the background after startup) "
+                f"in {metrics.load_seconds:.2f}s"
+            )
+            current = loop.run_until_complete(metrics.current())
+            counted = tuple(
+                current[name]
+                for name in (
+                    "total_users",
+                    "total_conversations",
+                    "total_messages",
+                    "active_users_24h",
+                    "new_users_24h",
+                    "new_messages_24h",
+                )
+            )
+            print(f"COUNT queries {expected}\n{label:<14}{counted}")
+            report(
+                f"{label} per page load",
+                time_call(
+                    lambda: loop.run_until_complete(metrics.current()), args.repeat * 50
+                ),
+            )
+        loop.run_until_complete(async_engine.dispose())
+        loop.close()
+        metrics = variants[0][1]
+
+        rows = [
+            {"sender_id": n % user_count + 1, "timestamp": datetime.utcnow()}
+            for n in range(100_000)
+        ]
+        started = time.perf_counter()
+        for row in rows:
+            metrics.messages_stored([row])
+        elapsed = time.perf_counter() - started
+        print(f"counting a stored message: {elapsed / len(rows) * 1e6:.2f} us")
+
+
+def bench_signin(args) -> None:
+    """Sign-in throughput (bcrypt verify) through the password worker pool,
+    then through ``POST /auth/signin`` while ``--signin-sockets`` sockets chat.
+
+    The endpoint run reports socket delivery latency before and during the
+    sign-in burst: if sign-ins held the event loop, it would rise with them.
+    """
+    import asyncio
+    import json
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    import socketio
+    from passlib.context import CryptContext
+    from .auth import PasswordHasher, create_access_token
+
+    context = CryptContext(
+        schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=args.rounds
+    )
+    password = "correct horse battery staple"
+    hashed = context.hash(password)
+    cores = os.cpu_count() or 1
+
+    async def run(workers: int) -> float:
+        hasher = PasswordHasher(context, workers, max_pending=args.signins)
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(
+                *(
+                    hasher.verify_and_update(password, hashed)
+                    for _ in range(args.signins)
+                )
+            )
+            return args.signins / (time.perf_counter() - started)
+        finally:
+            hasher.shutdown()
+
+    for workers in sorted({1, cores}):
+        rate = asyncio.run(run(workers))
+        print(
+            f"sign-ins, {workers} worker(s), cost {args.rounds}".ljust(40)
+            + f" {rate:8.1f}/s   {rate / min(workers, cores):8.1f}/s per core"
+        )
+
+    url = f"http://127.0.0.1:{args.port}"
+
+    def sign_in(user_id: int) -> int:
+        request = urllib.request.Request(
+            f"{url}/auth/signin",
+            data=json.dumps(
+                {"username": f"user{user_id}", "password": password}
+            ).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request) as response:
+            return response.status
+
+    async def run_endpoint():
+        sent_at = {}
+        latencies = {"idle": [], "during sign-ins": []}
+        phase = "idle"
+
+        def on_message(data):
+            started = sent_at.pop(data.get("content"), None)
+            if started is not None:
+                latencies[phase].append((time.perf_counter() - started) * 1000)
+
+        clients = []
+        for user_id in range(1, args.signin_sockets + 1):
+            client = socketio.AsyncClient(reconnection=False)
+            client.on("message", on_message)
+            token = create_access_token({"sub": f"user{user_id}"})
+            await client.connect(url, auth={"token": token}, transports=["websocket"])
+            clients.append((user_id, client))
+        await asyncio.sleep(1)  # let connect handlers finish joining rooms
+
+        async def chat(seconds: float) -> None:
+            """Each socket messages its group twice a second for ``seconds``."""
+            deadline = time.perf_counter() + seconds
+            n = 0
+            while time.perf_counter() < deadline:
+                for user_id, client in clients:
+                    content = f"signin {user_id}/{n}"
+                    sent_at[content] = time.perf_counter()
+                    await client.emit(
+                        "message",
+                        {
+                            "conversation_id": (user_id - 1) // args.group_size + 1,
+                            "sender_id": user_id,
+                            "content": content,
+                        },
+                    )
+                n += 1
+                await asyncio.sleep(0.5)
+
+        await chat(2)
+        await asyncio.sleep(0.5)  # last idle deliveries
+        phase = "during sign-ins"
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            chatting = asyncio.ensure_future(chat(args.timeout))
+            started = time.perf_counter()
+            statuses = await asyncio.gather(
+                *(
+                    loop.run_in_executor(pool, sign_in, 1 + n % args.signin_sockets)
+                    for n in range(args.signins)
+                )
+            )
+            elapsed = time.perf_counter() - started
+            chatting.cancel()
+        for _, client in clients:
+            await client.disconnect()
+
+        ok = sum(status == 200 for status in statuses)
+        print(
+            f"POST /auth/signin, cost {args.rounds}".ljust(40)
+            + f" {args.signins / elapsed:8.1f}/s   {ok}/{args.signins} ok, "
+            f"{args.signin_sockets} sockets chatting"
+        )
+        for label, samples in latencies.items():
+            if samples:
+                report(f"delivery latency, {label}", samples)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        Session = make_session_factory(db_path)
+        db = Session()
+        try:
+            seed_groups(db, args.signin_sockets, args.group_size)
+            db.query(User).update({User.hashed_password: hashed})
+            db.commit()
+        finally:
+            db.close()
+        server = start_server(
+            db_path,
+            args.port,
+            {
+                "BCRYPT_ROUNDS": str(args.rounds),
+                "PASSWORD_HASH_MAX_PENDING": str(args.signins),
+            },
+        )
+        try:
+            asyncio.run(run_endpoint())
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_ingest(args) -> None:
+    """Message persistence throughput: sync commits vs group commits."""
+    import asyncio
+    from sqlalchemy.ext.asyncio import AsyncSession
+    from .message_pipeline import MessagePipeline
+
+    async def run(db_path: str, mode: str) -> float:
+        engine = create_async_db_engine(f"sqlite+aiosqlite:///{db_path}")
+        session_factory = sessionmaker(
+            bind=engine, class_=AsyncSession, expire_on_commit=False
+        )
+        pipeline = MessagePipeline(session_factory, mode=mode)
+        await pipeline.start()
+        try:
+            started = time.perf_counter()
+            submitted = await asyncio.gather(
+                *(
+                    pipeline.submit(1, 1 + n % 2, f"ingest {n}")
+                    for n in range(args.messages)
+                )
+            )
+            await asyncio.gather(*(committed for _, committed in submitted))
+            return args.messages / (time.perf_counter() - started)
+        finally:
+            await pipeline.stop()
+            await engine.dispose()
+
+    for mode in ("sync", "batched"):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "bench.db")
+            Session = make_session_factory(db_path)
+            db = Session()
+            try:
+                seed_groups(db, 2, 2)
+            finally:
+                db.close()
+            rate = asyncio.run(run(db_path, mode))
+            print(f"{mode + ' durability':<40} {rate:8.1f} messages/s")
+
+
+def bench_db_profiles(args) -> None:
+    """Read/write throughput of the engine profiles under concurrent load.
+
+    One writer thread commits single messages while reader threads load the
+    chat list and the newest history page, as the REST routes do.
+    """
+    import threading
+    from .chat import build_conversation_list, fetch_message_page
+
+    for profile in ("basic", "tuned"):
+        with tempfile.TemporaryDirectory() as tmp:
+            Session = make_session_factory(os.path.join(tmp, "bench.db"), profile)
+            db = Session()
+            try:
+                seed_conversations(db, 100, args.messages_per_conversation)
+            finally:
+                db.close()
+
+            counts = {"reads": 0, "writes": 0, "errors": 0}
+            lock = threading.Lock()
+            stop_at = time.perf_counter() + args.duration
+
+            def count(kind):
+                with lock:
+                    counts[kind] += 1
+
+            def writer():
+                db = Session()
+                n = 0
+                while time.perf_counter() < stop_at:
+                    n += 1
+                    try:
+                        db.execute(
+                            insert(Message),
+                            [
+                                {
+                                    "conversation_id": 1 + n % 100,
+                                    "sender_id": 1,
+                                    "content": f"write {n}",
+                                    "timestamp": datetime.utcnow(),
+                                    "is_deleted": False,
+                                }
+                            ],
+                        )
+                        db.commit()
+                        count("writes")
+                    except Exception:
+                        db.rollback()
+                        count("errors")
+                db.close()
+
+            def reader(worker):
+                db = Session()
+                n = 0
+                while time.perf_counter() < stop_at:
+                    n += 1
+                    try:
+                        if n % 2:
+                            build_conversation_list(db, 1)
+                        else:
+                            fetch_message_page(db, 1 + (n + worker) % 100)
+                        db.rollback()  # end the read transaction
+                        count("reads")
+                    except Exception:
+                        db.rollback()
+                        count("errors")
+                db.close()
+
+            threads = [threading.Thread(target=writer)] + [
+                threading.Thread(target=reader, args=(i,)) for i in range(args.readers)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            print(
+                f"profile {profile:<32} {counts['writes'] / args.duration:8.1f} writes/s"
+                f" {counts['reads'] / args.duration:8.1f} reads/s"
+                f"   errors {counts['errors']}"
+            )
+
+
+def bench_fanout(args) -> None:
+    """Fan-out latency of one event to every member of a conversation.
+
+    Runs an in-process Socket.IO server whose engine.io writes are replaced
+    by a yield to the event loop, so only the server-side cost is measured:
+    a loop of per-participant sid lookups and emits vs a single multi-room
+    emit to the members' personal rooms.
+    """
+    import asyncio
+    import socketio
+    from .ws_manager import (
+        LocalPresenceStore,
+        PresenceRegistry,
+        emit_to_users,
+        user_room,
+    )
+
+    async def run(member_count):
+        server = socketio.AsyncServer(async_mode="asgi")
+        sent = 0
+
+        async def send_eio_packet(eio_sid, eio_pkt):
+            nonlocal sent
+            sent += 1
+            await asyncio.sleep(0)  # stands in for the websocket write
+
+        server._send_eio_packet = send_eio_packet
+        store = LocalPresenceStore(PresenceRegistry())
+        members = list(range(1, member_count + 1))
+        for user_id in members:
+            sid = await server.manager.connect(f"eio{user_id}", "/")
+            await server.manager.enter_room(sid, "/", user_room(user_id))
+            await store.add(sid, user_id)
+
+        data = {"conversations": [{"id": 1, "unread_count": 1}]}
+
+        async def per_participant():
+            for user_id in members:
+                sids = await store.sids_for(user_id)
+                if sids:
+                    await server.emit("update_chat_list", data, room=sids)
+
+        async def multi_room():
+            await emit_to_users("update_chat_list", data, members, server=server)
+
+        for label, fanout in (
+            ("per-participant emits", per_participant),
+            ("multi-room emit", multi_room),
+        ):
+            samples = []
+            for _ in range(args.repeat):
+                sent = 0
+                started = time.perf_counter()
+                await fanout()
+                samples.append((time.perf_counter() - started) * 1000)
+                assert sent == member_count, (label, sent)
+            report(f"{label} ({member_count} members)", samples)
+
+    for member_count in (10, 100, 1000):
+        asyncio.run(run(member_count))
+
+
+def bench_presence(args) -> None:
+    """Presence fan-out for a user in many conversations.
+
+    The user is in ``--conversations`` groups of 6 drawn from ``--contacts``
+    online contacts, so every contact shares many rooms with them. An
+    in-process Socket.IO server counts the packets each contact socket
+    would receive for one offline announcement: an emit per conversation
+    room, one multi-room emit, and the PresenceBroadcaster (one event per
+    distinct online co-participant). Then a reconnect within the grace
+    period, which the broadcaster doesn't announce at all.
+    """
+    import asyncio
+    import socketio
+    from collections import Counter
+    from sqlalchemy.ext.asyncio import AsyncSession
+    from .presence_broadcaster import PresenceBroadcaster
+    from .ws_manager import LocalPresenceStore, PresenceRegistry, user_room
+
+    subject_id = 1
+    contact_ids = list(range(2, args.contacts + 2))
+    rooms_by_contact = {contact_id: [] for contact_id in contact_ids}
+    subject_rooms = []
+
+    async def run(db_path):
+        engine = create_async_db_engine(f"sqlite+aiosqlite:///{db_path}")
+        session_factory = sessionmaker(
+            bind=engine, class_=AsyncSession, expire_on_commit=False
+        )
+        server = socketio.AsyncServer(async_mode="asgi")
+        received = Counter()
+
+        async def send_eio_packet(eio_sid, eio_pkt):
+            received[eio_sid] += 1
+            await asyncio.sleep(0)  # stands in for the websocket write
+
+        server._send_eio_packet = send_eio_packet
+        store = LocalPresenceStore(PresenceRegistry())
+        for contact_id in contact_ids:
+            sid = await server.manager.connect(f"eio{contact_id}", "/")
+            for room in rooms_by_contact[contact_id] + [user_room(contact_id)]:
+                await server.manager.enter_room(sid, "/", room)
+            await store.add(sid, contact_id)
+
+        data = {"user_id": subject_id, "status": "offline", "last_seen": None}
+
+        async def per_room():
+            for room in subject_rooms:
+                await server.emit("user_status_change", data, room=room)
+
+        async def multi_room():
+            await server.emit("user_status_change", data, room=subject_rooms)
+
+        async def broadcaster():
+            presence = PresenceBroadcaster(
+                session_factory, store, server=server, grace=0
+            )
+            presence.offline(subject_id)
+            await presence.flush(everything=True)
+
+        async def flapping(grace):
+            presence = PresenceBroadcaster(
+                session_factory, store, server=server, window=0, grace=grace
+            )
+            presence.offline(subject_id)
+            if not grace:
+                await presence.flush(everything=True)
+            presence.online(subject_id)
+            await presence.flush(everything=True)
+
+        for label, fanout in (
+            ("emit per conversation room", per_room),
+            ("multi-room emit", multi_room),
+            ("broadcaster (per recipient)", broadcaster),
+            ("reconnect, no grace period", lambda: flapping(0)),
+            ("reconnect within grace", lambda: flapping(5)),
+        ):
+            samples = []
+            for _ in range(args.repeat):
+                received.clear()
+                started = time.perf_counter()
+                await fanout()
+                samples.append((time.perf_counter() - started) * 1000)
+            per_contact = max(received.values(), default=0)
+            print(
+                f"{label:<32} {sum(received.values()):6d} packets, "
+                f"{per_contact:3d} per contact"
+            )
+            report("  latency", samples)
+        await engine.dispose()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        Session = make_session_factory(db_path)
+        db = Session()
+        try:
+            db.execute(
+                insert(User),
+                [
+                    {"id": user_id, "username": f"user{user_id}", "hashed_password": "x"}
+                    for user_id in [subject_id] + contact_ids
+                ],
+            )
+            db.execute(
+                insert(Conversation),
+                [
+                    {"id": n, "name": f"group {n}"}
+                    for n in range(1, args.conversations + 1)
+                ],
+            )
+            participants = []
+            for n in range(1, args.conversations + 1):
+                subject_rooms.append(str(n))
+                participants.append({"conversation_id": n, "user_id": subject_id})
+                for k in range(5):
+                    contact_id = contact_ids[(n * 5 + k) % len(contact_ids)]
+                    rooms_by_contact[contact_id].append(str(n))
+                    participants.append({"conversation_id": n, "user_id": contact_id})
+            db.execute(insert(ConversationParticipant), participants)
+            db.commit()
+        finally:
+            db.close()
+        asyncio.run(run(db_path))
+
+
+def bench_presence_redis(args) -> None:
+    """Shared presence with two workers racing on one Redis (fakeredis).
+
+    ``--contacts`` users each reconnect ``--repeat`` times, alternating
+    workers, with the new socket registered on one worker while the old one
+    is removed on the other. Every user must end up online with one socket.
+    Then worker 1 stops heartbeating without cleaning up (a crash): once
+    its ``alive`` key expires, worker 0 must take its users offline, except
+    those that still have a socket on worker 0.
+    """
+    import asyncio
+    try:
+        from fakeredis import FakeServer
+        from fakeredis.aioredis import FakeRedis
+    except ImportError:
+        raise SystemExit("presence-redis needs the 'fakeredis' package")
+    from .ws_manager import PresenceRegistry, RedisPresenceStore
+
+    user_ids = list(range(1, args.contacts + 1))
+    cycles = args.repeat + args.repeat % 2  # even: users end on worker 1
+
+    async def run():
+        server = FakeServer()
+        offline = []
+        stores = [
+            RedisPresenceStore(
+                FakeRedis(server=server, max_connections=10_000),
+                PresenceRegistry(),
+                worker_id=f"worker{n}",
+                ttl=1,
+            )
+            for n in range(2)
+        ]
+        for store in stores:
+            await store.start(on_offline=offline.append)
+
+        async def reconnecting(user_id):
+            first = None
+            for n in range(cycles):
+                sid = f"{user_id}/{n}"
+                if first is None:
+                    first = await stores[0].add(sid, user_id)
+                    continue
+                await asyncio.gather(
+                    stores[n % 2].add(sid, user_id),
+                    stores[(n - 1) % 2].remove(f"{user_id}/{n - 1}"),
+                )
+
+        started = time.perf_counter()
+        await asyncio.gather(*(reconnecting(user_id) for user_id in user_ids))
+        elapsed = time.perf_counter() - started
+        operations = len(user_ids) * (2 * cycles - 1)
+        print(
+            f"{len(user_ids)} users x {cycles} reconnects, 2 workers".ljust(40)
+            + f" {operations / elapsed:8.1f} operations/s"
+        )
+        online = await stores[0].online_users(user_ids)
+        sockets = await stores[1].socket_count()
+        assert online == set(user_ids), f"{len(user_ids) - len(online)} users lost"
+        assert sockets == len(user_ids), f"{sockets} sockets for {len(user_ids)} users"
+        assert not offline, offline
+        print(f"{'after the races':<40} {len(online)} online, {sockets} sockets")
+
+        # Half of the users also connect to worker 0, then worker 1 crashes
+        both = user_ids[::2]
+        for user_id in both:
+            await stores[0].add(f"{user_id}/w0", user_id)
+        stores[1]._heartbeat.cancel()
+        deadline = time.perf_counter() + args.timeout
+        while not stores[0].reaped_workers and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        online = await stores[0].online_users(user_ids)
+        sockets = await stores[0].socket_count()
+        assert online == set(both), f"{len(online)} online, expected {len(both)}"
+        assert sorted(offline) == sorted(set(user_ids) - set(both)), len(offline)
+        assert sockets == len(both), sockets
+        print(
+            f"{'after worker 1 crashed':<40} {len(online)} online, {sockets} sockets, "
+            f"{len(offline)} announced offline"
+        )
+        await stores[0].stop()
+        assert await stores[0].user_count() == 0
+
+    asyncio.run(run())
+
+
+def seed_groups(db, user_count: int, group_size: int) -> None:
+    """Seeds ``user_count`` users split into group conversations of ``group_size``."""
+    db.execute(
+        insert(User),
+        [
+            {"id": i, "username": f"user{i}", "hashed_password": "x"}
+            for i in range(1, user_count + 1)
+        ],
+    )
+    group_count = (user_count + group_size - 1) // group_size
+    db.execute(
+        insert(Conversation),
+        [{"id": i, "name": f"group {i}"} for i in range(1, group_count + 1)],
+    )
+    db.execute(
+        insert(ConversationParticipant),
+        [
+            {"conversation_id": (i - 1) // group_size + 1, "user_id": i}
+            for i in range(1, user_count + 1)
+        ],
+    )
+    db.commit()
+
+
+def start_server(db_path: str, port: int, extra_env: dict | None = None):
+    """Starts ``backend.main:socket_app`` under uvicorn against ``db_path``."""
+    import subprocess
+    import sys
+    import urllib.request
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}", **(extra_env or {}))
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "backend.main:socket_app",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        cwd=repo_root,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/static/index.html")
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+def bench_socket_load(args) -> None:
+    """Messages/second and delivery latency with many concurrent sockets.
+
+    Every socket joins a group of ``--group-size`` users and sends
+    ``--messages-per-socket`` messages; latency is measured from emit on the
+    sender to receipt on each group member.
+    """
+    import asyncio
+    import socketio
+    from .auth import create_access_token
+
+    url = f"http://127.0.0.1:{args.port}"
+
+    async def run():
+        sent_at = {}
+        latencies = []
+        clients = []
+
+        def on_message(data):
+            started = sent_at.get(data.get("content"))
+            if started is not None:
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        for user_id in range(1, args.sockets + 1):
+            client = socketio.AsyncClient(reconnection=False)
+            client.on("message", on_message)
+            token = create_access_token({"sub": f"user{user_id}"})
+            await client.connect(url, auth={"token": token}, transports=["websocket"])
+            clients.append((user_id, client))
+        await asyncio.sleep(1)  # let connect handlers finish joining rooms
+
+        async def send_all(user_id, client):
+            conversation_id = (user_id - 1) // args.group_size + 1
+            for n in range(args.messages_per_socket):
+                content = f"load {user_id}/{n}"
+                sent_at[content] = time.perf_counter()
+                await client.emit(
+                    "message",
+                    {
+                        "conversation_id": conversation_id,
+                        "sender_id": user_id,
+                        "content": content,
+                    },
+                )
+
+        expected = args.sockets * args.messages_per_socket * args.group_size
+        started = time.perf_counter()
+        await asyncio.gather(*(send_all(u, c) for u, c in clients))
+        deadline = time.perf_counter() + args.timeout
+        while len(latencies) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        for _, client in clients:
+            await client.disconnect()
+
+        messages = args.sockets * args.messages_per_socket
+        print(
+            f"{args.sockets} sockets: {messages / elapsed:8.1f} messages/s, "
+            f"{len(latencies)}/{expected} deliveries in {elapsed:.1f}s"
+        )
+        if latencies:
+            report("delivery latency", latencies)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        Session = make_session_factory(db_path)
+        db = Session()
+        try:
+            seed_groups(db, args.sockets, args.group_size)
+        finally:
+            db.close()
+        server = start_server(
+            db_path, args.port, {"MESSAGE_DURABILITY": args.durability}
+        )
+        try:
+            asyncio.run(run())
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_reconnect_storm(args) -> None:
+    """Every socket (re)connecting at once, as after a restart or network blip.
+
+    ``--sockets`` clients connect concurrently to a freshly started server
+    (cold: empty token and membership caches), disconnect, and connect again
+    (warm). Refused connections are retried after the server's
+    ``retry_after`` hint, like the web client does. Reports time until all
+    sockets are connected, per-socket connect latency (first attempt to
+    success) and the number of refusals.
+    """
+    import asyncio
+    import random
+    import socketio
+    from .auth import create_access_token
+
+    url = f"http://127.0.0.1:{args.port}"
+    tokens = {
+        user_id: create_access_token({"sub": f"user{user_id}"})
+        for user_id in range(1, args.sockets + 1)
+    }
+
+    async def connect_with_retries(user_id, stats):
+        started = time.perf_counter()
+        deadline = started + args.timeout
+        while time.perf_counter() < deadline:
+            client = socketio.AsyncClient(reconnection=False)
+            refusal = {}
+
+            @client.on("connect_error")
+            def on_connect_error(data):
+                if isinstance(data, dict):
+                    refusal.update(data.get("data") or {})
+
+            try:
+                await client.connect(
+                    url,
+                    auth={"token": tokens[user_id]},
+                    transports=["websocket"],
+                    wait_timeout=args.timeout,
+                )
+            except socketio.exceptions.ConnectionError:
+                stats["refused" if "retry_after" in refusal else "failed"] += 1
+                delay = refusal.get("retry_after", 1.0)
+                await asyncio.sleep(delay + random.uniform(0, 1.0))
+                continue
+            stats["latencies"].append((time.perf_counter() - started) * 1000)
+            return client
+        return None
+
+    async def storm(label):
+        stats = {"latencies": [], "refused": 0, "failed": 0}
+        started = time.perf_counter()
+        clients = await asyncio.gather(
+            *(connect_with_retries(user_id, stats) for user_id in tokens)
+        )
+        elapsed = time.perf_counter() - started
+        connected = [client for client in clients if client is not None]
+        print(
+            f"{label}: {len(connected)}/{args.sockets} connected in "
+            f"{elapsed:.2f}s, {stats['refused']} refusals, "
+            f"{stats['failed']} failed attempts"
+        )
+        if stats["latencies"]:
+            report("  connect latency", stats["latencies"])
+        await asyncio.gather(*(client.disconnect() for client in connected))
+
+    async def run():
+        await storm("cold")
+        await asyncio.sleep(1)  # let the offline wave go out
+        await storm("warm")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        Session = make_session_factory(db_path)
+        db = Session()
+        try:
+            seed_groups(db, args.sockets, args.group_size)
+        finally:
+            db.close()
+        extra_env = {}
+        if args.connect_rate is not None:
+            extra_env["CONNECT_RATE_PER_SECOND"] = str(args.connect_rate)
+        server = start_server(db_path, args.port, extra_env)
+        try:
+            asyncio.run(run())
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_query_plans(args) -> None:
+    """EXPLAIN QUERY PLAN of the hot queries; exits 1 if any scans a table.
+
+    Runs backend/tests/test_query_plans.py, which holds the hot queries.
+    """
+    import sys
+    import pytest
+
+    os.environ["QUERY_PLANS_MESSAGES_PER_CONVERSATION"] = str(
+        args.messages_per_conversation
+    )
+    path = os.path.join(os.path.dirname(__file__), "tests", "test_query_plans.py")
+    sys.exit(pytest.main(["-q", "-p", "no:cacheprovider", path]))
+
+
+BENCHMARKS = {
+    "admin-stats": bench_admin_stats,
+    "ai-batch": bench_ai_batch,
+    "ai-cache": bench_ai_cache,
+    "ai-limits": bench_ai_limits,
+    "ai-providers": bench_ai_providers,
+    "conversations": bench_conversations,
+    "db-profiles": bench_db_profiles,
+    "fanout": bench_fanout,
+    "history": bench_history,
+    "ingest": bench_ingest,
+    "mark-read": bench_mark_read,
+    "presence": bench_presence,
+    "presence-redis": bench_presence_redis,
+    "query-plans": bench_query_plans,
+    "reconnect-storm": bench_reconnect_storm,
+    "search": bench_search,
+    "signin": bench_signin,
+    "socket-load": bench_socket_load,
+    "user-search": bench_user_search,
+}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="TalkFlow micro-benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--messages-per-conversation", type=int, default=20)
+    parser.add_argument("--signins", type=int, default=64)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost factor")
+    parser.add_argument("--sockets", type=int, default=1000)
+    parser.add_argument("--signin-sockets", type=int, default=10)
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--messages-per-socket", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--durability", choices=("sync", "batched"), default="sync")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds")
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--unread", type=int, default=10_000)
+    parser.add_argument("--conversations", type=int, default=300)
+    parser.add_argument("--contacts", type=int, default=60)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--search-messages", type=int, default=1_000_000)
+    parser.add_argument("--search-users", type=int, default=1_000_000)
+    parser.add_argument("--stats-messages", type=int, default=1_000_000)
+    parser.add_argument("--ai-latency", type=float, default=20.0, help="ms")
+    parser.add_argument(
+        "--connect-rate",
+        type=float,
+        help="server CONNECT_RATE_PER_SECOND (0 disables admission control)",
+    )
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
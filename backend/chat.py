@@ -1,15 +1,34 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session, aliased
 from .database import get_db
-from .models import Conversation, ConversationParticipant, Message, User
+from .models import (
+    Conversation,
+    ConversationParticipant,
+    ConversationSummary,
+    Message,
+    User,
+)
 from .schemas import ConversationCreate, MessageResponse, MessageCreate
 from .auth import get_current_user
-from sqlalchemy import and_
+from sqlalchemy import and_, func, select, tuple_, update
 from datetime import datetime  # Import datetime
-from .ws_manager import (
-    sio,
-    connected_users,
-)  # Import WebSocket components from ws_manager
+from .ws_manager import emit_to_users  # Import WebSocket helpers from ws_manager
+from .chat_list_notifier import chat_list_notifier
+from .conversation_summaries import (
+    message_deleted_statements,
+    message_edited_statements,
+)
+from .membership_cache import membership_cache
+from .last_seen_writer import last_seen_writer
+from .admin_metrics import admin_metrics
+from .message_search import (
+    SEARCH_PAGE_DEFAULT,
+    SEARCH_PAGE_MAX,
+    is_indexed,
+    reindex_statements,
+    search_messages,
+)
 
 router = APIRouter(prefix="/chat")
 
@@ -24,117 +43,152 @@ def create_conversation(
     db.add(new_conversation)
     db.commit()
     db.refresh(new_conversation)
-    for pid in conversation.participant_ids:
+    db.add(ConversationSummary(conversation_id=new_conversation.id))
+    # Each user joins once (the table has a unique (conversation, user) key)
+    for pid in dict.fromkeys(conversation.participant_ids):
         participant = ConversationParticipant(
             conversation_id=new_conversation.id, user_id=pid
         )
         db.add(participant)
     db.commit()
+    admin_metrics.conversation_created()
+    # Their next (re)connect joins the new room too; the cache belongs to the
+    # event loop, and this sync route runs in a worker thread
+    anyio.from_thread.run_sync(
+        membership_cache.invalidate, *conversation.participant_ids
+    )
     return {"message": "Conversation created", "conversation_id": new_conversation.id}
 
 
-@router.get("/conversations", response_model=list[dict])
-def get_conversations(
-    user: User = Depends(get_current_user), db: Session = Depends(get_db)
-):
-    # Fetch conversations the user is part of
-    user_participants = (
-        db.query(ConversationParticipant)
-        .filter(ConversationParticipant.user_id == user.id)
+def _conversation_list_query(db: Session, user_id: int):
+    """Chat-list query: one row per conversation of ``user_id``.
+
+    The latest message and the unread count are maintained on write (see
+    conversation_summaries.py), so this is a single indexed read of the
+    user's participant rows; its cost doesn't depend on message history.
+    """
+    return (
+        db.query(
+            Conversation.id,
+            Conversation.name,
+            ConversationSummary.last_message_content,
+            ConversationSummary.last_message_is_deleted,
+            ConversationSummary.last_message_at,
+            ConversationParticipant.unread_count,
+        )
+        .select_from(ConversationParticipant)
+        .join(Conversation, Conversation.id == ConversationParticipant.conversation_id)
+        .outerjoin(
+            ConversationSummary,
+            ConversationSummary.conversation_id == Conversation.id,
+        )
+        .filter(ConversationParticipant.user_id == user_id)
+        # Conversations without messages go last, like datetime.min did before
+        .order_by(
+            ConversationSummary.last_message_at.is_(None),
+            ConversationSummary.last_message_at.desc(),
+            Conversation.id.desc(),
+        )
+    )
+
+
+def _participants_by_conversation(db: Session, user_id: int) -> dict:
+    """Fetches the participants of all of ``user_id``'s conversations at once."""
+    my_conversation_ids = select(ConversationParticipant.conversation_id).where(
+        ConversationParticipant.user_id == user_id
+    )
+    rows = (
+        db.query(
+            ConversationParticipant.conversation_id,
+            User.id,
+            User.username,
+            User.last_seen,
+        )
+        .join(User, User.id == ConversationParticipant.user_id)
+        .filter(ConversationParticipant.conversation_id.in_(my_conversation_ids))
+        .order_by(ConversationParticipant.conversation_id, ConversationParticipant.id)
         .all()
     )
-    conversation_ids = [p.conversation_id for p in user_participants]
+    participants = {}
+    for conversation_id, participant_id, username, last_seen in rows:
+        # Times not written yet are newer than the column
+        last_seen = last_seen_writer.get(participant_id) or last_seen
+        participants.setdefault(conversation_id, []).append(
+            {
+                "id": participant_id,
+                "username": username,
+                "last_seen": last_seen.isoformat() if last_seen else None,
+            }
+        )
+    return participants
 
-    if not conversation_ids:
-        return []
 
-    conversations = (
-        db.query(Conversation).filter(Conversation.id.in_(conversation_ids)).all()
+def conversation_members_query(conversation_id: int):
+    """The users taking part in ``conversation_id``."""
+    return (
+        select(User)
+        .join(ConversationParticipant)
+        .where(ConversationParticipant.conversation_id == conversation_id)
     )
 
-    # Create a map for quick lookup of participant info for the current user
-    user_participant_map = {p.conversation_id: p for p in user_participants}
 
-    result = []
-    for conv in conversations:
-        # Fetch all participant user objects for this conversation
-        participants = (
-            db.query(User)
-            .join(ConversationParticipant)
-            .filter(ConversationParticipant.conversation_id == conv.id)
-            .all()
-        )
+def build_conversation_list(db: Session, user_id: int) -> list[dict]:
+    """Returns the chat list for ``user_id`` in a constant number of queries."""
+    rows = _conversation_list_query(db, user_id).all()
+    if not rows:
+        return []
 
-        # Create participant details list (id and username)
-        participant_details = [
-            {"id": p.id, "username": p.username} for p in participants
-        ]
+    participants_map = _participants_by_conversation(db, user_id)
+
+    result = []
+    for (
+        conversation_id,
+        conversation_name,
+        last_content,
+        last_is_deleted,
+        last_timestamp,
+        unread_count,
+    ) in rows:
+        participant_details = participants_map.get(conversation_id, [])
 
         # Determine display name
-        other_participants = [p for p in participants if p.id != user.id]
+        other_participants = [p for p in participant_details if p["id"] != user_id]
         display_name = (
-            other_participants[0].username
-            if len(participants) == 2
+            other_participants[0]["username"]
+            if len(participant_details) == 2
             and other_participants  # Use other user's name for 1-on-1
-            else conv.name or f"Group Chat ({len(participants)} members)"
+            else conversation_name
+            or f"Group Chat ({len(participant_details)} members)"
         )
 
-        last_message = (
-            db.query(Message)
-            .filter(Message.conversation_id == conv.id)
-            .order_by(Message.timestamp.desc())
-            .first()
-        )
-        last_message_content = (
-            last_message.content
-            if last_message and not last_message.is_deleted
-            else "No messages yet"
-        )
-
-        # Get the participant record for the current user in this conversation
-        current_participant = user_participant_map.get(conv.id)
-        last_read = (
-            current_participant.last_read_timestamp if current_participant else None
-        )
-
-        # Calculate unread count based on last read timestamp
-        unread_query = db.query(Message).filter(
-            Message.conversation_id == conv.id,
-            Message.sender_id != user.id,
-            Message.is_deleted == False,  # Don't count deleted messages as unread
-        )
-        if last_read:
-            unread_query = unread_query.filter(Message.timestamp > last_read)
-
-        unread_count = unread_query.count()
-
         result.append(
             {
-                "id": conv.id,
+                "id": conversation_id,
                 "name": display_name,  # Use the determined display name
-                "last_message": last_message_content,
+                "last_message": (
+                    last_content
+                    if last_content is not None and not last_is_deleted
+                    else "No messages yet"
+                ),
+                "last_timestamp": (
+                    last_timestamp.isoformat() if last_timestamp else None
+                ),
                 "participants": [
-                    p.username for p in participants
+                    p["username"] for p in participant_details
                 ],  # Keep list of usernames
-                "participant_details": participant_details,  # <-- ADDED participant details
+                "participant_details": participant_details,
                 "unread_count": unread_count,
             }
         )
+    return result
 
-    # Sort conversations by last message timestamp (descending)
-    # We need to fetch the timestamp for sorting
-    conv_last_timestamps = {
-        c.id: db.query(Message.timestamp)
-        .filter(Message.conversation_id == c.id)
-        .order_by(Message.timestamp.desc())
-        .limit(1)
-        .scalar()
-        or datetime.min
-        for c in conversations
-    }
-    result.sort(
-        key=lambda x: conv_last_timestamps.get(x["id"], datetime.min), reverse=True
-    )
+
+@router.get("/conversations", response_model=list[dict])
+def get_conversations(
+    user: User = Depends(get_current_user), db: Session = Depends(get_db)
+):
+    # Already sorted by last message timestamp (descending) in SQL
+    result = build_conversation_list(db, user.id)
 
     print(
         f"Fetched {len(result)} conversations for user {user.id}: {[conv['name'] for conv in result]}"
@@ -142,45 +196,78 @@ def get_conversations(
     return result
 
 
-@router.get("/messages/{conversation_id}", response_model=list[MessageResponse])
-def get_messages(
+MESSAGE_PAGE_DEFAULT = 50
+MESSAGE_PAGE_MAX = 200
+
+
+def fetch_message_page(
+    db: Session,
     conversation_id: int,
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
-):
-    # Check if user is a participant in the conversation
-    participant = (
-        db.query(ConversationParticipant)
-        .filter(
-            and_(
-                ConversationParticipant.conversation_id == conversation_id,
-                ConversationParticipant.user_id == user.id,
-            )
+    before_id: int | None = None,
+    after_id: int | None = None,
+    limit: int = MESSAGE_PAGE_DEFAULT,
+) -> list[dict]:
+    """Returns one page of a conversation's history in chronological order.
+
+    Pages are keyset-based on ``(timestamp, id)`` so they are served by the
+    ``ix_messages_conversation_timestamp_id`` index: without a cursor the newest
+    ``limit`` messages are returned, ``before_id`` walks back in history and
+    ``after_id`` catches up on newer messages. Sender and reply-preview data
+    are joined in, so a page costs one query whatever the history size.
+    """
+    ReplyMessage = aliased(Message)
+    Sender = aliased(User)
+    ReplySender = aliased(User)
+
+    query = (
+        db.query(
+            Message,
+            Sender.username,
+            ReplyMessage.content,
+            ReplyMessage.is_deleted,
+            ReplyMessage.sender_id,
+            ReplySender.username,
         )
-        .first()
+        .outerjoin(Sender, Sender.id == Message.sender_id)
+        .outerjoin(ReplyMessage, ReplyMessage.id == Message.replied_to_id)
+        .outerjoin(ReplySender, ReplySender.id == ReplyMessage.sender_id)
+        .filter(Message.conversation_id == conversation_id)
     )
 
-    if not participant:
-        raise HTTPException(
-            status_code=403, detail="Not authorized to view this conversation"
+    position = tuple_(Message.timestamp, Message.id)
+    if before_id is not None:
+        anchor = _cursor_timestamp(conversation_id, before_id)
+        query = query.filter(position < tuple_(anchor, before_id))
+    if after_id is not None:
+        anchor = _cursor_timestamp(conversation_id, after_id)
+        query = query.filter(position > tuple_(anchor, after_id))
+
+    if after_id is not None:
+        rows = query.order_by(Message.timestamp, Message.id).limit(limit).all()
+    else:
+        # Newest first so LIMIT keeps the page adjacent to the cursor
+        rows = (
+            query.order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit)
+            .all()
         )
+        rows.reverse()
 
-    messages = (
-        db.query(Message)
-        .filter(Message.conversation_id == conversation_id)
-        .order_by(Message.timestamp)
-        .all()
-    )
-
-    # Enhance messages with reply content
     result = []
-    for msg in messages:
+    for (
+        msg,
+        sender_username,
+        replied_content,
+        replied_is_deleted,
+        replied_sender_id,
+        replied_username,
+    ) in rows:
         message_dict = {
             "id": msg.id,
             "conversation_id": msg.conversation_id,
             "sender_id": msg.sender_id,
             # Include sender username for potential future use
-            "sender_username": msg.sender.username,
+            "sender_username": sender_username,
             "content": msg.content if not msg.is_deleted else "[Message deleted]",
             "timestamp": msg.timestamp.isoformat(),  # Ensure timestamp is ISO format string
             "is_deleted": msg.is_deleted,
@@ -193,26 +280,157 @@ def get_messages(
             ),  # Include read_at timestamp
         }
 
-        # Fetch replied message details if it exists
-        if msg.replied_to_id:
-            replied_msg = (
-                db.query(Message).filter(Message.id == msg.replied_to_id).first()
+        # Reply preview comes from the joined row, no extra query
+        if msg.replied_to_id and replied_sender_id is not None:
+            message_dict["replied_to_content"] = (
+                replied_content if not replied_is_deleted else "[Message deleted]"
             )
-            if replied_msg:
-                message_dict["replied_to_content"] = (
-                    replied_msg.content
-                    if not replied_msg.is_deleted
-                    else "[Message deleted]"
-                )
-                message_dict["replied_to_sender"] = replied_msg.sender_id
-                # Include username for better display
-                message_dict["replied_to_username"] = replied_msg.sender.username
+            message_dict["replied_to_sender"] = replied_sender_id
+            message_dict["replied_to_username"] = replied_username
 
         result.append(message_dict)
 
     return result
 
 
+def _cursor_timestamp(conversation_id: int, message_id: int):
+    """Scalar subquery resolving a cursor message id to its timestamp."""
+    return (
+        select(Message.timestamp)
+        .where(
+            Message.id == message_id,
+            Message.conversation_id == conversation_id,
+        )
+        .scalar_subquery()
+    )
+
+
+@router.get("/messages/{conversation_id}", response_model=list[MessageResponse])
+def get_messages(
+    conversation_id: int,
+    before_id: int | None = Query(None, description="Messages older than this id"),
+    after_id: int | None = Query(None, description="Messages newer than this id"),
+    limit: int = Query(MESSAGE_PAGE_DEFAULT, ge=1, le=MESSAGE_PAGE_MAX),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    if before_id is not None and after_id is not None:
+        raise HTTPException(
+            status_code=400, detail="Use either before_id or after_id, not both"
+        )
+
+    # Check if user is a participant in the conversation
+    participant = (
+        db.query(ConversationParticipant)
+        .filter(
+            and_(
+                ConversationParticipant.conversation_id == conversation_id,
+                ConversationParticipant.user_id == user.id,
+            )
+        )
+        .first()
+    )
+
+    if not participant:
+        raise HTTPException(
+            status_code=403, detail="Not authorized to view this conversation"
+        )
+
+    return fetch_message_page(
+        db, conversation_id, before_id=before_id, after_id=after_id, limit=limit
+    )
+
+
+@router.get("/search")
+def search(
+    q: str = Query(..., min_length=1, max_length=200, description="Words to find"),
+    conversation_id: int | None = Query(None, description="Search only this conversation"),
+    limit: int = Query(SEARCH_PAGE_DEFAULT, ge=1, le=SEARCH_PAGE_MAX),
+    offset: int = Query(0, ge=0, le=10_000),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Searches the messages of the user's conversations, best matches first.
+
+    Each result has a ``snippet`` of the message with the matched words in
+    ``<mark>`` (HTML-escaped otherwise). Pass ``next_offset`` back as
+    ``offset`` for the next page.
+    """
+    if not is_indexed(db):
+        raise HTTPException(
+            status_code=501, detail="Message search requires the SQLite database"
+        )
+
+    if conversation_id is not None:
+        participant = (
+            db.query(ConversationParticipant.id)
+            .filter(
+                ConversationParticipant.conversation_id == conversation_id,
+                ConversationParticipant.user_id == user.id,
+            )
+            .first()
+        )
+        if not participant:
+            raise HTTPException(
+                status_code=403, detail="Not authorized to view this conversation"
+            )
+
+    return search_messages(
+        db, user.id, q, conversation_id=conversation_id, limit=limit, offset=offset
+    )
+
+
+def mark_messages_read(
+    db: Session,
+    conversation_id: int,
+    reader_id: int,
+    read_at: datetime,
+    returning: bool | None = None,
+) -> dict:
+    """Sets ``read_at`` on the unread messages others sent to the conversation.
+
+    Returns ``{sender_id: (highest message id read, messages read)}``. With
+    ``returning`` (default: server databases that support it) this is a
+    single ``UPDATE ... RETURNING``. Otherwise the per-sender high-water
+    marks are read with one grouped query and the UPDATE is bounded by them;
+    on SQLite that measured faster than RETURNING, which materializes every
+    updated row, and it also covers SQLite builds older than 3.35.
+    """
+    if returning is None:
+        dialect = db.get_bind().dialect
+        returning = dialect.name != "sqlite" and getattr(
+            dialect, "update_returning", False
+        )
+
+    messages = Message.__table__  # Core statement: no ORM row processing
+    unread = (
+        messages.c.conversation_id == conversation_id,
+        messages.c.sender_id != reader_id,
+        messages.c.read_at.is_(None),
+    )
+    mark_read = update(messages).where(*unread).values(read_at=read_at)
+
+    read_up_to = {}
+    if returning:
+        for sender_id, message_id in db.execute(
+            mark_read.returning(messages.c.sender_id, messages.c.id)
+        ):
+            max_id, count = read_up_to.get(sender_id, (0, 0))
+            read_up_to[sender_id] = (max(max_id, message_id), count + 1)
+        return read_up_to
+
+    for sender_id, max_id, count in (
+        db.query(messages.c.sender_id, func.max(messages.c.id), func.count())
+        .filter(*unread)
+        .group_by(messages.c.sender_id)
+    ):
+        read_up_to[sender_id] = (max_id, count)
+    if read_up_to:
+        highest = max(max_id for max_id, _ in read_up_to.values())
+        db.execute(mark_read.where(messages.c.id <= highest))
+    return read_up_to
+
+
 @router.post("/conversations/{conversation_id}/mark_read")
 async def mark_conversation_as_read(  # Make the function async
     conversation_id: int,
@@ -235,56 +453,34 @@ async def mark_conversation_as_read(  # Make the function async
 
     now = datetime.utcnow()
     participant.last_read_timestamp = now
+    participant.unread_count = 0
 
-    # Find messages sent by others in this conversation that haven't been marked as read
-    messages_to_update = (
-        db.query(Message)
-        .filter(
-            Message.conversation_id == conversation_id,
-            Message.sender_id != user.id,  # Messages sent by others
-            Message.read_at == None,  # That are not yet marked as read
-        )
-        .all()
-    )
-
-    updated_message_ids_by_sender = {}
-    if messages_to_update:
-        for msg in messages_to_update:
-            msg.read_at = now
-            if msg.sender_id not in updated_message_ids_by_sender:
-                updated_message_ids_by_sender[msg.sender_id] = []
-            updated_message_ids_by_sender[msg.sender_id].append(msg.id)
+    # One set-based UPDATE instead of loading every unread message
+    read_up_to = mark_messages_read(db, conversation_id, user.id, now)
 
     db.commit()
+    # The reader's other devices drop the unread badge
+    chat_list_notifier.invalidate(conversation_id, user_ids=[user.id])
     print(
-        f"User {user.id} marked conversation {conversation_id} as read at {now}. Updated {len(messages_to_update)} messages."
+        f"User {user.id} marked conversation {conversation_id} as read at {now}. Updated {sum(count for _, count in read_up_to.values())} messages."
     )
 
-    # Notify senders via WebSocket
-    if updated_message_ids_by_sender:
-        # Find socket IDs for each sender
-        sender_ids = list(updated_message_ids_by_sender.keys())
-        # Invert connected_users for easier lookup (user_id -> list of sids)
-        user_sockets = {}
-        for sid, uid in connected_users.items():
-            if uid not in user_sockets:
-                user_sockets[uid] = []
-            user_sockets[uid].append(sid)
-
-        for sender_id, message_ids in updated_message_ids_by_sender.items():
-            if sender_id in user_sockets:
-                for sid in user_sockets[sender_id]:
-                    await sio.emit(
-                        "messages_read",
-                        {
-                            "conversation_id": conversation_id,
-                            "message_ids": message_ids,
-                        },
-                        room=sid,  # Send directly to the sender's socket
-                    )
-                    print(
-                        f"Notified user {sender_id} (sid: {sid}) about read messages: {message_ids}"
-                    )
+    # One receipt for all senders: everything up to read_up_to_id is read
+    if read_up_to:
+        read_up_to_id = max(max_id for max_id, _ in read_up_to.values())
+        await emit_to_users(
+            "messages_read",
+            {
+                "conversation_id": conversation_id,
+                "reader_id": user.id,
+                "read_up_to_id": read_up_to_id,
+                "read_at": now.isoformat(),
+            },
+            read_up_to,
+        )
+        print(
+            f"Notified {len(read_up_to)} senders that messages up to {read_up_to_id} were read"
+        )
 
     return {"status": "success", "message": "Conversation marked as read"}
 
@@ -306,9 +502,19 @@ def delete_message(
             status_code=403, detail="Not authorized to delete this message"
         )
 
+    # Deleting twice must not take the message off the unread counts twice
+    if message.is_deleted:
+        return {"status": "success", "message": "Message deleted"}
+
     # Mark message as deleted instead of removing it
     message.is_deleted = True
+    for statement in message_deleted_statements(message):
+        db.execute(statement)
+    for statement in reindex_statements(db, message):
+        db.execute(statement)
     db.commit()
+    # Sync route: hand the chat-list update to the event loop
+    anyio.from_thread.run_sync(chat_list_notifier.invalidate, message.conversation_id)
 
     return {"status": "success", "message": "Message deleted"}
 
@@ -336,10 +542,19 @@ def update_message(
         raise HTTPException(status_code=400, detail="Cannot edit a deleted message")
 
     # Update message content
-    if "content" in message_data:
+    changed = "content" in message_data and message_data["content"] != message.content
+    if changed:
         message.content = message_data["content"]
+        for statement in message_edited_statements(message):
+            db.execute(statement)
+        for statement in reindex_statements(db, message):
+            db.execute(statement)
 
     db.commit()
+    if changed:
+        anyio.from_thread.run_sync(
+            chat_list_notifier.invalidate, message.conversation_id
+        )
 
     return {
         "status": "success",
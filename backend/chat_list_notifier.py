@@ -0,0 +1,149 @@
+import asyncio
+import os
+from datetime import datetime
+from sqlalchemy import select
+from .database import AsyncSessionLocal
+from .models import ConversationParticipant, ConversationSummary
+from .ws_manager import emit_per_user
+
+# Chat-list invalidations within this window are merged into one event per user
+CHAT_LIST_DEBOUNCE_MS = int(os.getenv("CHAT_LIST_DEBOUNCE_MS", "200"))
+
+
+def chat_list_delta_query(conversation_ids):
+    """Each participant's row of the chat list for ``conversation_ids``."""
+    return (
+        select(
+            ConversationParticipant.user_id,
+            ConversationParticipant.conversation_id,
+            ConversationParticipant.unread_count,
+            ConversationSummary.last_message_content,
+            ConversationSummary.last_message_is_deleted,
+            ConversationSummary.last_message_at,
+        )
+        .outerjoin(
+            ConversationSummary,
+            ConversationSummary.conversation_id
+            == ConversationParticipant.conversation_id,
+        )
+        .where(ConversationParticipant.conversation_id.in_(conversation_ids))
+    )
+
+
+class ChatListNotifier:
+    """Coalesces chat-list invalidations into one ``update_chat_list`` per user.
+
+    ``invalidate`` only records the conversation; at most once per window the
+    pending conversations are read from the write-maintained summaries and
+    every affected user gets a single event carrying the changed chat-list
+    entries (last message, timestamp, unread count), so clients can patch
+    their list instead of refetching it.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        server=None,
+        window: float = CHAT_LIST_DEBOUNCE_MS / 1000,
+    ):
+        self.session_factory = session_factory
+        self.server = server  # defaults to the shared Socket.IO server
+        self.window = window
+        self._pending = {}  # conversation id -> set of user ids, or None for all
+        self._timer = None
+        self.invalidations = 0
+        self.flushes = 0
+        self.events = 0
+
+    def invalidate(self, conversation_id, user_ids=None) -> None:
+        """Schedules a chat-list update for the conversation's participants.
+
+        ``user_ids`` narrows it to some participants (e.g. the reader after
+        mark_read); by default every participant is notified.
+        """
+        self.invalidations += 1
+        if user_ids is None or self._pending.get(conversation_id, ()) is None:
+            self._pending[conversation_id] = None
+        else:
+            self._pending.setdefault(conversation_id, set()).update(user_ids)
+        if self._timer is None or self._timer.done():
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def stop(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending_conversations": len(self._pending),
+            "invalidations": self.invalidations,
+            "flushes": self.flushes,
+            "events": self.events,
+        }
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self.window)
+        except asyncio.CancelledError:
+            return
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Error notifying chat list updates: {e}")
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        self.flushes += 1
+
+        async with self.session_factory() as db:
+            rows = (await db.execute(chat_list_delta_query(list(pending)))).all()
+
+        updates_by_user = {}
+        for (
+            user_id,
+            conversation_id,
+            unread_count,
+            last_content,
+            last_is_deleted,
+            last_timestamp,
+        ) in rows:
+            recipients = pending[conversation_id]
+            if recipients is not None and user_id not in recipients:
+                continue
+            # Same fields as the entries of GET /chat/conversations
+            updates_by_user.setdefault(user_id, []).append(
+                {
+                    "id": conversation_id,
+                    "last_message": (
+                        last_content
+                        if last_content is not None and not last_is_deleted
+                        else "No messages yet"
+                    ),
+                    "last_timestamp": (
+                        last_timestamp.isoformat() if last_timestamp else None
+                    ),
+                    "unread_count": unread_count,
+                }
+            )
+
+        # Sent to each user's personal room; users with identical entries
+        # (e.g. a group's members with the same unread count) share one emit
+        timestamp = datetime.utcnow().isoformat()
+        await emit_per_user(
+            "update_chat_list",
+            {
+                user_id: {"conversations": conversations, "timestamp": timestamp}
+                for user_id, conversations in updates_by_user.items()
+            },
+            server=self.server,
+        )
+        self.events += len(updates_by_user)
+
+
+# Shared notifier used by the Socket.IO handlers and the chat routes
+chat_list_notifier = ChatListNotifier(AsyncSessionLocal)
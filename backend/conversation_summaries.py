@@ -0,0 +1,174 @@
+"""Write-time maintenance of the chat list summary.
+
+``conversation_summaries`` keeps the latest message of every conversation
+and ``conversation_participants.unread_count`` the number of unread messages
+per participant, so the chat list never has to aggregate message history.
+Both are updated in the same transaction as the message write that changes
+them. Rebuild them from the messages table with:
+
+    python -m backend.conversation_summaries
+"""
+
+from sqlalchemy import bindparam, or_, select, text
+
+from .migrate_db import SUMMARY_REBUILD_STATEMENTS
+from .models import ConversationParticipant, ConversationSummary
+
+summaries = ConversationSummary.__table__
+participants = ConversationParticipant.__table__
+
+# Core (table) statements so a list of parameters runs as one executemany
+_advance_summary = (
+    summaries.update()
+    .where(
+        summaries.c.conversation_id == bindparam("cid"),
+        or_(
+            summaries.c.last_message_id.is_(None),
+            summaries.c.last_message_id < bindparam("mid"),
+        ),
+    )
+    .values(
+        last_message_id=bindparam("mid"),
+        last_message_content=bindparam("content"),
+        last_message_is_deleted=bindparam("is_deleted"),
+        last_message_at=bindparam("ts"),
+    )
+)
+
+# Skips readers whose read mark is already past the message (it may have been
+# queued for a group commit while they opened the conversation)
+_count_unread = (
+    participants.update()
+    .where(
+        participants.c.conversation_id == bindparam("cid"),
+        participants.c.user_id != bindparam("sender"),
+        or_(
+            participants.c.last_read_timestamp.is_(None),
+            participants.c.last_read_timestamp < bindparam("ts"),
+        ),
+    )
+    .values(unread_count=participants.c.unread_count + 1)
+)
+
+
+async def record_messages(db, rows) -> None:
+    """Advances summaries and unread counts for newly inserted message ``rows``.
+
+    ``rows`` are the dicts inserted into ``messages`` (with their ids).
+    """
+    latest = {}
+    for row in rows:
+        cid = row["conversation_id"]
+        if cid not in latest or latest[cid]["id"] < row["id"]:
+            latest[cid] = row
+
+    existing = set(
+        await db.scalars(
+            select(summaries.c.conversation_id).where(
+                summaries.c.conversation_id.in_(latest)
+            )
+        )
+    )
+    missing = [cid for cid in latest if cid not in existing]
+    if missing:
+        # Conversations created before the summary table existed
+        await db.execute(
+            summaries.insert(),
+            [{"conversation_id": cid} for cid in missing],
+        )
+
+    await db.execute(
+        _advance_summary,
+        [
+            {
+                "cid": cid,
+                "mid": row["id"],
+                "content": row["content"],
+                "is_deleted": row["is_deleted"],
+                "ts": row["timestamp"],
+            }
+            for cid, row in latest.items()
+        ],
+    )
+    await db.execute(
+        _count_unread,
+        [
+            {
+                "cid": row["conversation_id"],
+                "sender": row["sender_id"],
+                "ts": row["timestamp"],
+            }
+            for row in rows
+        ],
+    )
+
+
+def message_deleted_statements(message) -> list:
+    """Statements dropping ``message`` from unread counts and hiding it in the
+    summary; run them in the transaction that marks it deleted, once.
+
+    Returned rather than executed so the REST routes (sync ``Session``) and
+    the Socket.IO handlers (``AsyncSession``) share them.
+    """
+    return [
+        participants.update()
+        .where(
+            participants.c.conversation_id == message.conversation_id,
+            participants.c.user_id != message.sender_id,
+            participants.c.unread_count > 0,
+            or_(
+                participants.c.last_read_timestamp.is_(None),
+                participants.c.last_read_timestamp < message.timestamp,
+            ),
+        )
+        .values(unread_count=participants.c.unread_count - 1),
+        summaries.update()
+        .where(
+            summaries.c.conversation_id == message.conversation_id,
+            summaries.c.last_message_id == message.id,
+        )
+        .values(last_message_is_deleted=True),
+    ]
+
+
+def message_edited_statements(message) -> list:
+    """Statements refreshing the summary preview if ``message`` is the latest one."""
+    return [
+        summaries.update()
+        .where(
+            summaries.c.conversation_id == message.conversation_id,
+            summaries.c.last_message_id == message.id,
+        )
+        .values(last_message_content=message.content)
+    ]
+
+
+async def record_message_deleted(db, message) -> None:
+    """Drops ``message`` from unread counts and hides it in the summary."""
+    for statement in message_deleted_statements(message):
+        await db.execute(statement)
+
+
+async def record_message_edited(db, message) -> None:
+    """Refreshes the summary preview if ``message`` is the latest one."""
+    for statement in message_edited_statements(message):
+        await db.execute(statement)
+
+
+def rebuild_summaries(db) -> None:
+    """Recomputes every summary and unread count from the messages table."""
+    for statement in SUMMARY_REBUILD_STATEMENTS:
+        db.execute(text(statement))
+    db.commit()
+
+
+if __name__ == "__main__":
+    from .database import Base, SessionLocal, engine
+
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        rebuild_summaries(session)
+        print("Conversation summaries and unread counts rebuilt.")
+    finally:
+        session.close()
@@ -1,15 +1,117 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./talkflowchat.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./talkflowchat.db")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+# Engine profile: "tuned" (default) or "basic" (driver defaults, no pragmas)
+DB_PROFILE = os.getenv("DB_PROFILE", "tuned")
+
+# Applied to every new SQLite connection in the "tuned" profile
+SQLITE_TUNED_PRAGMAS = {
+    "journal_mode": "WAL",  # readers no longer block the writer
+    "synchronous": "NORMAL",  # fsync on checkpoint instead of every commit
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "cache_size": -int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536")),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "temp_store": "MEMORY",
+}
+
+# Connection pool used by the "tuned" profile
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+
+def to_async_url(url: str) -> str:
+    """Maps a sync database URL to the matching asyncio driver."""
+    if url.startswith("sqlite:///"):
+        return "sqlite+aiosqlite:///" + url[len("sqlite:///") :]
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix) :]
+    return url
+
+
+def _is_sqlite(url: str) -> bool:
+    return url.startswith("sqlite")
+
+
+def _is_sqlite_memory(url: str) -> bool:
+    path = url.split("://", 1)[-1]
+    return _is_sqlite(url) and (":memory:" in path or "/" not in path)
+
+
+def engine_options(url: str, profile: str) -> dict:
+    """Keyword arguments for create_engine/create_async_engine."""
+    if profile not in ("basic", "tuned"):
+        raise ValueError(f"Unknown DB_PROFILE: {profile}")
+    options = {}
+    if _is_sqlite(url) and not url.startswith("sqlite+aiosqlite"):
+        options["connect_args"] = {"check_same_thread": False}
+    if profile == "basic" or _is_sqlite_memory(url):
+        return options
+    options.update(
+        pool_pre_ping=True,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+    )
+    if not _is_sqlite(url):
+        # Drop server connections before PostgreSQL/proxies time them out
+        options["pool_recycle"] = DB_POOL_RECYCLE
+    return options
+
+
+def apply_sqlite_pragmas(sync_engine, pragmas: dict) -> None:
+    """Runs ``PRAGMA name=value`` on every new DBAPI connection."""
+
+    @event.listens_for(sync_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+
+def create_db_engine(url: str = SQLALCHEMY_DATABASE_URL, profile: str = DB_PROFILE):
+    db_engine = create_engine(url, **engine_options(url, profile))
+    if _is_sqlite(url) and profile == "tuned":
+        apply_sqlite_pragmas(db_engine, SQLITE_TUNED_PRAGMAS)
+    return db_engine
+
+
+def create_async_db_engine(url: str, profile: str = DB_PROFILE):
+    db_engine = create_async_engine(url, **engine_options(url, profile))
+    if _is_sqlite(url) and profile == "tuned":
+        apply_sqlite_pragmas(db_engine.sync_engine, SQLITE_TUNED_PRAGMAS)
+    return db_engine
+
+
+# Used by the Socket.IO handlers; override to pick another async driver
+ASYNC_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_URL", to_async_url(SQLALCHEMY_DATABASE_URL)
 )
 
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine/sessions so socket handlers don't block the event loop.
+# expire_on_commit=False: attributes stay readable after commit without
+# an implicit (and in asyncio, forbidden) lazy refresh.
+async_engine = create_async_db_engine(ASYNC_DATABASE_URL)
+
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
 Base = declarative_base()
 
 
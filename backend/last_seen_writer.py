@@ -0,0 +1,107 @@
+import asyncio
+import os
+from datetime import datetime
+from sqlalchemy import bindparam
+from .database import AsyncSessionLocal
+from .models import User
+
+# How often the last-seen times collected in memory are written to users
+LAST_SEEN_FLUSH_INTERVAL_SECONDS = float(
+    os.getenv("LAST_SEEN_FLUSH_INTERVAL_SECONDS", "30")
+)
+
+users = User.__table__
+
+# Core statement so a batch runs as one executemany in a single transaction
+_set_last_seen = (
+    users.update()
+    .where(users.c.id == bindparam("user_id"))
+    .values(last_seen=bindparam("seen_at"))
+)
+
+
+class LastSeenWriter:
+    """Keeps users' last-seen times in memory and writes them periodically.
+
+    Connects and disconnects only record a timestamp; every interval the
+    latest time of each touched user is stored in one bulk UPDATE, so
+    connection churn costs one write transaction per interval instead of one
+    per event. Times not yet written are served by ``get``.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        interval: float = LAST_SEEN_FLUSH_INTERVAL_SECONDS,
+    ):
+        self.session_factory = session_factory
+        self.interval = interval
+        self._pending = {}  # user id -> last seen (utc)
+        self._task = None
+        self.touches = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    def touch(self, user_id, seen_at: datetime | None = None) -> None:
+        self.touches += 1
+        self._pending[user_id] = seen_at or datetime.utcnow()
+
+    def get(self, user_id):
+        """Last-seen time not yet written for ``user_id`` (or None)."""
+        return self._pending.get(user_id)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending_users": len(self._pending),
+            "touches": self.touches,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error writing last seen times: {e}")
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            async with self.session_factory() as db:
+                await db.execute(
+                    _set_last_seen,
+                    [
+                        {"user_id": user_id, "seen_at": seen_at}
+                        for user_id, seen_at in pending.items()
+                    ],
+                )
+                await db.commit()
+        except Exception:
+            # Retried with the next flush, unless a newer time came in since
+            for user_id, seen_at in pending.items():
+                self._pending.setdefault(user_id, seen_at)
+            raise
+        self.flushes += 1
+        self.rows_written += len(pending)
+
+
+# Shared writer used by the Socket.IO connect/disconnect handlers
+last_seen_writer = LastSeenWriter(AsyncSessionLocal)
@@ -1,14 +1,41 @@
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, HTTPException
 from fastapi.staticfiles import StaticFiles
-from .auth import router as auth_router, SECRET_KEY, ALGORITHM, create_initial_superadmin
-from .chat import router as chat_router
-from .ai_routes import router as ai_router
+from .auth import (
+    router as auth_router,
+    SECRET_KEY,
+    ALGORITHM,
+    create_initial_superadmin,
+    password_hasher,
+    user_cache,
+    user_cache_invalidator,
+    CachedUser,
+)
+from .chat import router as chat_router, conversation_members_query
+from .ai_routes import router as ai_router, stream_cached_ai_response
 from .admin_routes import router as admin_router
 
 # --- ADD THIS: Import Call model ---
-from .database import engine, Base, SessionLocal
-from .models import Message, User, ConversationParticipant, Call, Conversation
-from .ws_manager import sio, connected_users
+from .database import engine, Base, SessionLocal, AsyncSessionLocal
+from .models import Message, User, Call, Conversation
+from sqlalchemy import select
+from .ws_manager import (
+    sio,
+    connected_users,
+    presence,
+    connect_limiter,
+    join_rooms,
+    user_room,
+    emit_per_user,
+)
+from .message_pipeline import message_pipeline
+from .conversation_summaries import record_message_deleted, record_message_edited
+from .message_search import reindex_message
+from .chat_list_notifier import chat_list_notifier
+from .membership_cache import membership_cache
+from .presence_broadcaster import presence_broadcaster
+from .last_seen_writer import last_seen_writer
+from .admin_metrics import admin_metrics
+import asyncio
 import socketio
 from datetime import datetime
 from jose import JWTError, jwt
@@ -45,60 +72,54 @@ app.include_router(admin_router)
 # Mount Static Files (Typically after routers)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# --- Socket.IO Setup ---
-# Wrap the FastAPI app with the Socket.IO ASGIApp
-# Make sure this is done *after* all routes and middleware are added to 'app'
-socket_app = socketio.ASGIApp(sio, app)
 
+@app.on_event("startup")
+async def start_workers():
+    await message_pipeline.start()
+    await last_seen_writer.start()
+    await admin_metrics.start()
+    await user_cache_invalidator.start()
+    # A shared store also drops (and announces offline) the users of
+    # workers that stopped without shutting down
+    await presence.start(on_offline=presence_broadcaster.offline)
 
-# --- Helper to find SID by User ID ---
-def get_sid_by_user_id(user_id):
-    for sid, uid in connected_users.items():
-        if uid == user_id:
-            return sid
-    return None
 
+@app.on_event("shutdown")
+async def shutdown_workers():
+    # Commit any messages still waiting for a group commit
+    await message_pipeline.stop()
+    await chat_list_notifier.stop()
+    await presence_broadcaster.stop()
+    await last_seen_writer.stop()
+    await admin_metrics.stop()
+    await user_cache_invalidator.stop()
+    # Don't leave this worker's sockets behind in a shared presence store
+    await presence.stop()
+    password_hasher.shutdown()
 
-# --- Helper to update user's last seen time ---
-def update_user_last_seen(user_id):
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if user:
-            user.last_seen = datetime.utcnow()
-            db.commit()
-    except Exception as e:
-        print(f"Error updating last seen for user {user_id}: {e}")
-    finally:
-        db.close()
 
+# --- Socket.IO Setup ---
+# Wrap the FastAPI app with the Socket.IO ASGIApp
+# Make sure this is done *after* all routes and middleware are added to 'app'
+socket_app = socketio.ASGIApp(sio, app)
 
-# Add this helper function at the top level
-async def notify_chat_list_update(conversation_id, db):
-    """Helper function to notify all participants of a chat list update"""
-    try:
-        # Get all participants for this conversation
-        participants = (
-            db.query(ConversationParticipant)
-            .filter(ConversationParticipant.conversation_id == conversation_id)
-            .all()
-        )
-        
-        # Notify each participant
-        for participant in participants:
-            participant_sid = get_sid_by_user_id(participant.user_id)
-            if participant_sid:
-                await sio.emit('update_chat_list', {
-                    'conversation_id': conversation_id,
-                    'timestamp': datetime.utcnow().isoformat()
-                }, room=participant_sid)
-                print(f"Notified user {participant.user_id} about chat list update for conversation {conversation_id}")
-    except Exception as e:
-        print(f"Error notifying chat list update: {e}")
+
+# --- Helpers to find SIDs by User ID (across all workers) ---
+async def get_sid_by_user_id(user_id):
+    """Most recently connected socket of a user, for 1:1 call signaling."""
+    return await presence.latest_sid_for(user_id)
 
 
 @sio.event
 async def connect(sid, environ, auth=None):
+    # Admission control: during a reconnect storm refuse early with a retry
+    # hint rather than letting every handshake queue up
+    retry_after = connect_limiter.acquire()
+    if retry_after is not None:
+        raise socketio.exceptions.ConnectionRefusedError(
+            "Server busy, retry later", {"retry_after": retry_after}
+        )
+
     try:
         token = None
 
@@ -125,68 +146,58 @@ async def connect(sid, environ, auth=None):
             await sio.disconnect(sid)
             return False  # Explicitly return False for failed connection
 
-        # Validate token and get user
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            username = payload.get("sub")
-            if not username:
-                raise JWTError("Invalid token payload: Missing 'sub'")
-
-            db = SessionLocal()
+        # Validate token and get user (a reconnecting client usually hits
+        # the token cache shared with the REST routes)
+        user = user_cache.get(token)
+        if user is None:
             try:
-                user = db.query(User).filter(User.username == username).first()
-                if not user:
+                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+                username = payload.get("sub")
+                if not username:
+                    raise JWTError("Invalid token payload: Missing 'sub'")
+
+                async with AsyncSessionLocal() as db:
+                    db_user = await db.scalar(
+                        select(User).where(User.username == username)
+                    )
+                if not db_user:
                     # Avoid revealing specific errors like "User not found" to client
                     raise JWTError("Invalid token: User validation failed")
-
-                # Store user connection and update last seen
-                connected_users[sid] = user.id
-                user.last_seen = datetime.utcnow()
-                db.commit()
-                print(
-                    f"User {user.username} (ID: {user.id}) connected with socket ID: {sid}"
-                )
-
-                # Join user's conversations
-                conversations = (
-                    db.query(ConversationParticipant)
-                    .filter(ConversationParticipant.user_id == user.id)
-                    .all()
-                )
-                for conv_participant in conversations:
-                    room_name = str(conv_participant.conversation_id)
-                    await sio.enter_room(sid, room_name)
-                    print(f"User {user.username} (sid: {sid}) joined room {room_name}")
-
-                # Broadcast user's online status to their conversations
-                for conv in conversations:
-                    room_name = str(conv.conversation_id)
-                    await sio.emit(
-                        "user_status_change",
-                        {
-                            "user_id": user.id,
-                            "status": "online",
-                            "last_seen": None
-                        },
-                        room=room_name
-                    )
-
-                # Connection successful
-                return True  # Indicate successful connection
-
-            except (
-                Exception
-            ) as db_err:  # Catch potential DB errors during user/conv lookup
-                print(f"Database error during connection for {sid}: {db_err}")
+            except JWTError as e:
+                print(f"Token validation failed for {sid}: {str(e)}")
                 await sio.disconnect(sid)
-                return False
-            finally:
-                db.close()
+                return False  # Indicate failed connection
+            user = CachedUser.from_user(db_user)
+            user_cache.put(token, user, payload.get("exp"))
 
-        except JWTError as e:
-            print(f"Token validation failed for {sid}: {str(e)}")
+        try:
+            # Cached, and loaded in batches when many sockets connect at once
+            conversation_ids = await membership_cache.conversation_ids(user.id)
+        except Exception as db_err:  # Catch potential DB errors during lookup
+            print(f"Database error during connection for {sid}: {db_err}")
             await sio.disconnect(sid)
-            return False  # Indicate failed connection
+            return False
+
+        # Store user connection; last seen is written with the next batch
+        is_first_socket = await presence.add(sid, user.id)
+        last_seen_writer.touch(user.id)
+        print(f"User {user.username} (ID: {user.id}) connected with socket ID: {sid}")
+
+        # Join user's conversations and the personal room (one emit reaches
+        # all of the user's devices) in one go
+        await join_rooms(
+            sid,
+            [str(conversation_id) for conversation_id in conversation_ids]
+            + [user_room(user.id)],
+        )
+
+        # Announce the online status in the next presence batch; only for
+        # the first device, other tabs are already online
+        if is_first_socket:
+            presence_broadcaster.online(user.id)
+
+        # Connection successful
+        return True  # Indicate successful connection
 
     except Exception as e:
         # Catch-all for unexpected errors during connect logic
@@ -203,43 +214,23 @@ async def connect(sid, environ, auth=None):
 
 @sio.event
 async def disconnect(sid):
-    if sid in connected_users:
-        user_id = connected_users[sid]
-        print(f"User ID {user_id} disconnected: {sid}")
-        
-        # Update last seen time
-        update_user_last_seen(user_id)
-        
-        # Get user's conversations before removing from connected_users
-        db = SessionLocal()
-        try:
-            conversations = (
-                db.query(ConversationParticipant)
-                .filter(ConversationParticipant.user_id == user_id)
-                .all()
-            )
-            
-            # Broadcast user's offline status to their conversations
-            for conv in conversations:
-                room_name = str(conv.conversation_id)
-                await sio.emit(
-                    "user_status_change",
-                    {
-                        "user_id": user_id,
-                        "status": "offline",
-                        "last_seen": datetime.utcnow().isoformat()
-                    },
-                    room=room_name
-                )
-        except Exception as e:
-            print(f"Error broadcasting offline status for user {user_id}: {e}")
-        finally:
-            db.close()
-            
-        # Clean up user from connected_users map
-        del connected_users[sid]
-    else:
+    for task in ai_streams.pop(sid, {}).values():
+        task.cancel()
+
+    user_id, still_online = await presence.remove(sid)
+    if user_id is None:
         print(f"Unknown client disconnected: {sid}")
+        return
+
+    print(f"User ID {user_id} disconnected: {sid}")
+
+    # Other tabs/devices of this user are still connected
+    if still_online:
+        return
+
+    # Both are batched: the offline broadcast and the last seen write
+    last_seen_writer.touch(user_id)
+    presence_broadcaster.offline(user_id)
 
 
 @sio.event
@@ -295,88 +286,48 @@ async def message(sid, data):
         return
     # You might add length limits, sanitization, etc. here
 
-    # 5. Process and save the message
-    db = SessionLocal()
+    # 5. Process and save the message (committed now or group-committed,
+    # depending on the pipeline's durability mode)
     try:
-        # Create the new message
-        new_message = Message(
+        message_data, committed = await message_pipeline.submit(
             conversation_id=int(conversation_id),  # Ensure type consistency
             sender_id=user_id,  # Use the authenticated user_id
             content=content.strip(),  # Trim whitespace
-            timestamp=datetime.utcnow(),
             replied_to_id=(
                 int(replied_to_id) if replied_to_id is not None else None
             ),  # Ensure type consistency
         )
-
-        db.add(new_message)
-        db.commit()
-        db.refresh(new_message)
-        print(f"Message {new_message.id} saved for conversation {conversation_id}")
-
-        # 6. Prepare the message data to broadcast (Include sender username)
-        # Fetch sender username for broadcast payload
-        sender_username = (
-            db.query(User.username).filter(User.id == user_id).scalar() or "Unknown"
-        )
-
-        message_data = {
-            "id": new_message.id,
-            "conversation_id": new_message.conversation_id,
-            "sender_id": new_message.sender_id,
-            "sender_username": sender_username,  # Add username
-            "content": new_message.content,
-            "timestamp": new_message.timestamp.isoformat(),
-            "replied_to_id": new_message.replied_to_id,
-            "is_deleted": False,  # New messages are not deleted
-            "read_at": None,  # New messages are not read yet
-        }
-
-        # Add reply info if this is a reply
-        if new_message.replied_to_id:
-            # Query replied message and its sender's username in one go
-            replied_info = (
-                db.query(
-                    Message.content,
-                    Message.sender_id,
-                    Message.is_deleted,
-                    User.username,
-                )
-                .join(User, Message.sender_id == User.id)
-                .filter(Message.id == new_message.replied_to_id)
-                .first()
-            )
-
-            if replied_info:
-                (
-                    replied_content,
-                    replied_sender_id,
-                    replied_is_deleted,
-                    replied_username,
-                ) = replied_info
-                message_data["replied_to_content"] = (
-                    replied_content if not replied_is_deleted else "[Message deleted]"
-                )
-                message_data["replied_to_sender"] = replied_sender_id
-                message_data["replied_to_username"] = (
-                    replied_username  # Add replied username
-                )
-
-        # 7. Broadcast to the conversation room
-        room_name = str(conversation_id)
-        await sio.emit("message", message_data, room=room_name)
-        print(f"Message {new_message.id} broadcasted to room {room_name}")
-
-        # Notify all participants to update their chat lists
-        await notify_chat_list_update(conversation_id, db)
-
     except Exception as e:
         print(f"Error processing message from {sid}: {e}")
-        db.rollback()
-        # Optionally notify the sender of the error
-        # await sio.emit('error', {'message': 'Failed to send message'}, room=sid)
-    finally:
-        db.close()
+        return {"status": "error", "message": "Failed to send message"}
+    message_id = message_data["id"]
+    print(f"Message {message_id} accepted for conversation {conversation_id}")
+
+    # 6. Broadcast to the conversation room
+    room_name = str(conversation_id)
+    await sio.emit("message", message_data, room=room_name)
+    print(f"Message {message_id} broadcasted to room {room_name}")
+
+    # 7. Acknowledge to the sender once the message is durable
+    ack = {
+        "message_id": message_id,
+        "conversation_id": message_data["conversation_id"],
+        "client_id": data.get("client_id"),
+    }
+    if await committed:
+        ack["status"] = "success"
+        # Participants' chat lists are patched from the updated summary
+        chat_list_notifier.invalidate(message_data["conversation_id"])
+    else:
+        ack.update(status="error", message="Failed to save message")
+        # Already broadcast, so take it back from everyone's view
+        await sio.emit(
+            "message_deleted",
+            {"message_id": message_id, "conversation_id": ack["conversation_id"]},
+            room=room_name,
+        )
+    await sio.emit("message_ack", ack, room=sid)
+    return ack  # Also delivered to the client's emit callback
 
 
 # --- Message Deletion via WebSocket ---
@@ -404,10 +355,13 @@ async def delete_message(sid, data):
         print(f"Invalid message_id format for delete from {sid}: {message_id}")
         return
 
-    db = SessionLocal()
+    # The message may still be queued for its group commit
+    await message_pipeline.wait_committed(message_id)
+
+    db = AsyncSessionLocal()
     try:
         # Fetch the message to be deleted
-        message = db.query(Message).filter(Message.id == message_id).first()
+        message = await db.get(Message, message_id)
 
         if not message:
             print(f"Delete attempt by {sid}: Message {message_id} not found")
@@ -429,7 +383,9 @@ async def delete_message(sid, data):
 
         # Mark as deleted
         message.is_deleted = True
-        db.commit()
+        await record_message_deleted(db, message)
+        await reindex_message(db, message)
+        await db.commit()
         print(f"Message {message_id} marked as deleted by user {user_id} (sid: {sid})")
 
         # Notify clients in the conversation room
@@ -442,14 +398,14 @@ async def delete_message(sid, data):
         print(f"Delete notification for message {message_id} sent to room {room_name}")
 
         # Notify all participants to update their chat lists
-        await notify_chat_list_update(message.conversation_id, db)
+        chat_list_notifier.invalidate(message.conversation_id)
 
     except Exception as e:
         print(f"Error deleting message {message_id} requested by {sid}: {e}")
-        db.rollback()
+        await db.rollback()
         # await sio.emit('error', {'message': 'Failed to delete message'}, room=sid)
     finally:
-        db.close()
+        await db.close()
 
 
 # --- Message Editing via WebSocket ---
@@ -486,10 +442,13 @@ async def edit_message(sid, data):
         print(f"Invalid message_id format for edit from {sid}: {message_id}")
         return
 
-    db = SessionLocal()
+    # The message may still be queued for its group commit
+    await message_pipeline.wait_committed(message_id)
+
+    db = AsyncSessionLocal()
     try:
         # Fetch the message
-        message = db.query(Message).filter(Message.id == message_id).first()
+        message = await db.get(Message, message_id)
 
         if not message:
             print(f"Edit attempt by {sid}: Message {message_id} not found")
@@ -518,7 +477,9 @@ async def edit_message(sid, data):
 
         # Update content
         message.content = new_content.strip()
-        db.commit()
+        await record_message_edited(db, message)
+        await reindex_message(db, message)
+        await db.commit()
         print(f"Message {message_id} edited by user {user_id} (sid: {sid})")
 
         # Notify clients in the room
@@ -535,14 +496,14 @@ async def edit_message(sid, data):
         print(f"Edit notification for message {message_id} sent to room {room_name}")
 
         # Notify all participants to update their chat lists
-        await notify_chat_list_update(message.conversation_id, db)
+        chat_list_notifier.invalidate(message.conversation_id)
 
     except Exception as e:
         print(f"Error editing message {message_id} requested by {sid}: {e}")
-        db.rollback()
+        await db.rollback()
         # await sio.emit('error', {'message': 'Failed to edit message'}, room=sid)
     finally:
-        db.close()
+        await db.close()
 
 
 # --- Room Management (Optional but good practice) ---
@@ -585,6 +546,96 @@ async def leave_conversation(sid, data):  # Renamed for clarity
     )
 
 
+# --- Streamed AI responses ---
+# sid -> {request id: task streaming the response}
+ai_streams = {}
+
+
+async def run_ai_stream(sid, user_id, request_id, kind, text, target_language):
+    parts = []
+    chunks = stream_cached_ai_response(kind, text, target_language, user_id=user_id)
+    try:
+        async for delta in chunks:
+            parts.append(delta)
+            await sio.emit(
+                "ai_stream_chunk", {"request_id": request_id, "delta": delta}, room=sid
+            )
+        await sio.emit(
+            "ai_stream_done",
+            {"request_id": request_id, "result": "".join(parts).strip()},
+            room=sid,
+        )
+    except HTTPException as e:
+        await sio.emit(
+            "ai_stream_error",
+            {"request_id": request_id, "status": e.status_code, "detail": e.detail},
+            room=sid,
+        )
+    except asyncio.CancelledError:
+        pass  # Cancelled by the client or its disconnect
+    except Exception as e:
+        # The task has no caller to report to; the client must still hear
+        print(f"Error streaming AI response {request_id} for {sid}: {e}")
+        await sio.emit(
+            "ai_stream_error",
+            {
+                "request_id": request_id,
+                "status": 500,
+                "detail": "AI failed to generate a response.",
+            },
+            room=sid,
+        )
+    finally:
+        await chunks.aclose()
+        streams = ai_streams.get(sid)
+        if streams is not None:
+            streams.pop(request_id, None)
+            if not streams:
+                del ai_streams[sid]
+
+
+@sio.event
+async def ai_stream(sid, data):
+    """Streams an AI response back as ``ai_stream_chunk`` events.
+
+    ``data``: ``request_id``, ``kind`` (fix-grammar, complete-sentence or
+    translate), ``text`` and, for translations, ``target_language``.
+    """
+    if sid not in connected_users:
+        print(f"Unauthorized AI stream attempt from {sid}")
+        return
+
+    if not isinstance(data, dict) or not all(
+        k in data for k in ("request_id", "kind", "text")
+    ):
+        print(f"Invalid ai_stream data from {sid}")
+        return
+
+    request_id = data["request_id"]
+    streams = ai_streams.setdefault(sid, {})
+    if request_id in streams:
+        return
+    streams[request_id] = asyncio.ensure_future(
+        run_ai_stream(
+            sid,
+            connected_users[sid],
+            request_id,
+            data["kind"],
+            str(data["text"]),
+            data.get("target_language"),
+        )
+    )
+
+
+@sio.event
+async def ai_stream_cancel(sid, data):
+    if not isinstance(data, dict) or "request_id" not in data:
+        return
+    task = ai_streams.get(sid, {}).get(data["request_id"])
+    if task is not None:
+        task.cancel()
+
+
 # --- WebRTC Signaling Handlers ---
 
 
@@ -598,24 +649,24 @@ async def call_request(sid, data):
     if not callee_id:
         return print(f"call_request from {sid} missing callee_id")
 
-    callee_sid = get_sid_by_user_id(callee_id)
+    callee_sid = await get_sid_by_user_id(callee_id)
     if not callee_sid:
         print(f"User {callee_id} not online for call request from {caller_id}")
         await sio.emit("call_unavailable", {"callee_id": callee_id}, room=sid)
         return
 
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
-        caller = db.query(User).filter(User.id == caller_id).first()
-        callee = db.query(User).filter(User.id == callee_id).first()
+        caller = await db.get(User, caller_id)
+        callee = await db.get(User, int(callee_id))
         if not caller or not callee:
             raise Exception("Caller or Callee not found in DB")
 
         # Create a call record
-        new_call = Call(caller_id=caller_id, callee_id=callee_id, status="initiated")
+        new_call = Call(caller_id=caller_id, callee_id=callee.id, status="initiated")
         db.add(new_call)
-        db.commit()
-        db.refresh(new_call)
+        await db.commit()
+        await db.refresh(new_call)
 
         print(
             f"Relaying call request from {caller.username} ({sid}) to {callee.username} ({callee_sid})"
@@ -631,10 +682,10 @@ async def call_request(sid, data):
         )
     except Exception as e:
         print(f"Error processing call_request from {sid}: {e}")
-        db.rollback()
+        await db.rollback()
         await sio.emit("call_error", {"message": "Failed to initiate call"}, room=sid)
     finally:
-        db.close()
+        await db.close()
 
 
 @sio.event
@@ -650,22 +701,22 @@ async def call_response(sid, data):
     if not caller_id or not response or not call_id:
         return print(f"call_response from {sid} missing data")
 
-    caller_sid = get_sid_by_user_id(caller_id)
+    caller_sid = await get_sid_by_user_id(caller_id)
     if not caller_sid:
         print(f"Caller {caller_id} not online for call response from {callee_id}")
         # Optionally update call status in DB to 'missed' or similar
         return
 
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
-        call = db.query(Call).filter(Call.id == call_id).first()
+        call = await db.get(Call, call_id)
         if not call or call.callee_id != callee_id or call.caller_id != caller_id:
             raise Exception("Invalid call record for response")
 
         call.status = response  # Update status to 'accepted' or 'rejected'
         if response == "rejected":
             call.end_time = datetime.utcnow()
-        db.commit()
+        await db.commit()
 
         print(
             f"Relaying call response '{response}' from {callee_id} to {caller_id} ({caller_sid})"
@@ -677,10 +728,10 @@ async def call_response(sid, data):
         )
     except Exception as e:
         print(f"Error processing call_response from {sid}: {e}")
-        db.rollback()
+        await db.rollback()
         # Notify both parties of error?
     finally:
-        db.close()
+        await db.close()
 
 
 @sio.event
@@ -696,7 +747,7 @@ async def webrtc_signal(sid, data):
     if not target_id or not signal_type or signal_data is None:
         return print(f"webrtc_signal from {sid} missing data")
 
-    target_sid = get_sid_by_user_id(target_id)
+    target_sid = await get_sid_by_user_id(target_id)
     if not target_sid:
         print(f"Target user {target_id} not online for WebRTC signal from {sender_id}")
         # Maybe notify sender that target is offline?
@@ -728,17 +779,17 @@ async def hang_up(sid, data):
     if not target_id or not call_id:
         return print(f"hang_up from {sid} missing target_id or call_id")
 
-    target_sid = get_sid_by_user_id(target_id)
+    target_sid = await get_sid_by_user_id(target_id)
 
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
-        call = db.query(Call).filter(Call.id == call_id).first()
+        call = await db.get(Call, call_id)
         if call and call.status not in ["ended", "rejected", "missed"]:
             # Ensure the user hanging up is part of the call
             if call.caller_id == user_id or call.callee_id == user_id:
                 call.status = "ended"
                 call.end_time = datetime.utcnow()
-                db.commit()
+                await db.commit()
                 print(f"Call {call_id} ended by user {user_id}")
 
                 # Notify the other user if they are online
@@ -760,9 +811,9 @@ async def hang_up(sid, data):
 
     except Exception as e:
         print(f"Error processing hang_up for call {call_id} from {sid}: {e}")
-        db.rollback()
+        await db.rollback()
     finally:
-        db.close()
+        await db.close()
 
 
 @sio.event
@@ -779,21 +830,18 @@ async def new_conversation(sid, data):
         print(f"Invalid new_conversation data from {sid}")
         return
 
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Get conversation details including name and participants
-        conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+        conversation = await db.get(Conversation, conversation_id)
         if not conversation:
             print(f"Conversation {conversation_id} not found")
             return
 
         # Get participant details
         participants = (
-            db.query(User)
-            .join(ConversationParticipant)
-            .filter(ConversationParticipant.conversation_id == conversation_id)
-            .all()
-        )
+            await db.scalars(conversation_members_query(conversation_id))
+        ).all()
 
         # Create participant details list
         participant_details = [
@@ -801,41 +849,38 @@ async def new_conversation(sid, data):
             for p in participants
         ]
 
-        # Notify all participants about the new conversation
+        # Notify all participants about the new conversation; participants
+        # with the same view of it share one multi-room emit
+        created_by_user = {}
         for participant_id in participant_ids:
-            participant_sid = get_sid_by_user_id(participant_id)
-            if participant_sid:
-                # Get the other participant's name for 1-on-1 chats
-                other_participant = next(
-                    (p for p in participants if p.id != participant_id),
-                    None
-                )
-                conversation_name = (
-                    other_participant.username
-                    if len(participants) == 2 and not conversation.name
-                    else conversation.name
-                )
-
-                await sio.emit("conversation_created", {
-                    "conversation_id": conversation_id,
-                    "is_creator": participant_id == user_id,
-                    "creator_id": user_id,
-                    "name": conversation_name,
-                    "participant_details": participant_details,
-                    "is_group": len(participants) > 2
-                }, room=participant_sid)
-                print(f"Notified user {participant_id} about new conversation {conversation_id}")
-
-                # Also emit a chat list update
-                await sio.emit('update_chat_list', {
-                    'conversation_id': conversation_id,
-                    'timestamp': datetime.utcnow().isoformat()
-                }, room=participant_sid)
+            # Get the other participant's name for 1-on-1 chats
+            other_participant = next(
+                (p for p in participants if p.id != participant_id),
+                None
+            )
+            conversation_name = (
+                other_participant.username
+                if len(participants) == 2 and not conversation.name
+                else conversation.name
+            )
+            created_by_user[participant_id] = {
+                "conversation_id": conversation_id,
+                "is_creator": participant_id == user_id,
+                "creator_id": user_id,
+                "name": conversation_name,
+                "participant_details": participant_details,
+                "is_group": len(participants) > 2
+            }
+        await emit_per_user("conversation_created", created_by_user)
+        print(f"Notified {len(created_by_user)} users about new conversation {conversation_id}")
+
+        # Also schedule a chat list update
+        chat_list_notifier.invalidate(conversation_id)
 
     except Exception as e:
         print(f"Error in new_conversation handler: {e}")
     finally:
-        db.close()
+        await db.close()
 
 
 # --- Main Execution ---
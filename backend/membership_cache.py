@@ -0,0 +1,112 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from sqlalchemy import select
+from .database import AsyncSessionLocal
+from .models import ConversationParticipant
+
+MEMBERSHIP_CACHE_TTL_SECONDS = int(os.getenv("MEMBERSHIP_CACHE_TTL_SECONDS", "300"))
+MEMBERSHIP_CACHE_MAX_ENTRIES = int(os.getenv("MEMBERSHIP_CACHE_MAX_ENTRIES", "50000"))
+
+
+class MembershipCache:
+    """Conversation ids of each user, for joining rooms on (re)connect.
+
+    Misses that arrive in the same event-loop tick are loaded together with a
+    single ``user_id IN (...)`` query, so a reconnect storm costs a handful
+    of queries instead of one per socket. Entries expire after the TTL and
+    are dropped when a user is added to a conversation (other workers pick
+    the change up when their entry expires; clients also join new
+    conversations explicitly).
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        ttl_seconds: float = MEMBERSHIP_CACHE_TTL_SECONDS,
+        max_entries: int = MEMBERSHIP_CACHE_MAX_ENTRIES,
+    ):
+        self.session_factory = session_factory
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user id -> (expires_at, conversation ids)
+        self._waiting = {}  # user id -> future, for the next batched load
+        self._loader = None
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    async def conversation_ids(self, user_id) -> tuple:
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        future = self._waiting.get(user_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._waiting[user_id] = future
+            if self._loader is None or self._loader.done():
+                self._loader = asyncio.ensure_future(self._load_waiting())
+        return await asyncio.shield(future)
+
+    def invalidate(self, *user_ids) -> None:
+        for user_id in user_ids:
+            self._entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "batched_loads": self.loads,
+        }
+
+    async def _load_waiting(self) -> None:
+        await asyncio.sleep(0)  # let the rest of this tick's misses queue up
+        while self._waiting:
+            waiting, self._waiting = self._waiting, {}
+            try:
+                conversation_ids = await self._load(list(waiting))
+            except Exception as e:
+                for future in waiting.values():
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            expires_at = time.monotonic() + self.ttl_seconds
+            for user_id, future in waiting.items():
+                ids = conversation_ids.get(user_id, ())
+                self._entries[user_id] = (expires_at, ids)
+                self._entries.move_to_end(user_id)
+                if not future.done():
+                    future.set_result(ids)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def _load(self, user_ids) -> dict:
+        self.loads += 1
+        async with self.session_factory() as db:
+            rows = (
+                await db.execute(
+                    select(
+                        ConversationParticipant.user_id,
+                        ConversationParticipant.conversation_id,
+                    ).where(ConversationParticipant.user_id.in_(user_ids))
+                )
+            ).all()
+        conversation_ids = {}
+        for user_id, conversation_id in rows:
+            conversation_ids.setdefault(user_id, []).append(conversation_id)
+        return {user_id: tuple(ids) for user_id, ids in conversation_ids.items()}
+
+
+# Shared cache used by the Socket.IO connect/disconnect handlers
+membership_cache = MembershipCache(AsyncSessionLocal)
@@ -0,0 +1,272 @@
+import asyncio
+import os
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import func, insert, select
+from .admin_metrics import admin_metrics
+from .conversation_summaries import record_messages
+from .message_search import index_messages
+from .database import AsyncSessionLocal
+from .models import Message, User
+
+# "sync": every message is committed before it is broadcast (default).
+# "batched": messages get an id/timestamp immediately, are broadcast right
+# away and are group-committed in small batches (single writer process only:
+# ids are allocated in memory).
+MESSAGE_DURABILITY = os.getenv("MESSAGE_DURABILITY", "sync")
+MESSAGE_BATCH_MAX_SIZE = int(os.getenv("MESSAGE_BATCH_MAX_SIZE", "200"))
+MESSAGE_BATCH_MAX_DELAY_MS = int(os.getenv("MESSAGE_BATCH_MAX_DELAY_MS", "20"))
+# Sender usernames kept for broadcast payloads (least recently used evicted)
+MESSAGE_USERNAME_CACHE_SIZE = int(os.getenv("MESSAGE_USERNAME_CACHE_SIZE", "10000"))
+
+
+class MessagePipeline:
+    """Ingests chat messages and persists them according to the durability mode.
+
+    ``submit`` returns the broadcast payload together with a future that
+    resolves to True once the message is committed (False if it could not be
+    stored), so callers can broadcast first and acknowledge on durability.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        mode: str = MESSAGE_DURABILITY,
+        max_batch_size: int = MESSAGE_BATCH_MAX_SIZE,
+        max_delay: float = MESSAGE_BATCH_MAX_DELAY_MS / 1000,
+        max_usernames: int = MESSAGE_USERNAME_CACHE_SIZE,
+    ):
+        if mode not in ("sync", "batched"):
+            raise ValueError(f"Unknown message durability mode: {mode}")
+        self.session_factory = session_factory
+        self.mode = mode
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_usernames = max_usernames
+        self._queue = []  # (row, future) waiting for the next group commit
+        self._pending = {}  # message id -> (row, future) until committed
+        self._usernames = OrderedDict()  # user id -> username lookup (LRU)
+        self._next_id = None
+        self._has_work = None
+        self._batch_full = None
+        self._flusher = None
+        self.committed = 0
+        self.failed = 0
+        self.batches = 0
+
+    @property
+    def batched(self) -> bool:
+        return self.mode == "batched"
+
+    async def start(self) -> None:
+        if not self.batched or self._flusher is not None:
+            return
+        async with self.session_factory() as db:
+            self._next_id = (await db.scalar(select(func.max(Message.id)))) or 0
+        self._has_work = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._flusher is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+        await self.flush()
+
+    async def submit(self, conversation_id, sender_id, content, replied_to_id=None):
+        """Stores a new message; returns ``(message_data, committed_future)``."""
+        row = {
+            "conversation_id": conversation_id,
+            "sender_id": sender_id,
+            "content": content,
+            "timestamp": datetime.utcnow(),
+            "replied_to_id": replied_to_id,
+            "is_deleted": False,
+        }
+        committed = asyncio.get_running_loop().create_future()
+
+        if self.batched:
+            self._next_id += 1
+            row["id"] = self._next_id
+            self._pending[row["id"]] = (row, committed)
+            self._queue.append((row, committed))
+            self._has_work.set()
+            if len(self._queue) >= self.max_batch_size:
+                self._batch_full.set()
+        else:
+            async with self.session_factory() as db:
+                result = await db.execute(insert(Message).values(**row))
+                row["id"] = result.inserted_primary_key[0]
+                await record_messages(db, [row])
+                await index_messages(db, [row])
+                await db.commit()
+            self.committed += 1
+            admin_metrics.messages_stored([row])
+            committed.set_result(True)
+
+        return await self._payload(row), committed
+
+    async def wait_committed(self, message_id) -> None:
+        """Waits until ``message_id`` is written, if it is still queued."""
+        entry = self._pending.get(message_id)
+        if entry is not None:
+            await asyncio.shield(entry[1])
+
+    async def flush(self) -> None:
+        """Commits everything queued so far."""
+        while self._queue:
+            batch = self._queue[: self.max_batch_size]
+            del self._queue[: self.max_batch_size]
+            await self._write_batch(batch)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "queued": len(self._queue),
+            "committed": self.committed,
+            "failed": self.failed,
+            "batches": self.batches,
+            "cached_usernames": len(self._usernames),
+        }
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_work.wait()
+            # Give the batch up to max_delay to fill before committing it
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._has_work.clear()
+            self._batch_full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing message batch: {e}")
+
+    async def _write_batch(self, batch) -> None:
+        rows = [row for row, _ in batch]
+        results = [False] * len(batch)
+        try:
+            async with self.session_factory() as db:
+                try:
+                    await db.execute(insert(Message), rows)
+                    await record_messages(db, rows)
+                    await index_messages(db, rows)
+                    await db.commit()
+                    results = [True] * len(batch)
+                except Exception as e:
+                    print(
+                        f"Group commit of {len(batch)} messages failed, "
+                        f"retrying one by one: {e}"
+                    )
+                    await db.rollback()
+                    # Isolate the bad row(s) so the rest of the batch survives
+                    for i, row in enumerate(rows):
+                        try:
+                            await db.execute(insert(Message).values(**row))
+                            await record_messages(db, [row])
+                            await index_messages(db, [row])
+                            await db.commit()
+                            results[i] = True
+                        except Exception as row_err:
+                            print(f"Error saving message {row['id']}: {row_err}")
+                            await db.rollback()
+        except Exception as e:
+            print(f"Error opening session for message batch: {e}")
+
+        self.batches += 1
+        admin_metrics.messages_stored([row for row, ok in zip(rows, results) if ok])
+        for (row, future), ok in zip(batch, results):
+            self._pending.pop(row["id"], None)
+            if ok:
+                self.committed += 1
+            else:
+                self.failed += 1
+            if not future.done():
+                future.set_result(ok)
+
+    async def _username(self, user_id):
+        """Sender usernames never change, so each is looked up once while it is
+        among the ``max_usernames`` most recently used."""
+        lookup = self._usernames.get(user_id)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._load_username(user_id))
+            self._usernames[user_id] = lookup
+            while len(self._usernames) > self.max_usernames:
+                self._usernames.popitem(last=False)
+        else:
+            self._usernames.move_to_end(user_id)
+        username = await asyncio.shield(lookup)
+        if username is None:
+            if self._usernames.get(user_id) is lookup:
+                del self._usernames[user_id]
+        return username
+
+    async def _load_username(self, user_id):
+        async with self.session_factory() as db:
+            return await db.scalar(select(User.username).where(User.id == user_id))
+
+    async def _payload(self, row) -> dict:
+        """Builds the broadcast payload (sender username and reply preview)."""
+        message_data = {
+            "id": row["id"],
+            "conversation_id": row["conversation_id"],
+            "sender_id": row["sender_id"],
+            "sender_username": await self._username(row["sender_id"]) or "Unknown",
+            "content": row["content"],
+            "timestamp": row["timestamp"].isoformat(),
+            "replied_to_id": row["replied_to_id"],
+            "is_deleted": False,  # New messages are not deleted
+            "read_at": None,  # New messages are not read yet
+        }
+        if not row["replied_to_id"]:
+            return message_data
+
+        # The replied message may still be waiting for its group commit
+        pending = self._pending.get(row["replied_to_id"])
+        if pending is not None:
+            replied = pending[0]
+            replied_info = (
+                replied["content"],
+                replied["sender_id"],
+                replied["is_deleted"],
+                await self._username(replied["sender_id"]),
+            )
+        else:
+            async with self.session_factory() as db:
+                replied_info = (
+                    await db.execute(
+                        select(
+                            Message.content,
+                            Message.sender_id,
+                            Message.is_deleted,
+                            User.username,
+                        )
+                        .join(User, Message.sender_id == User.id)
+                        .where(Message.id == row["replied_to_id"])
+                    )
+                ).first()
+
+        if replied_info:
+            (
+                replied_content,
+                replied_sender_id,
+                replied_is_deleted,
+                replied_username,
+            ) = replied_info
+            message_data["replied_to_content"] = (
+                replied_content if not replied_is_deleted else "[Message deleted]"
+            )
+            message_data["replied_to_sender"] = replied_sender_id
+            message_data["replied_to_username"] = replied_username
+        return message_data
+
+
+# Shared pipeline used by the Socket.IO message handler
+message_pipeline = MessagePipeline(AsyncSessionLocal)
@@ -0,0 +1,214 @@
+"""Full-text search over message history.
+
+``messages_fts`` (an SQLite FTS5 table, see migrate_db.py) indexes the
+content of every message that isn't deleted, with the message id as rowid
+and its conversation as a ``c<id>`` token in the ``scope`` column, so
+searches limited to a user's conversations are answered inside the index.
+It is updated in the same transaction as the message writes. Rebuild it
+from the messages table with:
+
+    python -m backend.message_search
+"""
+
+import html
+import re
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, text
+
+from .migrate_db import MESSAGE_SEARCH_DDL, SEARCH_REBUILD_STATEMENTS
+
+# Not part of Base.metadata: the virtual table is created by its own DDL
+messages_fts = Table(
+    "messages_fts",
+    MetaData(),
+    Column("rowid", Integer, primary_key=True),
+    Column("content", String),
+    Column("scope", String),
+    Column("conversation_id", Integer),
+)
+
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 100
+MAX_QUERY_TERMS = 16
+
+# Up to this many conversations are matched as scope tokens in the FTS query;
+# beyond that a long OR costs more than filtering the matches by conversation
+MAX_SCOPE_TOKENS = 100
+
+# Private-use characters mark the matches in snippets until they are escaped
+_MATCH_START, _MATCH_END = "\ue000", "\ue001"
+
+# Only the content column counts towards the BM25 score
+_SEARCH = """
+    SELECT m.id, m.conversation_id, m.sender_id, u.username, m.timestamp,
+           snippet(messages_fts, 0, :match_start, :match_end, '…', 12) AS snippet,
+           bm25(messages_fts, 1.0, 0.0) AS score
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    LEFT JOIN users u ON u.id = m.sender_id
+    WHERE messages_fts MATCH :query {filter}
+    ORDER BY score, m.id DESC
+    LIMIT :limit OFFSET :offset
+"""
+
+
+def is_indexed(db) -> bool:
+    """Whether ``db`` (a sync or async session) has the FTS5 index."""
+    return db.get_bind().dialect.name == "sqlite"
+
+
+async def index_messages(db, rows) -> None:
+    """Adds newly inserted message ``rows`` (dicts with their ids) to the index."""
+    entries = [
+        {
+            "rowid": row["id"],
+            "content": row["content"],
+            "scope": f"c{row['conversation_id']}",
+            "conversation_id": row["conversation_id"],
+        }
+        for row in rows
+        if row["content"] and not row["is_deleted"]
+    ]
+    if entries and is_indexed(db):
+        await db.execute(messages_fts.insert(), entries)
+
+
+def reindex_statements(db, message) -> list:
+    """Statements updating ``message``'s entry after an edit or delete.
+
+    Returned rather than executed so sync and async sessions can share them.
+    """
+    if not is_indexed(db):
+        return []
+    statements = [messages_fts.delete().where(messages_fts.c.rowid == message.id)]
+    if message.content and not message.is_deleted:
+        statements.append(
+            messages_fts.insert().values(
+                rowid=message.id,
+                content=message.content,
+                scope=f"c{message.conversation_id}",
+                conversation_id=message.conversation_id,
+            )
+        )
+    return statements
+
+
+async def reindex_message(db, message) -> None:
+    for statement in reindex_statements(db, message):
+        await db.execute(statement)
+
+
+def fts_query(query: str, conversation_ids=None) -> str | None:
+    """An FTS5 query matching all words of ``query``, the last one as a prefix.
+
+    Words are quoted, so FTS5 operators and punctuation typed by the user
+    are matched literally instead of raising syntax errors. With
+    ``conversation_ids`` only messages of those conversations match.
+    """
+    terms = re.findall(r"\w+", query.lower())[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"  # search as you type
+    match = f"content : ({' '.join(quoted)})"
+    if conversation_ids is not None:
+        scopes = " OR ".join(f'"c{int(cid)}"' for cid in conversation_ids)
+        match += f" AND scope : ({scopes})"
+    return match
+
+
+def highlight(snippet: str) -> str:
+    """HTML-escapes a snippet and wraps its matches in ``<mark>``."""
+    return (
+        html.escape(snippet)
+        .replace(_MATCH_START, "<mark>")
+        .replace(_MATCH_END, "</mark>")
+    )
+
+
+def search_messages(
+    db,
+    user_id: int,
+    query: str,
+    conversation_id: int | None = None,
+    limit: int = SEARCH_PAGE_DEFAULT,
+    offset: int = 0,
+) -> dict:
+    """Best matches for ``query`` among the messages ``user_id`` can see.
+
+    Ranked by BM25 relevance, then newest first. Only conversations the
+    user participates in are searched (just ``conversation_id`` if given).
+    Returns ``{"results": [...], "next_offset": int or None}``.
+    """
+    no_results = {"results": [], "next_offset": None}
+    conversation_ids = db.execute(
+        text(
+            "SELECT conversation_id FROM conversation_participants "
+            "WHERE user_id = :user_id"
+        ),
+        {"user_id": user_id},
+    ).scalars().all()
+    if conversation_id is not None:
+        conversation_ids = [cid for cid in conversation_ids if cid == conversation_id]
+    if not conversation_ids:
+        return no_results
+
+    params = {
+        "user_id": user_id,
+        "match_start": _MATCH_START,
+        "match_end": _MATCH_END,
+        "limit": limit + 1,  # one more tells whether there is a next page
+        "offset": offset,
+    }
+    if len(conversation_ids) <= MAX_SCOPE_TOKENS:
+        match = fts_query(query, conversation_ids)
+        conversation_filter = ""
+    else:
+        match = fts_query(query)
+        conversation_filter = (
+            "AND messages_fts.conversation_id IN (SELECT conversation_id "
+            "FROM conversation_participants WHERE user_id = :user_id)"
+        )
+    if match is None:
+        return no_results
+    params["query"] = match
+
+    statement = text(_SEARCH.format(filter=conversation_filter)).columns(
+        timestamp=DateTime
+    )
+    rows = db.execute(statement, params).all()
+    results = [
+        {
+            "message_id": row.id,
+            "conversation_id": row.conversation_id,
+            "sender_id": row.sender_id,
+            "sender_username": row.username,
+            "timestamp": row.timestamp.isoformat(),
+            "snippet": highlight(row.snippet),
+            "score": row.score,
+        }
+        for row in rows[:limit]
+    ]
+    return {
+        "results": results,
+        "next_offset": offset + limit if len(rows) > limit else None,
+    }
+
+
+def rebuild_search_index(db) -> None:
+    """Refills the search index from the messages table."""
+    db.execute(text(MESSAGE_SEARCH_DDL))
+    for statement in SEARCH_REBUILD_STATEMENTS:
+        db.execute(text(statement))
+    db.commit()
+
+
+if __name__ == "__main__":
+    from .database import Base, SessionLocal, engine
+
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        rebuild_search_index(session)
+        print("Message search index rebuilt.")
+    finally:
+        session.close()
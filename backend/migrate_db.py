@@ -3,6 +3,58 @@ from datetime import datetime
 
 DB_PATH = "./talkflowchat.db"
 
+# Recomputes conversation_summaries and unread counts from the messages table
+# (also used by `python -m backend.conversation_summaries`)
+SUMMARY_REBUILD_STATEMENTS = (
+    "DELETE FROM conversation_summaries",
+    """
+    INSERT INTO conversation_summaries (
+        conversation_id, last_message_id, last_message_content,
+        last_message_is_deleted, last_message_at
+    )
+    SELECT c.id, m.id, m.content, m.is_deleted, m.timestamp
+    FROM conversations c
+    LEFT JOIN messages m ON m.id = (
+        SELECT latest.id FROM messages latest
+        WHERE latest.conversation_id = c.id
+        ORDER BY latest.timestamp DESC, latest.id DESC
+        LIMIT 1
+    )
+    """,
+    """
+    UPDATE conversation_participants SET unread_count = (
+        SELECT COUNT(*) FROM messages m
+        WHERE m.conversation_id = conversation_participants.conversation_id
+          AND m.sender_id != conversation_participants.user_id
+          AND NOT m.is_deleted
+          AND (
+              conversation_participants.last_read_timestamp IS NULL
+              OR m.timestamp > conversation_participants.last_read_timestamp
+          )
+    )
+    """,
+)
+
+# Full-text index of message content (see message_search.py). The rowid is the
+# message id and scope a "c<conversation id>" token; deleted messages are left out
+MESSAGE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, scope, conversation_id UNINDEXED, "
+    "tokenize = 'unicode61 remove_diacritics 2')"
+)
+
+# Refills the message search index from the messages table
+# (also used by `python -m backend.message_search`)
+SEARCH_REBUILD_STATEMENTS = (
+    "DELETE FROM messages_fts",
+    """
+    INSERT INTO messages_fts (rowid, content, scope, conversation_id)
+    SELECT id, content, 'c' || conversation_id, conversation_id FROM messages
+    WHERE NOT is_deleted AND content IS NOT NULL AND content != ''
+    """,
+    "INSERT INTO messages_fts (messages_fts) VALUES ('optimize')",
+)
+
 
 # Function to add created_at to users table
 def add_created_at_column(cursor):
@@ -51,6 +103,163 @@ def add_read_at_column(cursor):
         print("read_at column already exists in messages table.")
 
 
+# Function to add last_seen to users table
+def add_last_seen_column(cursor):
+    cursor.execute("PRAGMA table_info(users)")
+    columns = cursor.fetchall()
+    column_names = [column[1] for column in columns]
+
+    if "last_seen" not in column_names:
+        cursor.execute("ALTER TABLE users ADD COLUMN last_seen DATETIME")
+        print("Added last_seen column to users table.")
+    else:
+        print("last_seen column already exists in users table.")
+
+
+# Function to add the case-folded, indexed username used by user search
+def add_username_key_column(cursor):
+    cursor.execute("PRAGMA table_info(users)")
+    column_names = [column[1] for column in cursor.fetchall()]
+
+    if "username_key" not in column_names:
+        cursor.execute("ALTER TABLE users ADD COLUMN username_key VARCHAR")
+        # str.casefold, not SQL lower(): that only folds ASCII letters
+        cursor.execute("SELECT id, username FROM users WHERE username IS NOT NULL")
+        cursor.executemany(
+            "UPDATE users SET username_key = ? WHERE id = ?",
+            [(username.casefold(), user_id) for user_id, username in cursor.fetchall()],
+        )
+        print("Added username_key column to users table and filled it.")
+    else:
+        print("username_key column already exists in users table.")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS ix_users_username_key ON users (username_key)"
+    )
+    print("Ensured ix_users_username_key index on users table.")
+
+
+# Function to add the history pagination index to messages table
+def add_message_history_index(cursor):
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS ix_messages_conversation_timestamp_id "
+        "ON messages (conversation_id, timestamp, id)"
+    )
+    print("Ensured ix_messages_conversation_timestamp_id index on messages table.")
+
+
+# Function to remove duplicate participants before the unique index is added
+def dedupe_conversation_participants(cursor):
+    # Keep the oldest row, carrying over the newest read mark of its duplicates
+    cursor.execute(
+        """
+        UPDATE conversation_participants
+        SET last_read_timestamp = (
+            SELECT MAX(d.last_read_timestamp)
+            FROM conversation_participants d
+            WHERE d.conversation_id = conversation_participants.conversation_id
+              AND d.user_id = conversation_participants.user_id
+        )
+        WHERE id IN (
+            SELECT MIN(id) FROM conversation_participants
+            GROUP BY conversation_id, user_id HAVING COUNT(*) > 1
+        )
+        """
+    )
+    cursor.execute(
+        """
+        DELETE FROM conversation_participants
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM conversation_participants
+            GROUP BY conversation_id, user_id
+        )
+        """
+    )
+    if cursor.rowcount:
+        print(f"Removed {cursor.rowcount} duplicate conversation participants.")
+
+
+# Function to add the indexes used by the chat list, read receipts and profiles
+def add_hot_path_indexes(cursor):
+    dedupe_conversation_participants(cursor)
+    statements = {
+        "uq_conversation_participants_conversation_user": (
+            "CREATE UNIQUE INDEX IF NOT EXISTS "
+            "uq_conversation_participants_conversation_user "
+            "ON conversation_participants (conversation_id, user_id)"
+        ),
+        "ix_conversation_participants_user_conversation": (
+            "CREATE INDEX IF NOT EXISTS "
+            "ix_conversation_participants_user_conversation "
+            "ON conversation_participants (user_id, conversation_id)"
+        ),
+        "ix_messages_sender_id": (
+            "CREATE INDEX IF NOT EXISTS ix_messages_sender_id "
+            "ON messages (sender_id)"
+        ),
+        "ix_messages_unread": (
+            "CREATE INDEX IF NOT EXISTS ix_messages_unread "
+            "ON messages (conversation_id, sender_id) WHERE read_at IS NULL"
+        ),
+    }
+    for name, statement in statements.items():
+        cursor.execute(statement)
+        print(f"Ensured {name} index.")
+
+
+# Function to add the write-maintained chat list summary (table and unread counts)
+def add_conversation_summaries(cursor):
+    cursor.execute("PRAGMA table_info(conversation_participants)")
+    column_names = [column[1] for column in cursor.fetchall()]
+    added_unread_count = "unread_count" not in column_names
+    if added_unread_count:
+        cursor.execute(
+            "ALTER TABLE conversation_participants "
+            "ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0"
+        )
+        print("Added unread_count column to conversation_participants table.")
+
+    cursor.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'conversation_summaries'"
+    )
+    added_table = cursor.fetchone() is None
+    if added_table:
+        cursor.execute(
+            """
+            CREATE TABLE conversation_summaries (
+                conversation_id INTEGER NOT NULL PRIMARY KEY
+                    REFERENCES conversations (id),
+                last_message_id INTEGER REFERENCES messages (id),
+                last_message_content VARCHAR,
+                last_message_is_deleted BOOLEAN,
+                last_message_at DATETIME
+            )
+            """
+        )
+        print("Created conversation_summaries table.")
+
+    if added_unread_count or added_table:
+        for statement in SUMMARY_REBUILD_STATEMENTS:
+            cursor.execute(statement)
+        print("Filled conversation summaries and unread counts.")
+    else:
+        print("conversation_summaries table and unread_count column already exist.")
+
+
+# Function to add the full-text message search index
+def add_message_search_index(cursor):
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    )
+    if cursor.fetchone() is None:
+        cursor.execute(MESSAGE_SEARCH_DDL)
+        for statement in SEARCH_REBUILD_STATEMENTS:
+            cursor.execute(statement)
+        print("Created and filled the messages_fts search index.")
+    else:
+        print("messages_fts search index already exists.")
+
+
 def run_migrations():
     conn = None
     try:
@@ -60,7 +269,13 @@ def run_migrations():
         print("Running migrations...")
         add_created_at_column(cursor)
         add_last_read_timestamp_column(cursor)
-        add_read_at_column(cursor)  # Add the new migration step
+        add_read_at_column(cursor)
+        add_message_history_index(cursor)
+        add_hot_path_indexes(cursor)
+        add_conversation_summaries(cursor)
+        add_last_seen_column(cursor)
+        add_message_search_index(cursor)
+        add_username_key_column(cursor)
 
         conn.commit()
         print("Migrations completed successfully.")
@@ -1,9 +1,31 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, JSON
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    DateTime,
+    Boolean,
+    JSON,
+    Index,
+    UniqueConstraint,
+    DDL,
+    event,
+)
 from sqlalchemy.orm import relationship
 from .database import Base
+from .migrate_db import MESSAGE_SEARCH_DDL
 from datetime import datetime
 
 
+def username_search_key(username: str | None) -> str | None:
+    """Case-folded username, as matched by user search (see user_search.py)."""
+    return username.casefold() if username is not None else None
+
+
+def _default_username_key(context):
+    return username_search_key(context.get_current_parameters().get("username"))
+
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
@@ -13,6 +35,9 @@ class User(Base):
     is_admin = Column(Boolean, default=False)
     is_super_admin = Column(Boolean, default=False)
     last_login = Column(DateTime, nullable=True)
+    last_seen = Column(DateTime, nullable=True)  # written in batches, see last_seen_writer.py
+    # Set on insert (usernames never change); indexed for prefix search
+    username_key = Column(String, index=True, default=_default_username_key)
 
 
 class Conversation(Base):
@@ -31,9 +56,27 @@ class ConversationParticipant(Base):
     conversation_id = Column(Integer, ForeignKey("conversations.id"))
     user_id = Column(Integer, ForeignKey("users.id"))
     last_read_timestamp = Column(DateTime, nullable=True)  # Add last read timestamp
+    # Maintained on write (see conversation_summaries.py)
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
     conversation = relationship("Conversation", back_populates="participants")
     user = relationship("User")
 
+    __table_args__ = (
+        # A user is a participant of a conversation at most once; also serves
+        # the "is user X in conversation Y" and "participants of Y" lookups
+        UniqueConstraint(
+            "conversation_id",
+            "user_id",
+            name="uq_conversation_participants_conversation_user",
+        ),
+        # "Conversations of user X" (chat list, socket connect)
+        Index(
+            "ix_conversation_participants_user_conversation",
+            "user_id",
+            "conversation_id",
+        ),
+    )
+
 
 class Message(Base):
     __tablename__ = "messages"
@@ -50,6 +93,46 @@ class Message(Base):
     sender = relationship("User")
     replied_to = relationship("Message", remote_side=[id], backref="replies")
 
+    __table_args__ = (
+        # Keyset pagination of conversation history (chat.fetch_message_page)
+        Index(
+            "ix_messages_conversation_timestamp_id",
+            "conversation_id",
+            "timestamp",
+            "id",
+        ),
+        # Per-user message counts (profiles, admin stats)
+        Index("ix_messages_sender_id", "sender_id"),
+        # Messages still waiting for a read receipt (mark_read)
+        Index(
+            "ix_messages_unread",
+            "conversation_id",
+            "sender_id",
+            sqlite_where=read_at.is_(None),
+            postgresql_where=read_at.is_(None),
+        ),
+    )
+
+
+# Full-text search index next to the messages table (SQLite only; kept in sync
+# by message_search.py)
+event.listen(
+    Message.__table__,
+    "after_create",
+    DDL(MESSAGE_SEARCH_DDL).execute_if(dialect="sqlite"),
+)
+
+
+class ConversationSummary(Base):
+    """Latest message of a conversation, kept up to date on every write."""
+
+    __tablename__ = "conversation_summaries"
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), primary_key=True)
+    last_message_id = Column(Integer, ForeignKey("messages.id"), nullable=True)
+    last_message_content = Column(String, nullable=True)
+    last_message_is_deleted = Column(Boolean, default=False)
+    last_message_at = Column(DateTime, nullable=True)
+
 
 # --- Add Call Model ---
 class Call(Base):
@@ -0,0 +1,184 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+from .database import AsyncSessionLocal
+from .models import ConversationParticipant
+from .ws_manager import emit_to_users, presence, sio
+
+# Presence changes within this window are announced together
+PRESENCE_BROADCAST_DELAY_MS = int(os.getenv("PRESENCE_BROADCAST_DELAY_MS", "250"))
+
+# A user who reconnects within this grace period is never announced offline
+PRESENCE_OFFLINE_GRACE_MS = int(os.getenv("PRESENCE_OFFLINE_GRACE_MS", "5000"))
+
+
+def co_participants_query(user_ids):
+    """Distinct ``(user_id, other participant)`` pairs sharing a conversation."""
+    subject = aliased(ConversationParticipant)
+    other = aliased(ConversationParticipant)
+    return (
+        select(subject.user_id, other.user_id)
+        .join(other, other.conversation_id == subject.conversation_id)
+        .where(subject.user_id.in_(user_ids), other.user_id != subject.user_id)
+        .distinct()
+    )
+
+
+class PresenceBroadcaster:
+    """Announces users going online/offline off the connect/disconnect path.
+
+    Every changed user is announced once to each distinct co-participant
+    (the union of the members of their conversations) who is online, through
+    the recipients' personal rooms, so a contact sharing 50 conversations
+    gets one ``user_status_change``, not one per shared room.
+
+    Transitions are collected for one window and only each user's latest
+    state is announced. Going offline is held back for a grace period: a
+    user who reconnects within it (page reload, network blip) is announced
+    neither offline nor online again.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        presence_store,
+        server=None,
+        window: float = PRESENCE_BROADCAST_DELAY_MS / 1000,
+        grace: float = PRESENCE_OFFLINE_GRACE_MS / 1000,
+    ):
+        self.session_factory = session_factory
+        self.presence = presence_store
+        self.server = server  # defaults to the shared Socket.IO server
+        self.window = window
+        self.grace = grace
+        # user id -> (status, changed at, due at, replaced an unannounced online)
+        self._pending = {}
+        self._timer = None
+        self._wakeup = None  # set when a change is due before the timer wakes
+        self.transitions = 0
+        self.flaps_suppressed = 0
+        self.flushes = 0
+        self.broadcasts = 0
+        self.recipients = 0
+
+    def online(self, user_id) -> None:
+        self.transitions += 1
+        pending = self._pending.get(user_id)
+        if pending is not None and pending[0] == "offline" and not pending[3]:
+            # Back within the grace period: their contacts never saw them leave
+            del self._pending[user_id]
+            self.flaps_suppressed += 1
+            return
+        self._record(user_id, "online", self.window)
+
+    def offline(self, user_id) -> None:
+        self.transitions += 1
+        self._record(user_id, "offline", self.grace)
+
+    def _record(self, user_id, status, delay) -> None:
+        # An "online" that is replaced before it is announced must still be
+        # announced if the user comes back, or their contacts never see it
+        pending = self._pending.get(user_id)
+        unannounced = pending is not None and (pending[0] == "online" or pending[3])
+        self._pending[user_id] = (
+            status,
+            datetime.utcnow(),
+            time.monotonic() + delay,
+            unannounced,
+        )
+        if self._timer is None or self._timer.done():
+            self._wakeup = asyncio.Event()
+            self._timer = asyncio.ensure_future(self._flush_later())
+        else:
+            self._wakeup.set()
+
+    async def stop(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush(everything=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending_users": len(self._pending),
+            "transitions": self.transitions,
+            "flaps_suppressed": self.flaps_suppressed,
+            "flushes": self.flushes,
+            "broadcasts": self.broadcasts,
+            "recipients": self.recipients,
+        }
+
+    async def _flush_later(self) -> None:
+        while self._pending:
+            next_due = min(pending[2] for pending in self._pending.values())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), max(next_due - time.monotonic(), 0)
+                )
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                return
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error broadcasting presence changes: {e}")
+
+    async def flush(self, everything: bool = False) -> None:
+        """Announces the changes that are due (all of them if ``everything``)."""
+        now = time.monotonic()
+        due = {
+            user_id: pending
+            for user_id, pending in self._pending.items()
+            if everything or pending[2] <= now
+        }
+        if not due:
+            return
+        for user_id in due:
+            del self._pending[user_id]
+        self.flushes += 1
+
+        async with self.session_factory() as db:
+            rows = (await db.execute(co_participants_query(list(due)))).all()
+        recipients_by_user = {}
+        for user_id, other_id in rows:
+            recipients_by_user.setdefault(user_id, []).append(other_id)
+
+        # Only contacts with a socket somewhere need to hear about it
+        online = await self.presence.online_users(
+            {other_id for _, other_id in rows}
+        )
+
+        for user_id, (status, changed_at, _, _) in due.items():
+            # May have reconnected through another worker during the grace period
+            if status == "offline" and await self.presence.is_online(user_id):
+                continue
+            recipients = [
+                other_id
+                for other_id in recipients_by_user.get(user_id, ())
+                if other_id in online
+            ]
+            if not recipients:
+                continue
+            await emit_to_users(
+                "user_status_change",
+                {
+                    "user_id": user_id,
+                    "status": status,
+                    "last_seen": (
+                        changed_at.isoformat() if status == "offline" else None
+                    ),
+                },
+                recipients,
+                server=self.server or sio,
+            )
+            self.broadcasts += 1
+            self.recipients += len(recipients)
+
+
+# Shared broadcaster used by the Socket.IO connect/disconnect handlers
+presence_broadcaster = PresenceBroadcaster(AsyncSessionLocal, presence)
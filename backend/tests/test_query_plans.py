@@ -0,0 +1,198 @@
+"""EXPLAIN QUERY PLAN of the hot queries: none may scan a whole table.
+
+Each entry runs the real code path against a seeded database: the REST
+routes (sync ones in a worker thread, as FastAPI runs them), the
+chat-list and presence flushes, and the membership and token lookups
+of the Socket.IO handlers. Every SELECT, UPDATE and DELETE they send is
+checked. Run from the repository root:
+
+    python -m pytest backend/tests
+"""
+
+import asyncio
+import os
+from functools import partial
+from types import SimpleNamespace
+
+import anyio
+import pytest
+import socketio
+from sqlalchemy import event, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from backend import chat
+from backend.auth import create_access_token, get_current_user, get_user_profile, user_cache
+from backend.benchmark import make_session_factory, seed_conversations
+from backend.chat_list_notifier import ChatListNotifier
+from backend.database import Base
+from backend.membership_cache import MembershipCache
+from backend.models import Message
+from backend.presence_broadcaster import PresenceBroadcaster
+from backend.user_search import encode_cursor, find_users
+from backend.ws_manager import LocalPresenceStore, PresenceRegistry
+
+# Messages in each of the 200 seeded conversations
+MESSAGES_PER_CONVERSATION = int(os.getenv("QUERY_PLANS_MESSAGES_PER_CONVERSATION", "20"))
+
+
+def captured_statements(engines, fn) -> list:
+    """Runs ``fn`` and returns the ``(sql, parameters)`` it sent to ``engines``.
+
+    Reads and writes that have a plan are kept (SELECT, UPDATE, DELETE);
+    an executemany keeps its first parameter set.
+    """
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb in ("SELECT", "WITH", "UPDATE", "DELETE"):
+            statements.append((statement, parameters[0] if executemany else parameters))
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", capture)
+    try:
+        fn()
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", capture)
+    return statements
+
+
+def full_scans(plan_rows, tables) -> list:
+    """Plan steps that read a whole table (``SCAN messages``) instead of SEARCH."""
+    scans = []
+    for row in plan_rows:
+        detail = row[-1]
+        if not detail.startswith("SCAN "):
+            continue
+        # Aliases are rendered as e.g. "users_1"; subqueries/CTEs are fine
+        name = detail.split()[1].rstrip("0123456789").rstrip("_")
+        if name in tables:
+            scans.append(detail)
+    return scans
+
+
+@pytest.fixture(scope="module")
+def seeded(tmp_path_factory):
+    """A seeded database, with the sessions and servers the code paths use."""
+    db_path = str(tmp_path_factory.mktemp("query_plans") / "plans.db")
+    Session = make_session_factory(db_path)
+    db = Session()
+    # No pool: connections must not outlive the asyncio.run that made them
+    async_engine = create_async_engine(
+        f"sqlite+aiosqlite:///{db_path}", poolclass=NullPool
+    )
+    async_session_factory = sessionmaker(
+        bind=async_engine, class_=AsyncSession, expire_on_commit=False
+    )
+    server = socketio.AsyncServer(async_mode="asgi")  # no sockets to reach
+    shared_notifier = chat.chat_list_notifier
+    chat.chat_list_notifier = ChatListNotifier(async_session_factory, server=server)
+    try:
+        user_id = seed_conversations(db, 200, MESSAGES_PER_CONVERSATION)
+        # Give the planner statistics, as a long-lived database would have
+        db.execute(text("ANALYZE"))
+        db.commit()
+        yield SimpleNamespace(
+            db=db,
+            engines=[db.get_bind(), async_engine.sync_engine],
+            async_session_factory=async_session_factory,
+            server=server,
+            user_id=user_id,
+            user=SimpleNamespace(id=user_id),
+            own_message_ids=db.scalars(
+                select(Message.id)
+                .where(Message.conversation_id == 7, Message.sender_id == user_id)
+                .order_by(Message.id.desc())
+                .limit(2)
+            ).all(),
+        )
+    finally:
+        chat.chat_list_notifier = shared_notifier
+        db.close()
+
+
+def route(handler, *route_args, **route_kwargs):
+    """Runs a sync route in a worker thread, then the chat-list update it
+    scheduled."""
+
+    async def run():
+        await anyio.to_thread.run_sync(partial(handler, *route_args, **route_kwargs))
+        await chat.chat_list_notifier.flush()
+
+    asyncio.run(run())
+
+
+def presence_flush(s):
+    async def run():
+        broadcaster = PresenceBroadcaster(
+            s.async_session_factory,
+            LocalPresenceStore(PresenceRegistry()),
+            server=s.server,
+            grace=0,
+        )
+        broadcaster.offline(s.user_id)
+        await broadcaster.stop()  # flushes
+
+    asyncio.run(run())
+
+
+def token_lookup(s):
+    user_cache.clear()
+    get_current_user(token=create_access_token({"sub": "user7"}), db=s.db)
+
+
+# Hot code path -> function running it against the ``seeded`` namespace
+HOT_QUERIES = {
+    "chat list": lambda s: chat.build_conversation_list(s.db, s.user_id),
+    "history page": lambda s: chat.get_messages(
+        7, before_id=None, after_id=None, limit=50, user=s.user, db=s.db
+    ),
+    "older history page": lambda s: chat.fetch_message_page(s.db, 7, before_id=130),
+    # a page past the contacts runs all three queries
+    "user search": lambda s: find_users(
+        s.db, s.user_id, "user1", cursor=encode_cursor(["user15", 15])
+    ),
+    "mark read": lambda s: asyncio.run(
+        chat.mark_conversation_as_read(7, user=s.user, db=s.db)
+    ),
+    "edit message": lambda s: route(
+        chat.update_message,
+        s.own_message_ids[0],
+        {"content": "edited"},
+        user=s.user,
+        db=s.db,
+    ),
+    "delete message": lambda s: route(
+        chat.delete_message, s.own_message_ids[1], user=s.user, db=s.db
+    ),
+    "conversation participants": lambda s: s.db.scalars(
+        chat.conversation_members_query(7)
+    ).all(),
+    "presence recipients": presence_flush,
+    "user conversations": lambda s: asyncio.run(
+        MembershipCache(s.async_session_factory).conversation_ids(s.user_id)
+    ),
+    "token user lookup": token_lookup,
+    "user profile": lambda s: get_user_profile(
+        s.user_id, db=s.db, current_user=s.user
+    ),
+}
+
+
+@pytest.mark.parametrize("label", HOT_QUERIES)
+def test_hot_query_uses_indexes(seeded, label):
+    statements = captured_statements(
+        seeded.engines, lambda: HOT_QUERIES[label](seeded)
+    )
+    tables = set(Base.metadata.tables)
+    scans = []
+    with seeded.db.get_bind().connect() as conn:
+        for statement, parameters in statements:
+            plan = conn.exec_driver_sql(
+                "EXPLAIN QUERY PLAN " + statement, parameters
+            ).fetchall()
+            scans.extend(full_scans(plan, tables))
+    assert statements and not scans, f"{label}: {len(statements)} queries, {scans}"
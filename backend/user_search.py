@@ -0,0 +1,182 @@
+"""Type-ahead search of users by username prefix.
+
+Matching uses ``users.username_key``, the case-folded username, as an index
+range (``prefix <= key < next prefix``), which every database answers from
+the index; a case-insensitive ``LIKE``/``ILIKE`` on ``username`` can't use
+its index and reads every user.
+
+Results are ranked: exact matches first, then users sharing a conversation
+with the caller (most recent conversation activity first), then everyone
+else alphabetically. The first two groups are small and built in full for
+each page; the rest is read from the index one page at a time.
+"""
+
+import base64
+import json
+from fastapi import HTTPException
+from sqlalchemy import and_, bindparam, func, or_, select
+
+from .models import ConversationParticipant, ConversationSummary, User, username_search_key
+
+USER_SEARCH_DEFAULT = 10
+USER_SEARCH_MAX = 50
+
+users = User.__table__
+summaries = ConversationSummary.__table__
+mine = ConversationParticipant.__table__.alias("mine")
+theirs = ConversationParticipant.__table__.alias("theirs")
+
+# Built once: composing ORM statements costs more than running them here
+_in_prefix = and_(
+    users.c.username_key >= bindparam("lower"),
+    users.c.username_key < bindparam("upper"),
+)
+
+_exact = (
+    select(users.c.id, users.c.username)
+    .where(users.c.username_key == bindparam("key"), users.c.id != bindparam("user_id"))
+    .order_by(users.c.id)
+)
+
+# The caller's contacts, by the latest message of the conversations they share
+_contacts = (
+    select(users.c.id, users.c.username)
+    .select_from(
+        mine.join(theirs, theirs.c.conversation_id == mine.c.conversation_id)
+        .join(users, users.c.id == theirs.c.user_id)
+        .outerjoin(summaries, summaries.c.conversation_id == mine.c.conversation_id)
+    )
+    .where(
+        mine.c.user_id == bindparam("user_id"),
+        theirs.c.user_id != bindparam("user_id"),
+        _in_prefix,
+    )
+    .group_by(users.c.id, users.c.username)
+    .order_by(func.max(summaries.c.last_message_at).desc().nulls_last(), users.c.id)
+)
+
+# Everyone else, alphabetically after (after_key, after_id)
+_rest = (
+    select(users.c.id, users.c.username, users.c.username_key)
+    .where(
+        _in_prefix,
+        users.c.id != bindparam("user_id"),
+        users.c.username_key >= bindparam("after_key"),
+        or_(
+            users.c.username_key > bindparam("after_key"),
+            users.c.id > bindparam("after_id"),
+        ),
+    )
+    .order_by(users.c.username_key, users.c.id)
+    .limit(bindparam("limit"))
+)
+
+
+def prefix_range(prefix: str) -> tuple[str, str] | None:
+    """Bounds of the keys starting with ``prefix``: ``lower <= key < upper``.
+
+    None for a prefix of nothing but the highest code point (a noncharacter
+    no username contains), which has no upper bound.
+    """
+    stem = prefix.rstrip("\U0010ffff")
+    if not stem:
+        return None
+    return prefix, stem[:-1] + chr(ord(stem[-1]) + 1)
+
+
+def encode_cursor(position: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    """The position an ``encode_cursor`` string stands for; 400 if malformed.
+
+    ``[n]`` is the n-th user of the ranked exact matches and contacts,
+    ``[key, id]`` the last user returned from the alphabetical rest.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, UnicodeDecodeError):
+        position = None
+    valid = isinstance(position, list) and (
+        (len(position) == 1 and isinstance(position[0], int) and position[0] >= 0)
+        or (
+            len(position) == 2
+            and isinstance(position[0], str)
+            and isinstance(position[1], int)
+        )
+    )
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return position
+
+
+def _ranked_head(db, params: dict) -> list:
+    """Exact matches, then the caller's contacts matching the prefix."""
+    exact = db.execute(_exact, params).all()
+    exact_ids = {row.id for row in exact}
+    contacts = db.execute(_contacts, params).all()
+    return list(exact) + [row for row in contacts if row.id not in exact_ids]
+
+
+def find_users(
+    db,
+    user_id: int,
+    query: str,
+    limit: int = USER_SEARCH_DEFAULT,
+    cursor: str | None = None,
+) -> dict:
+    """Users whose username starts with ``query``, ignoring case, best first.
+
+    ``user_id`` (the caller) is left out. Returns
+    ``{"results": [{"id", "username"}], "next_cursor": str or None}``;
+    pass ``next_cursor`` back as ``cursor`` for the next page.
+    """
+    key = username_search_key(query)
+    bounds = prefix_range(key)
+    position = decode_cursor(cursor) if cursor else [0]
+    if bounds is None:
+        return {"results": [], "next_cursor": None}
+    params = {"user_id": user_id, "key": key, "lower": bounds[0], "upper": bounds[1]}
+
+    head = _ranked_head(db, params)
+    if len(position) == 1:
+        start = position[0]
+        page = [(row, None) for row in head[start : start + limit + 1]]
+        after = [bounds[0], -1]
+    else:
+        start = len(head)
+        page = []
+        after = position
+
+    wanted = limit + 1 - len(page)
+    if wanted > 0:
+        head_ids = {row.id for row in head}
+        # Contacts also match the prefix; read enough to make up for them
+        rows = db.execute(
+            _rest,
+            {
+                **params,
+                "after_key": after[0],
+                "after_id": after[1],
+                "limit": wanted + len(head_ids),
+            },
+        ).all()
+        page += [
+            (row, [row.username_key, row.id])
+            for row in rows
+            if row.id not in head_ids
+        ][:wanted]
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        _, last_position = page[-1]
+        if last_position is None:
+            last_position = [start + len(page)]
+        next_cursor = encode_cursor(last_position)
+    return {
+        "results": [{"id": row.id, "username": row.username} for row, _ in page],
+        "next_cursor": next_cursor,
+    }
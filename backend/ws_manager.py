@@ -1,4 +1,471 @@
+import asyncio
+import json
+import os
+import random
+import socket
+import time
+import uuid
 import socketio
+from dotenv import load_dotenv
+
+# Load environment variables (REDIS_URL for multi-worker deployments)
+load_dotenv()
+
+# When set, Socket.IO emits and presence are shared between workers via Redis
+REDIS_URL = os.getenv("REDIS_URL")
+
+# A worker missing heartbeats for this long is considered gone and its
+# sockets are dropped from the shared presence (Redis only)
+PRESENCE_WORKER_TTL_SECONDS = float(os.getenv("PRESENCE_WORKER_TTL_SECONDS", "30"))
+
+# Admission control for new sockets (per worker); 0 disables the limit
+CONNECT_RATE_PER_SECOND = float(os.getenv("CONNECT_RATE_PER_SECOND", "500"))
+CONNECT_BURST = int(os.getenv("CONNECT_BURST", "1000"))
+CONNECT_MAX_RETRY_AFTER = float(os.getenv("CONNECT_MAX_RETRY_AFTER", "30"))
+
+
+class PresenceRegistry:
+    """Tracks which sockets belong to which user, in both directions.
+
+    Keeps ``sid -> user_id`` and ``user_id -> sids`` in sync so every lookup is
+    O(1). A user may have several sockets (tabs/devices); their sids are kept
+    in connection order so the newest one can be picked for 1:1 signaling.
+    """
+
+    def __init__(self):
+        self._user_by_sid = {}
+        self._sids_by_user = {}
+
+    def add(self, sid, user_id) -> None:
+        self.remove(sid)
+        self._user_by_sid[sid] = user_id
+        # dict used as an insertion-ordered set
+        self._sids_by_user.setdefault(user_id, {})[sid] = None
+
+    def remove(self, sid):
+        """Forgets ``sid`` and returns the user it belonged to (or None)."""
+        user_id = self._user_by_sid.pop(sid, None)
+        if user_id is None:
+            return None
+        sids = self._sids_by_user.get(user_id)
+        if sids is not None:
+            sids.pop(sid, None)
+            if not sids:
+                del self._sids_by_user[user_id]
+        return user_id
+
+    def user_for(self, sid):
+        return self._user_by_sid.get(sid)
+
+    def all_sids(self) -> list:
+        return list(self._user_by_sid)
+
+    def sids_for(self, user_id) -> list:
+        """All sockets of ``user_id``, oldest first."""
+        return list(self._sids_by_user.get(user_id, ()))
+
+    def latest_sid_for(self, user_id):
+        """The most recently connected socket of ``user_id`` (or None)."""
+        sids = self._sids_by_user.get(user_id)
+        if not sids:
+            return None
+        return next(reversed(sids))
+
+    def is_online(self, user_id) -> bool:
+        return user_id in self._sids_by_user
+
+    @property
+    def user_count(self) -> int:
+        return len(self._sids_by_user)
+
+    @property
+    def socket_count(self) -> int:
+        return len(self._user_by_sid)
+
+    # sid-keyed read access, so `sid in connected_users` and
+    # `connected_users[sid]` keep working in the event handlers
+    def __contains__(self, sid) -> bool:
+        return sid in self._user_by_sid
+
+    def __getitem__(self, sid):
+        return self._user_by_sid[sid]
+
+    def __len__(self) -> int:
+        return len(self._user_by_sid)
+
+
+class LocalPresenceStore:
+    """Presence for a single worker process, backed by a PresenceRegistry.
+
+    This is the default store. Every store exposes the same async API so the
+    Socket.IO handlers don't care whether presence is process-local or shared.
+    """
+
+    def __init__(self, registry: PresenceRegistry):
+        self.local = registry
+
+    async def add(self, sid, user_id) -> bool:
+        """Registers ``sid``; returns True if it is the user's first socket."""
+        was_online = self.local.is_online(user_id)
+        self.local.add(sid, user_id)
+        return not was_online
+
+    async def remove(self, sid):
+        """Forgets ``sid``; returns ``(user_id, still_online)``."""
+        user_id = self.local.remove(sid)
+        if user_id is None:
+            return None, False
+        return user_id, self.local.is_online(user_id)
+
+    async def sids_for(self, user_id) -> list:
+        return self.local.sids_for(user_id)
+
+    async def latest_sid_for(self, user_id):
+        return self.local.latest_sid_for(user_id)
+
+    async def is_online(self, user_id) -> bool:
+        return self.local.is_online(user_id)
+
+    async def online_users(self, user_ids) -> set:
+        """The subset of ``user_ids`` that has at least one socket."""
+        return {user_id for user_id in user_ids if self.local.is_online(user_id)}
+
+    async def user_count(self) -> int:
+        return self.local.user_count
+
+    async def socket_count(self) -> int:
+        return self.local.socket_count
+
+    async def start(self, on_offline=None) -> None:
+        """Called on startup. Shared stores pass users whose sockets they
+        drop on their own (a crashed worker's) to ``on_offline(user_id)``."""
+
+    async def stop(self) -> None:
+        """Called on shutdown."""
+        await self.clear_local()
+
+    async def clear_local(self) -> None:
+        """Forgets this worker's sockets."""
+        for sid in self.local.all_sids():
+            await self.remove(sid)
+
+    def stats(self) -> dict:
+        return {"store": "local"}
+
+
+class RedisPresenceStore(LocalPresenceStore):
+    """Presence shared by every worker through a Redis-compatible server.
+
+    ``redis`` is any ``redis.asyncio`` compatible client (a real server, or
+    e.g. ``fakeredis.aioredis.FakeRedis`` as a local stand-in). The local
+    registry is still updated so per-socket checks stay in-memory; Redis
+    holds the global view:
+
+    - ``<prefix>:sids`` hash of sid -> user id (socket count = HLEN)
+    - ``<prefix>:user:<id>`` sorted set of sids scored by connect time
+    - ``<prefix>:users`` set of online user ids (user count = SCARD)
+    - ``<prefix>:worker:<worker id>`` hash of the sockets each worker holds
+    - ``<prefix>:alive:<worker id>`` expires ``ttl`` seconds after the
+      worker's last heartbeat
+    - ``<prefix>:workers`` set of registered worker ids
+
+    A worker that dies without shutting down stops heartbeating; the next
+    heartbeat of any other worker (or the next worker to start) finds its
+    ``alive`` key gone and removes its sockets, so its users don't stay
+    online for good.
+    """
+
+    def __init__(
+        self,
+        redis,
+        registry: PresenceRegistry,
+        prefix: str = "talkflow:presence",
+        worker_id: str | None = None,
+        ttl: float = PRESENCE_WORKER_TTL_SECONDS,
+    ):
+        super().__init__(registry)
+        self.redis = redis
+        self.prefix = prefix
+        self.worker_id = worker_id or (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        )
+        self.ttl = ttl
+        self.reaped_workers = 0
+        self.reaped_sockets = 0
+        self._on_offline = None
+        self._heartbeat = None
+
+    def _user_key(self, user_id) -> str:
+        return f"{self.prefix}:user:{user_id}"
+
+    def _worker_key(self, worker_id) -> str:
+        return f"{self.prefix}:worker:{worker_id}"
+
+    def _alive_key(self, worker_id) -> str:
+        return f"{self.prefix}:alive:{worker_id}"
+
+    async def start(self, on_offline=None) -> None:
+        self._on_offline = on_offline
+        await self.beat()
+        await self.redis.sadd(f"{self.prefix}:workers", self.worker_id)
+        await self.reap()
+        if self._heartbeat is None:
+            self._heartbeat = asyncio.create_task(self._run_heartbeat())
+
+    async def stop(self) -> None:
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            try:
+                await self._heartbeat
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat = None
+        await self.clear_local()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(
+                self._alive_key(self.worker_id), self._worker_key(self.worker_id)
+            )
+            pipe.srem(f"{self.prefix}:workers", self.worker_id)
+            await pipe.execute()
+
+    async def beat(self) -> None:
+        """Marks this worker alive for another ``ttl`` seconds."""
+        await self.redis.set(
+            self._alive_key(self.worker_id), 1, ex=max(int(self.ttl), 1)
+        )
+
+    async def _run_heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.beat()
+                await self.reap()
+            except Exception as e:
+                print(f"Error in presence heartbeat: {e}")
+
+    async def reap(self) -> list:
+        """Removes the sockets of workers whose heartbeat expired.
+
+        Returns the users left without a socket, after passing each of them
+        to ``on_offline``. Safe to run on several workers at once.
+        """
+        offline = []
+        for raw_worker_id in await self.redis.smembers(f"{self.prefix}:workers"):
+            worker_id = _decode(raw_worker_id)
+            if worker_id == self.worker_id or await self.redis.exists(
+                self._alive_key(worker_id)
+            ):
+                continue
+            sockets = await self.redis.hgetall(self._worker_key(worker_id))
+            for raw_sid, raw_user_id in sockets.items():
+                sid = _decode(raw_sid)
+                user_id, still_online = await self._forget(
+                    sid, int(raw_user_id), worker_id
+                )
+                if not still_online:
+                    offline.append(user_id)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.delete(self._worker_key(worker_id))
+                pipe.srem(f"{self.prefix}:workers", worker_id)
+                await pipe.execute()
+            self.reaped_workers += 1
+            self.reaped_sockets += len(sockets)
+            print(f"Removed {len(sockets)} sockets of stopped worker {worker_id}")
+        if self._on_offline is not None:
+            for user_id in offline:
+                self._on_offline(user_id)
+        return offline
+
+    async def add(self, sid, user_id) -> bool:
+        self.local.add(sid, user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(f"{self.prefix}:sids", sid, user_id)
+            pipe.hset(self._worker_key(self.worker_id), sid, user_id)
+            pipe.zadd(self._user_key(user_id), {sid: time.time()})
+            pipe.sadd(f"{self.prefix}:users", user_id)
+            pipe.zcard(self._user_key(user_id))
+            results = await pipe.execute()
+        return results[-1] == 1
+
+    async def remove(self, sid):
+        user_id = self.local.remove(sid)
+        if user_id is None:
+            # The socket may have been registered by a worker that restarted
+            raw_user_id = await self.redis.hget(f"{self.prefix}:sids", sid)
+            if raw_user_id is None:
+                return None, False
+            user_id = int(raw_user_id)
+        return await self._forget(sid, user_id, self.worker_id)
+
+    async def _forget(self, sid, user_id, worker_id):
+        """Drops ``sid`` of ``worker_id``; returns ``(user_id, still_online)``."""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hdel(f"{self.prefix}:sids", sid)
+            pipe.hdel(self._worker_key(worker_id), sid)
+            pipe.zrem(self._user_key(user_id), sid)
+            pipe.zcard(self._user_key(user_id))
+            results = await pipe.execute()
+        still_online = results[-1] > 0
+        if not still_online:
+            await self.redis.srem(f"{self.prefix}:users", user_id)
+            # Another worker may have registered a socket in the meantime
+            if await self.redis.zcard(self._user_key(user_id)) > 0:
+                await self.redis.sadd(f"{self.prefix}:users", user_id)
+                still_online = True
+        return user_id, still_online
+
+    async def sids_for(self, user_id) -> list:
+        sids = await self.redis.zrange(self._user_key(user_id), 0, -1)
+        return [_decode(sid) for sid in sids]
+
+    async def latest_sid_for(self, user_id):
+        sids = await self.redis.zrange(self._user_key(user_id), -1, -1)
+        return _decode(sids[0]) if sids else None
+
+    async def is_online(self, user_id) -> bool:
+        return bool(await self.redis.sismember(f"{self.prefix}:users", user_id))
+
+    async def online_users(self, user_ids) -> set:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.sismember(f"{self.prefix}:users", user_id)
+            results = await pipe.execute()
+        return {user_id for user_id, online in zip(user_ids, results) if online}
+
+    async def user_count(self) -> int:
+        return await self.redis.scard(f"{self.prefix}:users")
+
+    async def socket_count(self) -> int:
+        return await self.redis.hlen(f"{self.prefix}:sids")
+
+    def stats(self) -> dict:
+        return {
+            "store": "redis",
+            "worker_id": self.worker_id,
+            "ttl_seconds": self.ttl,
+            "reaped_workers": self.reaped_workers,
+            "reaped_sockets": self.reaped_sockets,
+        }
+
+
+class ConnectionRateLimiter:
+    """Token bucket admitting at most ``rate`` connections/s after a ``burst``.
+
+    A refused client is told when to come back: each refusal takes the next
+    free slot (``1 / rate`` apart) of a virtual queue, so a reconnect storm
+    is spread out at the rate the server can admit instead of every client
+    retrying at the same moment.
+    """
+
+    def __init__(
+        self,
+        rate: float = CONNECT_RATE_PER_SECOND,
+        burst: int = CONNECT_BURST,
+        max_retry_after: float = CONNECT_MAX_RETRY_AFTER,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_retry_after = max_retry_after
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._next_slot = 0.0
+        self.admitted = 0
+        self.refused = 0
+
+    def acquire(self):
+        """Returns None if the connection is admitted, else seconds to wait."""
+        if self.rate <= 0:
+            self.admitted += 1
+            return None
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self.admitted += 1
+            return None
+
+        self.refused += 1
+        self._next_slot = max(self._next_slot, now) + 1 / self.rate
+        retry_after = min(self._next_slot - now, self.max_retry_after)
+        # Jitter so clients given neighbouring slots don't collide
+        return round(retry_after * random.uniform(1.0, 1.2), 2)
+
+    def stats(self) -> dict:
+        return {
+            "rate_per_second": self.rate,
+            "burst": self.burst,
+            "admitted": self.admitted,
+            "refused": self.refused,
+        }
+
+
+async def join_rooms(sid, rooms, server=None, namespace="/") -> None:
+    """Adds ``sid`` to all ``rooms`` at once.
+
+    Same effect as ``enter_room`` per room (room membership is always kept
+    by the worker that owns the socket, also with the Redis manager), minus
+    an awaited call and a log line per room.
+    """
+    manager = (server or sio).manager
+    eio_sid = manager.eio_sid_from_sid(sid, namespace)
+    for room in rooms:
+        manager.basic_enter_room(sid, namespace, room, eio_sid=eio_sid)
+
+
+def user_room(user_id) -> str:
+    """Room joined by every socket (tab/device) of ``user_id`` on connect."""
+    return f"user:{user_id}"
+
+
+async def emit_to_users(event, data, user_ids, server=None) -> None:
+    """Sends one event to every device of ``user_ids`` with a single emit."""
+    rooms = [user_room(user_id) for user_id in dict.fromkeys(user_ids)]
+    if rooms:
+        await (server or sio).emit(event, data, room=rooms)
+
+
+async def emit_per_user(event, data_by_user: dict, server=None) -> None:
+    """Sends each user their own payload, one emit per distinct payload.
+
+    Users whose payloads are equal share a single multi-room emit, so the
+    packet is encoded once and fanned out by the client manager.
+    """
+    groups = {}
+    for user_id, data in data_by_user.items():
+        key = json.dumps(data, sort_keys=True, default=str)
+        groups.setdefault(key, (data, []))[1].append(user_id)
+    for data, user_ids in groups.values():
+        await emit_to_users(event, data, user_ids, server=server)
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def create_client_manager(redis_url: str | None):
+    """Socket.IO client manager: in-process by default, Redis pub/sub if configured."""
+    if not redis_url:
+        return None  # socketio.AsyncServer falls back to AsyncManager
+    return socketio.AsyncRedisManager(redis_url)
+
+
+def create_presence_store(redis_url: str | None, registry: PresenceRegistry):
+    if not redis_url:
+        return LocalPresenceStore(registry)
+    try:
+        import redis.asyncio as redis_asyncio
+    except ImportError as e:
+        raise RuntimeError(
+            "REDIS_URL is set but the 'redis' package is not installed"
+        ) from e
+    return RedisPresenceStore(redis_asyncio.from_url(redis_url), registry)
+
 
 # Shared Socket.IO server instance
 sio = socketio.AsyncServer(
@@ -8,7 +475,14 @@ sio = socketio.AsyncServer(
     ping_timeout=35000,
     logger=True,
     engineio_logger=True,
+    client_manager=create_client_manager(REDIS_URL),
 )
 
-# Shared dictionary to store mapping of socket IDs (sid) to user IDs
-connected_users = {}
+# Sockets connected to this worker (sid <-> user id)
+connected_users = PresenceRegistry()
+
+# Presence across all workers; use this for "is user X online / where"
+presence = create_presence_store(REDIS_URL, connected_users)
+
+# Admission control applied by the connect handler
+connect_limiter = ConnectionRateLimiter()
@@ -32,6 +32,70 @@ async function callAIEndpoint(endpoint, text) {
     }
 }
 
+// Streams an AI response from the server-sent events endpoint, calling
+// onDelta with the text received so far; resolves to the full result
+async function streamAIEndpoint(endpoint, text, onDelta) {
+    try {
+        const token = localStorage.getItem('token');
+        const body = endpoint === 'translate'
+            ? { text, target_language: 'russian' } // Default to Russian translation
+            : { text };
+
+        const response = await fetch(`/ai/${endpoint}/stream`, {
+            method: 'POST',
+            headers: {
+                'Authorization': `Bearer ${token}`,
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(body)
+        });
+
+        if (!response.ok) {
+            throw new Error(`AI request failed: ${response.statusText}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let received = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // Events are separated by a blank line
+            let end;
+            while ((end = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, end);
+                buffer = buffer.slice(end + 2);
+
+                let event = 'message';
+                let data = '';
+                for (const line of rawEvent.split('\n')) {
+                    if (line.startsWith('event: ')) event = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                }
+                const payload = data ? JSON.parse(data) : {};
+
+                if (event === 'delta') {
+                    received += payload.delta;
+                    onDelta(received);
+                } else if (event === 'done') {
+                    return payload.result;
+                } else if (event === 'error') {
+                    throw new Error(payload.detail);
+                }
+            }
+        }
+        return received.trim() || null;
+    } catch (error) {
+        console.error(`Error streaming AI endpoint ${endpoint}:`, error);
+        showToast(`AI Error: ${error.message}`, "error");
+        return null;
+    }
+}
+
 // Function to update message input with AI result
 function updateMessageInput(result) {
     if (!result) return;
@@ -91,7 +155,11 @@ function setupAIButtons() {
             if (!text) return;
             
             completeSentenceBtn.disabled = true;
-            const result = await callAIEndpoint('complete-sentence', text);
+            // Completions are the slowest; show them as they arrive
+            const result = await streamAIEndpoint('complete-sentence', text, (partial) => {
+                const input = document.getElementById('message-input');
+                if (input) input.value = partial;
+            });
             completeSentenceBtn.disabled = false;
             
             if (result) {
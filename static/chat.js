@@ -27,7 +27,7 @@ const showToast = (message, type = 'info') => {
 
 
 import { setupMessageHandlers, setupReplyUI, hideReplyUI, handleMessageClick, clearMessageSelection } from './messageHandlers.js';
-import { initializeSocket, joinConversation, connected_users } from './socket.js';
+import { initializeSocket, joinConversation, connected_users, watchConnectRefusals } from './socket.js';
 import { showProfile } from './profile.js';
 import { initMessageInteractions, getReplyData } from './messageInteractions.js'; // Removed startReply import
 // --- ADD WEBRTC IMPORTS ---
@@ -47,6 +47,12 @@ let conversations = [];
 let userData = null;
 let socket = null;
 
+// History paging (GET /chat/messages/{id} returns the newest page by default)
+const MESSAGE_PAGE_SIZE = 50;
+let oldestLoadedMessageId = null;
+let hasMoreHistory = false;
+let isLoadingHistory = false;
+
 // --- DOM Element Variables (Declare here, assign in DOMContentLoaded) ---
 let chatSection = null;
 let profileSection = null;
@@ -132,6 +138,7 @@ async function setupSocketListeners() {
 
         // Remove any existing listeners to prevent duplicates
         socket.removeAllListeners();
+        watchConnectRefusals(socket);
 
         // Handle new messages
         socket.on('message', async (data) => {
@@ -167,8 +174,7 @@ async function setupSocketListeners() {
                     }
                 }
             }
-            // Update chat list without scrolling
-            debouncedLoadConversations();
+            // The chat list entry arrives separately via update_chat_list
         });
 
         // Handle message deletion
@@ -180,8 +186,7 @@ async function setupSocketListeners() {
                     messageElement.innerHTML = '<div class="message-content">[Message deleted]</div>';
                 }
             }
-            // Update chat list to reflect deleted message
-            await loadConversations();
+            // The chat list entry arrives separately via update_chat_list
         });
 
         // Handle message editing
@@ -197,17 +202,23 @@ async function setupSocketListeners() {
                     }
                 }
             }
-            // Update chat list to reflect edited message
-            await loadConversations();
+            // The chat list entry arrives separately via update_chat_list
+        });
+
+        // Patch the chat list with the server's coalesced deltas
+        socket.on('update_chat_list', (data) => {
+            if (!applyChatListUpdate(data)) {
+                debouncedLoadConversations();
+            }
         });
 
         // Handle read status updates
-        socket.on('messages_read', async (data) => {
+        socket.on('messages_read', (data) => {
             if (data.conversation_id === currentConversationId) {
-                updateMessageReadStatus(data.message_ids);
+                updateMessageReadStatus(data.read_up_to_id);
             }
-            // Update chat list to reflect read status
-            await loadConversations();
+            // The reader's unread badge arrives as an update_chat_list; the
+            // senders' chat list shows nothing about read receipts
         });
 
         // Handle user status changes
@@ -322,6 +333,13 @@ document.addEventListener('DOMContentLoaded', async () => {
         localAudioElement = document.getElementById('local-audio');
         remoteAudioElement = document.getElementById('remote-audio');
 
+        // Fetch older history when the user scrolls to the top
+        messageList?.addEventListener('scroll', () => {
+            if (messageList.scrollTop < 50) {
+                loadOlderMessages();
+            }
+        });
+
         const token = localStorage.getItem('token');
         console.log('Token found in localStorage:', token ? 'Yes' : 'No');
 
@@ -605,7 +623,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                     });
                     if (!response.ok) throw new Error('User search failed');
 
-                    const users = await response.json();
+                    const { results: users } = await response.json();
                     userSuggestions.innerHTML = ''; // Clear "Searching..."
 
                     const currentUsername = document.getElementById('profile-username')?.textContent; // Get own username if profile was loaded
@@ -743,7 +761,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                     });
                     if (!response.ok) throw new Error('User search failed');
 
-                    const users = await response.json();
+                    const { results: users } = await response.json();
                     newGroupUserSuggestions.innerHTML = ''; // Clear "Searching..."
 
                     // Filter out self and already added users
@@ -999,6 +1017,29 @@ async function loadConversations() {
     }
 }
 
+// Applies an update_chat_list delta to the loaded chat list. Returns false
+// when a full reload is needed (e.g. a conversation we don't have yet).
+function applyChatListUpdate(data) {
+    const updates = data && data.conversations;
+    if (!Array.isArray(updates)) return false;
+
+    for (const update of updates) {
+        const conversation = conversations.find(c => c.id === update.id);
+        if (!conversation) return false;
+        Object.assign(conversation, update);
+    }
+
+    // Same order as the server: newest activity first, empty chats last
+    conversations.sort((a, b) => {
+        if (!a.last_timestamp || !b.last_timestamp) {
+            return (a.last_timestamp ? 0 : 1) - (b.last_timestamp ? 0 : 1) || b.id - a.id;
+        }
+        return b.last_timestamp.localeCompare(a.last_timestamp) || b.id - a.id;
+    });
+    renderChatList(conversations);
+    return true;
+}
+
 function renderChatList(convList) {
     const chatListEl = document.getElementById('chat-list');
     if (!chatListEl) {
@@ -1280,7 +1321,7 @@ async function loadConversation(conversationId) {
 
         // --- Fetch Conversation Details (Messages) ---
         console.log('Fetching messages for conversation:', conversationId);
-        const response = await fetch(`/chat/messages/${conversationId}`, {
+        const response = await fetch(`/chat/messages/${conversationId}?limit=${MESSAGE_PAGE_SIZE}`, {
             headers: { 'Authorization': `Bearer ${token}` }
         });
 
@@ -1295,6 +1336,8 @@ async function loadConversation(conversationId) {
 
         const messages = await response.json();
         console.log(`Loaded ${messages.length} messages for conversation ${conversationId}`);
+        oldestLoadedMessageId = messages.length > 0 ? messages[0].id : null;
+        hasMoreHistory = messages.length === MESSAGE_PAGE_SIZE;
 
         // --- Render Messages ---
         // Add a class to prevent any scroll behavior
@@ -1393,6 +1436,50 @@ async function loadConversation(conversationId) {
     }
 }
 
+async function loadOlderMessages() {
+    if (!currentConversationId || !hasMoreHistory || isLoadingHistory || !oldestLoadedMessageId) return;
+    const messageList = document.getElementById('message-list');
+    if (!messageList) return;
+
+    isLoadingHistory = true;
+    const conversationId = currentConversationId;
+    try {
+        const token = localStorage.getItem('token');
+        const response = await fetch(
+            `/chat/messages/${conversationId}?before_id=${oldestLoadedMessageId}&limit=${MESSAGE_PAGE_SIZE}`,
+            { headers: { 'Authorization': `Bearer ${token}` } }
+        );
+        if (!response.ok) {
+            console.error('Failed to load older messages:', response.status);
+            return;
+        }
+        const olderMessages = await response.json();
+        // Ignore the page if the user switched conversations meanwhile
+        if (conversationId !== currentConversationId) return;
+
+        hasMoreHistory = olderMessages.length === MESSAGE_PAGE_SIZE;
+        if (olderMessages.length === 0) return;
+        oldestLoadedMessageId = olderMessages[0].id;
+
+        // Prepend while keeping the visible message in place
+        const previousHeight = messageList.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        olderMessages.forEach(msg => {
+            const messageDiv = createMessageElement(msg);
+            if (messageDiv) {
+                fragment.appendChild(messageDiv);
+            }
+        });
+        messageList.insertBefore(fragment, messageList.firstChild);
+        messageList.scrollTop += messageList.scrollHeight - previousHeight;
+        console.log(`Loaded ${olderMessages.length} older messages for conversation ${conversationId}`);
+    } catch (error) {
+        console.error('Error loading older messages:', error);
+    } finally {
+        isLoadingHistory = false;
+    }
+}
+
 async function markConversationRead(conversationId) {
     if (!conversationId) return;
     console.log(`Marking conversation ${conversationId} as read...`);
@@ -1531,14 +1618,13 @@ function createMessageElement(msg) {
     return messageWrapper;
 }
 
-// Update the updateMessageReadStatus function
-function updateMessageReadStatus(messageIds) {
-    if (!Array.isArray(messageIds)) return;
-    console.log("Updating read status for messages:", messageIds);
+// Marks own messages up to the receipt's high-water mark as read
+function updateMessageReadStatus(readUpToId) {
+    if (typeof readUpToId !== 'number') return;
+    console.log("Updating read status for messages up to:", readUpToId);
 
-    messageIds.forEach(messageId => {
-        const messageElement = document.querySelector(`.message[data-message-id="${messageId}"]`);
-        if (messageElement && messageElement.dataset.senderId == currentUserId) {
+    document.querySelectorAll(`.message[data-sender-id="${currentUserId}"]`).forEach(messageElement => {
+        if (Number(messageElement.dataset.messageId) <= readUpToId) {
             const statusIcon = messageElement.querySelector('.message-status-icon');
             if (statusIcon) {
                 statusIcon.innerHTML = '✔✔';
@@ -1743,6 +1829,7 @@ export {
     createMessageElement,
     updateMessageReadStatus,
     renderChatList, // Export if needed for socket updates
+    applyChatListUpdate,
     showToast // Export showToast if it's defined here
 };
 
@@ -1,4 +1,4 @@
-import { currentConversationId, loadConversations, currentUserId, createMessageElement, updateMessageReadStatus } from './chat.js'; // Import updateMessageReadStatus
+import { currentConversationId, loadConversations, currentUserId, createMessageElement, updateMessageReadStatus, applyChatListUpdate } from './chat.js'; // Import updateMessageReadStatus
 
 // Track connected users
 export const connected_users = new Map();
@@ -62,23 +62,42 @@ export async function initializeSocket() {
                 timeout: 10000 // 10 second connection timeout
             });
 
+            // Retry connections the server refused while under load
+            watchConnectRefusals(socket);
+
             // Set up connection timeout
             await new Promise((resolve, reject) => {
-                socketConnectionTimeout = setTimeout(() => {
-                    reject(new Error('Socket connection timeout'));
-                }, 10000);
+                const armTimeout = (ms) => {
+                    clearTimeout(socketConnectionTimeout);
+                    socketConnectionTimeout = setTimeout(() => {
+                        socket.off('connect_error', onConnectError);
+                        reject(new Error('Socket connection timeout'));
+                    }, ms);
+                };
+
+                const onConnectError = (error) => {
+                    const retryAfter = getRetryAfter(error);
+                    if (retryAfter !== null) {
+                        // Keep waiting for the retry scheduled by watchConnectRefusals
+                        armTimeout(retryAfter * 1000 + MAX_RETRY_JITTER_MS + 10000);
+                        return;
+                    }
+                    clearTimeout(socketConnectionTimeout);
+                    socket.off('connect_error', onConnectError);
+                    console.error('Socket connection error:', error);
+                    reject(error);
+                };
+
+                armTimeout(10000);
 
                 socket.once('connect', () => {
                     clearTimeout(socketConnectionTimeout);
+                    socket.off('connect_error', onConnectError);
                     console.log('Socket connected successfully');
                     resolve();
                 });
 
-                socket.once('connect_error', (error) => {
-                    clearTimeout(socketConnectionTimeout);
-                    console.error('Socket connection error:', error);
-                    reject(error);
-                });
+                socket.on('connect_error', onConnectError);
             });
 
             // Set up basic event listeners
@@ -119,6 +138,32 @@ export async function initializeSocket() {
     return socketInitializationPromise;
 }
 
+const MAX_RETRY_JITTER_MS = 1000;
+
+// Seconds to wait before retrying, when the server refused the connection
+// because too many clients were connecting at once (null otherwise)
+function getRetryAfter(error) {
+    const retryAfter = error?.data?.retry_after;
+    return typeof retryAfter === 'number' ? retryAfter : null;
+}
+
+// Refused connections are not retried by socket.io itself; reconnect after
+// the server's hint plus jitter so refused clients don't return in lockstep.
+// Call again after removeAllListeners().
+export function watchConnectRefusals(sock) {
+    sock.on('connect_error', (error) => {
+        const retryAfter = getRetryAfter(error);
+        if (retryAfter === null) return;
+        const delay = retryAfter * 1000 + Math.random() * MAX_RETRY_JITTER_MS;
+        console.log(`Server busy, retrying connection in ${Math.round(delay)} ms`);
+        setTimeout(() => {
+            if (!sock.connected) {
+                sock.connect();
+            }
+        }, delay);
+    });
+}
+
 // Function to join a conversation
 export async function joinConversation(conversationId) {
     const socket = await initializeSocket();
@@ -159,6 +204,7 @@ function setupSocketEvents() {
 
     // Remove any existing listeners to prevent duplicates
     socket.removeAllListeners();
+    watchConnectRefusals(socket);
 
     socket.io.on("error", (error) => {
         console.error('Transport error:', error);
@@ -230,7 +276,7 @@ function setupSocketEvents() {
                 }
             }
         }
-        loadConversations();
+        // The chat list entry arrives separately via update_chat_list
     });
 
     socket.on('message_deleted', (data) => {
@@ -261,13 +307,15 @@ function setupSocketEvents() {
 
     socket.on('update_chat_list', (data) => {
         console.log('Received update_chat_list event:', data);
-        loadConversations();
+        if (!applyChatListUpdate(data)) {
+            loadConversations();
+        }
     });
 
     socket.on('messages_read', (data) => {
         console.log('Received messages_read event:', data);
         if (data.conversation_id === currentConversationId) {
-            updateMessageReadStatus(data.message_ids);
+            updateMessageReadStatus(data.read_up_to_id);
         }
     });
 }